@@ -0,0 +1,149 @@
+"""
+Offline analysis of stored chains: autocorrelation, effective sample size (ESS), Monte Carlo
+standard error (MCSE) and integrated autocorrelation time (IAT) of every coordinate.
+
+Unlike OnlineDiagnostics, which summarises the chain while it runs, these use the whole
+stored chain. Autocorrelations are calculated using the FFT, for a chunk of coordinates
+at a time in a single vectorized pass, so chains on disk are read one chunk of columns at
+a time. Several chains of the same length are combined as in reference 1, and the IAT is
+estimated using Geyer's initial monotone sequence, reference 2.
+
+References:
+    1. Bayesian Data Analysis (3rd edition), section 11.5
+    2. Practical Markov chain Monte Carlo - https://doi.org/10.1214/ss/1177011137
+"""
+import numpy as np
+
+
+def as_chains(chains):
+    """
+    Return chains as a list of arrays of shape (n_iters, d), truncated to the same length.
+
+    Parameters:
+    chains - a chain of shape (n_iters, d) such as lr.sample, a stack of chains of shape
+            (n_chains, n_iters, d), a path to a .npy file holding a chain, e.g. a
+            checkpoint's sample table, or a list of any of these; files are memory-mapped
+    """
+    if isinstance( chains, basestring ) or ( isinstance( chains, np.ndarray )
+            and chains.ndim == 2 ):
+        chains = [ chains ]
+    loaded = []
+    for chain in chains:
+        if isinstance( chain, basestring ):
+            chain = np.load( chain, mmap_mode = 'r' )
+        if chain.ndim == 3:
+            loaded += list(chain)
+        else:
+            loaded.append( chain )
+    n_iters = min( [ chain.shape[0] for chain in loaded ] )
+    return [ chain[:n_iters] for chain in loaded ]
+
+
+def autocovariance(x):
+    """
+    Calculate the autocovariance of every chain and coordinate at every lag using the FFT.
+
+    Parameters:
+    x - array of shape (n_chains, n_iters, n_coordinates)
+
+    Returns:
+    acov - array with the same shape as x, acov[:,t,:] holding the autocovariance at lag t
+    """
+    n_iters = x.shape[1]
+    # Zero pad to avoid circular correlation, to a power of 2 for speed
+    size = 2**int( np.ceil( np.log2( 2 * n_iters ) ) )
+    centred = x - x.mean( axis = 1 )[:,np.newaxis,:]
+    # Tiny terms underflow, which LogisticRegression sets to raise
+    with np.errstate( under = 'ignore' ):
+        transform = np.fft.rfft( centred, n = size, axis = 1 )
+        power = transform.real**2 + transform.imag**2
+        return np.fft.irfft( power, n = size, axis = 1 )[:,:n_iters,:] / n_iters
+
+
+def initial_sequence(rho):
+    """
+    Estimate the integrated autocorrelation time of each coordinate from its autocorrelations.
+
+    Sums of autocorrelations at neighbouring lags are truncated at the first negative sum
+    and made monotone decreasing, Geyer's initial monotone sequence estimator.
+
+    Parameters:
+    rho - array of shape (n_lags, n_coordinates) holding autocorrelations from lag 0
+
+    Returns:
+    iat - integrated autocorrelation time of each coordinate
+    """
+    n_pairs = rho.shape[0] // 2
+    pairs = rho[0:2*n_pairs:2,:] + rho[1:2*n_pairs:2,:]
+    positive = np.cumprod( pairs > 0, axis = 0 ).astype(bool)
+    pairs = np.minimum.accumulate( np.where( positive, pairs, 0 ), axis = 0 )
+    return -1 + 2 * pairs.sum( axis = 0 )
+
+
+def analyse_chains(chains,max_lag=None,chunk_size=100):
+    """
+    Calculate the ESS, MCSE and IAT of every coordinate of stored chains.
+
+    Parameters:
+    chains - chains in any form accepted by as_chains
+    max_lag - also return the autocorrelations up to this lag (optional)
+    chunk_size - number of coordinates processed at a time (optional)
+
+    Returns:
+    summary - dict holding vectors with an entry for each coordinate: mean, sd (the
+            posterior standard deviation), ess, mcse and iat, and autocorrelation, an
+            array of shape (max_lag + 1, d), if max_lag is set
+    """
+    chains = as_chains(chains)
+    n_chains = len(chains)
+    n_iters, d = chains[0].shape
+    keys = [ 'mean', 'sd', 'ess', 'mcse', 'iat' ]
+    summary = dict( ( key, np.zeros(d) ) for key in keys )
+    if max_lag is not None:
+        summary['autocorrelation'] = np.zeros( ( max_lag + 1, d ) )
+    for start in xrange(0,d,chunk_size):
+        end = min( start + chunk_size, d )
+        x = np.array( [ chain[:,start:end] for chain in chains ], dtype = float )
+        acov = autocovariance(x)
+        chain_means = x.mean( axis = 1 )
+        within = acov[:,0,:].mean( axis = 0 ) * n_iters / ( n_iters - 1.0 )
+        var_plus = within * ( n_iters - 1.0 ) / n_iters
+        if n_chains > 1:
+            var_plus += chain_means.var( axis = 0, ddof = 1 )
+        rho = 1 - ( within - acov.mean( axis = 0 ) ) / var_plus
+        # Bound the IAT below, as antithetic chains could otherwise give an unbounded ESS
+        iat = np.maximum( initial_sequence(rho), 1 / np.log10( n_chains * n_iters ) )
+        summary['mean'][start:end] = chain_means.mean( axis = 0 )
+        summary['sd'][start:end] = np.sqrt(var_plus)
+        summary['iat'][start:end] = iat
+        summary['ess'][start:end] = n_chains * n_iters / iat
+        summary['mcse'][start:end] = np.sqrt( var_plus * iat / ( n_chains * n_iters ) )
+        if max_lag is not None:
+            summary['autocorrelation'][:,start:end] = rho[:max_lag+1,:]
+    return summary
+
+
+def compare_corrected(sample,corrected,chunk_size=100):
+    """
+    Compare a chain with its zero variance corrected version, e.g. from lr.postprocess_functionals.
+
+    The corrected chain estimates the same means as the original with a smaller MCSE. Its
+    gain is reported as an effective ESS: the number of independent draws from the
+    posterior that would give the MCSE of the corrected chain.
+
+    Parameters:
+    sample - original chain in any form accepted by as_chains
+    corrected - corrected chain with the same shape
+    chunk_size - number of coordinates processed at a time (optional)
+
+    Returns:
+    comparison - dict holding vectors with an entry for each coordinate: ess_before and
+            mcse_before of the original chain, mcse_after of the corrected chain,
+            effective_ess of the corrected chain and mcse_ratio, mcse_before / mcse_after
+    """
+    before = analyse_chains( sample, chunk_size = chunk_size )
+    after = analyse_chains( corrected, chunk_size = chunk_size )
+    mcse_ratio = before['mcse'] / after['mcse']
+    return { 'ess_before' : before['ess'], 'mcse_before' : before['mcse'],
+            'mcse_after' : after['mcse'], 'effective_ess' : before['ess'] * mcse_ratio**2,
+            'mcse_ratio' : mcse_ratio }
@@ -0,0 +1,122 @@
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve
+from data_source import ArrayData, AliasTable
+from evaluator import test_logloss
+
+
+def sensitivities(data,beta_mode,block_size=10000,ridge=1e-8):
+    """
+    Calculate the importance of each row of the training data, used to sample a coreset.
+
+    The sensitivity of a row bounds the share of the log likelihood it can contribute, so
+    rows with high sensitivity have to be kept for a small coreset to approximate the log
+    likelihood everywhere. For logistic regression it is bounded using three terms, each
+    normalised to sum to 1 over the data: the size | y_i - p_i | ||x_i|| of the row's log
+    likelihood gradient at the mode, its leverage x_i^T ( X^T W X )^-1 x_i, which is large
+    for rows in directions few other rows cover, and its row weight, a uniform term.
+
+    Takes two passes over the data in blocks, the first to calculate X^T W X.
+
+    Parameters:
+    data - data source holding the training data, rows can already be weighted
+    beta_mode - parameter values at the mode
+    block_size - number of rows processed at a time (optional)
+    ridge - regularisation of X^T W X, relative to its average diagonal (optional)
+
+    Returns:
+    probabilities - sampling probability of each row, proportional to its sensitivity
+    """
+    gram = np.zeros( ( data.d, data.d ) )
+    for X, y, weights in data.weighted_blocks(block_size):
+        if weights is None:
+            gram += np.dot( X.T, X )
+        else:
+            gram += np.dot( X.T, weights[:,np.newaxis] * X )
+    gram[np.diag_indices(data.d)] += ridge * np.trace(gram) / data.d
+    factor = cho_factor( gram )
+    gradients = []
+    leverages = []
+    uniform = []
+    for X, y, weights in data.weighted_blocks(block_size):
+        if weights is None:
+            weights = np.ones( len(y) )
+        with np.errstate( over = 'ignore', under = 'ignore' ):
+            residuals = y - 1 / ( 1 + np.exp( - np.dot( X, beta_mode ) ) )
+        gradients.append( weights * np.abs(residuals) * np.sqrt( ( X**2 ).sum( axis = 1 ) ) )
+        leverages.append( weights * ( cho_solve( factor, X.T ).T * X ).sum( axis = 1 ) )
+        uniform.append( weights )
+    probabilities = np.zeros( data.N )
+    for term in [ gradients, leverages, uniform ]:
+        term = np.concatenate(term)
+        probabilities += term / term.sum()
+    return probabilities / 3
+
+
+def build_coreset(data,beta_mode,size,block_size=10000):
+    """
+    Sample a weighted coreset of the training data by sensitivity sampling.
+
+    size rows are drawn with replacement, with probability q_i given by sensitivities,
+    and a row drawn c_i times gets row weight c_i w_i / ( size q_i ), where w_i is its
+    weight in data. The weighted log likelihood of the coreset is then an unbiased
+    estimate of the full data log likelihood at any parameter values, with small variance
+    near the mode. Fitting a LogisticRegression object to the coreset makes the cost of
+    full data passes, e.g. for the control variates, depend on the coreset size rather than N.
+
+    Parameters:
+    data - data source holding the training data
+    beta_mode - parameter values at the mode, e.g. found by SGD on a subsample
+    size - number of rows drawn, the coreset holds at most this many distinct rows
+    block_size - number of rows processed at a time (optional)
+
+    Returns:
+    coreset - ArrayData object holding the coreset, with row weights
+    indices - indices of the coreset rows in data
+    """
+    probabilities = sensitivities( data, beta_mode, block_size )
+    draws = AliasTable( probabilities ).draw( size )
+    indices, counts = np.unique( draws, return_counts = True )
+    row_weights = counts / ( size * probabilities[indices] )
+    if data.row_weights is not None:
+        row_weights *= data.row_weights[indices]
+    X, y = data.rows(indices)
+    return ArrayData( X, y, row_weights ), indices
+
+
+def compare_posteriors(sample,reference,X_test=None,y_test=None):
+    """
+    Compare a posterior sample fitted to a coreset with one fitted to the full data.
+
+    Parameters:
+    sample - array of shape (n_iters, d) holding the coreset chain, e.g. lr.sample
+    reference - array of shape (n_iters, d) holding the full data chain
+    X_test - matrix of explanatory variables for testing (optional)
+    y_test - vector of response variables for testing (optional)
+
+    Returns:
+    report - dict holding:
+        mean_error, the largest difference between the posterior means of a coordinate,
+            in full data posterior standard deviations
+        sd_ratio_median, sd_ratio_min, sd_ratio_max, the ratio of the coreset posterior
+            standard deviation to the full data one, over coordinates
+        covariance_error, the Frobenius norm of the difference between the posterior
+            covariances relative to that of the full data covariance
+        logloss, reference_logloss, the test log loss at each posterior mean, if the test
+            set is given
+    """
+    mean = sample.mean( axis = 0 )
+    reference_mean = reference.mean( axis = 0 )
+    covariance = np.atleast_2d( np.cov( sample, rowvar = False ) )
+    reference_covariance = np.atleast_2d( np.cov( reference, rowvar = False ) )
+    sd = np.sqrt( np.diag(covariance) )
+    reference_sd = np.sqrt( np.diag(reference_covariance) )
+    sd_ratio = sd / reference_sd
+    report = { 'mean_error' : np.max( np.abs( mean - reference_mean ) / reference_sd ),
+            'sd_ratio_median' : np.median(sd_ratio), 'sd_ratio_min' : np.min(sd_ratio),
+            'sd_ratio_max' : np.max(sd_ratio),
+            'covariance_error' : np.linalg.norm( covariance - reference_covariance )
+                / np.linalg.norm( reference_covariance ) }
+    if X_test is not None:
+        report['logloss'] = test_logloss( mean, X_test, y_test )
+        report['reference_logloss'] = test_logloss( reference_mean, X_test, y_test )
+    return report
@@ -0,0 +1,164 @@
+import numpy as np
+
+
+class OnlineDiagnostics:
+    """
+    Convergence diagnostics updated one iteration at a time, without storing the chain.
+
+    The chain is summarised by at most 2 * n_batches batches, each holding the mean and
+    sum of squared deviations of every coordinate. When the batches fill up, neighbouring
+    batches are merged and the batch size doubles, so each update costs O(d) amortised.
+    From the batches we get the batch means estimate of the asymptotic variance, which
+    gives the effective sample size (ESS) and Monte Carlo standard error (MCSE) of each
+    coordinate, and the mean and variance of each half of the chain, used for split R-hat.
+
+    References:
+        1. Batch means - https://arxiv.org/abs/1403.5536
+        2. Split R-hat - Bayesian Data Analysis (3rd edition), section 11.4
+    """
+
+    def __init__(self,d,n_batches=32):
+        """
+        Initialise empty diagnostics.
+
+        Parameters:
+        d - dimension of the chain
+        n_batches - minimum number of batches once the chain is long enough (optional)
+        """
+        self.d = d
+        self.n_batches = n_batches
+        self.batch_size = 1
+        self.n_complete = 0
+        self.batch_means = np.zeros( ( 2 * n_batches, d ) )
+        self.batch_m2 = np.zeros( ( 2 * n_batches, d ) )
+        # Current, incomplete batch
+        self.count = 0
+        self.mean = np.zeros( d )
+        self.m2 = np.zeros( d )
+        # Total number of iterations seen
+        self.n = 0
+
+
+    def update(self,x):
+        """
+        Add one state of the chain
+
+        Parameters:
+        x - current state of the chain (float array of length d)
+        """
+        self.n += 1
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * ( x - self.mean )
+        if self.count == self.batch_size:
+            self.batch_means[self.n_complete,:] = self.mean
+            self.batch_m2[self.n_complete,:] = self.m2
+            self.n_complete += 1
+            self.count = 0
+            self.mean = np.zeros( self.d )
+            self.m2 = np.zeros( self.d )
+            if self.n_complete == 2 * self.n_batches:
+                self.merge_batches()
+
+
+    def merge_batches(self):
+        """Merge neighbouring batches, doubling the batch size"""
+        means_left = self.batch_means[0::2,:]
+        means_right = self.batch_means[1::2,:]
+        delta = means_right - means_left
+        self.batch_m2[:self.n_batches,:] = ( self.batch_m2[0::2,:] + self.batch_m2[1::2,:]
+                + delta**2 * self.batch_size / 2.0 )
+        self.batch_means[:self.n_batches,:] = ( means_left + means_right ) / 2.0
+        self.n_complete = self.n_batches
+        self.batch_size *= 2
+
+
+    def variance(self):
+        """Return the variance of each coordinate over the complete batches"""
+        means = self.batch_means[:self.n_complete,:]
+        n = self.n_complete * self.batch_size
+        m2 = self.batch_m2[:self.n_complete,:].sum( axis = 0 ) + self.batch_size * (
+                ( means - means.mean( axis = 0 ) )**2 ).sum( axis = 0 )
+        return m2 / ( n - 1 )
+
+
+    def asymptotic_variance(self):
+        """Return the batch means estimate of the asymptotic variance of each coordinate"""
+        means = self.batch_means[:self.n_complete,:]
+        return self.batch_size * means.var( axis = 0, ddof = 1 )
+
+
+    def ess(self):
+        """Return the effective sample size of each coordinate"""
+        if self.n_complete < 2:
+            return np.zeros( self.d )
+        n = self.n_complete * self.batch_size
+        return n * self.variance() / self.asymptotic_variance()
+
+
+    def mcse(self):
+        """Return the Monte Carlo standard error of the mean of each coordinate"""
+        if self.n_complete < 2:
+            return np.inf * np.ones( self.d )
+        n = self.n_complete * self.batch_size
+        return np.sqrt( self.asymptotic_variance() / n )
+
+
+    def halves(self):
+        """
+        Return the length, mean and variance of each half of the chain.
+
+        Only complete batches are used, with the last one dropped if there's an odd number.
+        """
+        n_half = self.n_complete // 2
+        summaries = []
+        for start in [0, n_half]:
+            means = self.batch_means[start:(start+n_half),:]
+            n = n_half * self.batch_size
+            m2 = self.batch_m2[start:(start+n_half),:].sum( axis = 0 ) + self.batch_size * (
+                    ( means - means.mean( axis = 0 ) )**2 ).sum( axis = 0 )
+            summaries.append( ( n, means.mean( axis = 0 ), m2 / ( n - 1 ) ) )
+        return summaries
+
+
+    def rhat(self):
+        """Return the split R-hat of each coordinate for this chain alone"""
+        return split_rhat( [self] )
+
+
+def split_rhat(chains):
+    """
+    Calculate split R-hat for each coordinate across several chains.
+
+    Parameters:
+    chains - list of OnlineDiagnostics objects, one for each chain
+
+    Returns:
+    rhat - split R-hat of each coordinate, nan until every chain has 4 complete batches
+    """
+    if min( [ chain.n_complete for chain in chains ] ) < 4:
+        return np.nan * np.ones( chains[0].d )
+    halves = []
+    for chain in chains:
+        halves += chain.halves()
+    n = min( [ half[0] for half in halves ] )
+    means = np.array( [ half[1] for half in halves ] )
+    within = np.mean( [ half[2] for half in halves ], axis = 0 )
+    between = n * means.var( axis = 0, ddof = 1 )
+    var_plus = ( n - 1 ) / float( n ) * within + between / n
+    return np.sqrt( var_plus / within )
+
+
+def diagnostics_from_chain(sample,n_batches=32):
+    """
+    Build OnlineDiagnostics from a stored chain, e.g. when resuming from a checkpoint.
+
+    Parameters:
+    sample - array of shape (n_iters, d) holding the chain
+    n_batches - minimum number of batches once the chain is long enough (optional)
+    """
+    diagnostics = OnlineDiagnostics( sample.shape[1], n_batches )
+    for x in sample:
+        diagnostics.update(x)
+    return diagnostics
@@ -0,0 +1,126 @@
+import threading
+import multiprocessing
+import Queue
+import numpy as np
+from timeit import default_timer
+from sklearn.metrics import log_loss
+
+
+class AsyncEvaluator:
+    """
+    Evaluate the test log loss of snapshots of beta in a background worker.
+
+    Snapshots are submitted while the chain keeps running, the worker calculates the
+    test log loss of each and returns it tagged with the iteration, the sampling time
+    reported at submission and the time the evaluation itself took. The worker is
+    either a thread (numpy releases the GIL during the matrix product) or a forked
+    process, which holds its own reference to the test set.
+    """
+
+    def __init__(self,X_test,y_test,mode='thread',weights=None,loss=None):
+        """
+        Start the background worker.
+
+        Parameters:
+        X_test - matrix of explanatory variables for testing
+        y_test - vector of response variables for testing
+        mode - either 'thread' or 'process', the type of worker to use (optional)
+        weights - weight of each test point, e.g. its multiplicity (optional)
+        loss - function calculating the test log loss, with the signature of test_logloss,
+                which is the default (optional)
+        """
+        if loss is None:
+            loss = test_logloss
+        if mode == 'thread':
+            self.tasks = Queue.Queue()
+            self.done = Queue.Queue()
+            self.worker = threading.Thread( target = evaluate_snapshots,
+                    args = ( X_test, y_test, self.tasks, self.done, weights, loss ) )
+        elif mode == 'process':
+            self.tasks = multiprocessing.Queue()
+            self.done = multiprocessing.Queue()
+            self.worker = multiprocessing.Process( target = evaluate_snapshots,
+                    args = ( X_test, y_test, self.tasks, self.done, weights, loss ) )
+        else:
+            raise ValueError( "Unknown evaluation mode: {0}".format( mode ) )
+        self.worker.daemon = True
+        self.worker.start()
+        self.n_submitted = 0
+        self.n_returned = 0
+
+
+    def submit(self,iteration,beta,elapsed_time):
+        """
+        Queue a snapshot of beta for evaluation.
+
+        Parameters:
+        iteration - iteration the snapshot was taken at
+        beta - current parameter values, copied before being queued
+        elapsed_time - sampling time to tag the result with
+        """
+        self.tasks.put( ( iteration, np.copy( beta ), elapsed_time ) )
+        self.n_submitted += 1
+
+
+    def results(self,block=False):
+        """
+        Return the evaluations which have finished so far.
+
+        Parameters:
+        block - if True wait until every submitted snapshot has been evaluated (optional)
+
+        Returns:
+        results - list of dictionaries with keys iteration, test_log_loss, elapsed_time
+                and evaluation_time
+        """
+        results = []
+        while self.n_returned < self.n_submitted:
+            try:
+                result = self.done.get( block = block )
+            except Queue.Empty:
+                break
+            results.append( result )
+            self.n_returned += 1
+        return results
+
+
+    def close(self):
+        """Wait for outstanding evaluations, stop the worker and return the remaining results"""
+        results = self.results( block = True )
+        self.tasks.put( None )
+        self.worker.join()
+        return results
+
+
+def evaluate_snapshots(X_test,y_test,tasks,done,weights,loss):
+    """Worker loop, evaluate snapshots from tasks until None is received"""
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        iteration, beta, elapsed_time = task
+        start = default_timer()
+        current_loss = loss( beta, X_test, y_test, weights = weights )
+        done.put( { 'iteration' : iteration, 'test_log_loss' : current_loss,
+                'elapsed_time' : elapsed_time, 'evaluation_time' : default_timer() - start } )
+
+
+def test_logloss(beta,X_test,y_test,pool=None,weights=None):
+    """
+    Calculate the log loss on the test set for parameter values beta
+
+    Parameters:
+    beta - a vector of logistic regression parameters (float array)
+    X_test - matrix of explanatory variables for testing
+    y_test - vector of response variables for testing
+    pool - BlockPool used to score blocks of the test set in parallel (optional)
+    weights - weight of each test point, e.g. its multiplicity if duplicates were 
+            compressed using unique_rows (optional)
+    """
+    if pool is None:
+        scores = np.asarray( X_test.dot( beta ) ).ravel()
+    else:
+        scores = np.concatenate( pool.map( lambda X : np.asarray( X.dot( beta ) ).ravel(),
+                pool.split( X_test ) ) )
+    y_pred = ( scores >= 0.0 ).astype(int)
+    return log_loss( y_test, y_pred, sample_weight = weights )
@@ -1,7 +1,15 @@
+import sys
+import itertools
 import numpy as np
+from metrics import Metrics
+from diagnostics import OnlineDiagnostics, diagnostics_from_chain
+from evaluator import AsyncEvaluator, test_logloss
+from data_source import as_data_source
+from parallel import BlockPool
+from summary import PosteriorSummary
+from stein import kernel_stein_discrepancy, random_feature_ksd
 from stopwatch import Stopwatch
 from saga import SAGA
-from sklearn.metrics import log_loss
 
 
 class LogisticRegression:
@@ -20,26 +28,34 @@ class LogisticRegression:
     """
 
 
-    def __init__(self,X_train,X_test,y_train,y_test):
+    def __init__(self,X_train,X_test,y_train,y_test,n_threads=1,test_weights=None):
         """
         Initialise the logistic regression object.
 
         Parameters:
-        X_train - matrix of explanatory variables for training (assumes numpy array of floats)
+        X_train - matrix of explanatory variables for training (assumes numpy array of floats),
+                or a data source such as those returned by data_source.load_memmap, 
+                in which case y_train is ignored
         X_test - matrix of explanatory variables for testing (assumes numpy array of ints)
         y_train - vector of response variables for training (assumes numpy array of ints)
         y_train - vector of response variables for testing (assumes numpy array of ints)
+        n_threads - number of threads used for full data passes, large minibatches and 
+                test set evaluation, None to use one per core (optional)
+        test_weights - weight of each test point in the test log loss, e.g. its multiplicity
+                if duplicate test points were compressed (optional)
         """
         # Set error to be raised if there's an over/under flow
         np.seterr( over = 'raise', under = 'raise' )
-        self.X = X_train
-        self.y = y_train
+        self.data = as_data_source( X_train, y_train )
         self.X_test = X_test
         self.y_test = y_test
+        self.test_weights = test_weights
+        # Function calculating the test log loss at given parameter values
+        self.test_loss = test_logloss
 
         # Set dimension constants
-        self.N = self.X.shape[0]
-        self.d = self.X.shape[1]
+        self.N = self.data.N
+        self.d = self.data.d
         self.test_size = self.X_test.shape[0]
         
         # Initialise containers
@@ -51,9 +67,43 @@ class LogisticRegression:
         self.training_loss = []
         self.n_iters = None
         self.fitter = None
+        # Instrumentation for the current fit, disabled until fit is called
+        self.metrics = Metrics( enabled = False )
+        # Background evaluation mode of the test log loss, None evaluates synchronously
+        self.evaluation = None
+        # Checkpointer used to periodically save the state of the fit
+        self.checkpointer = None
+        # Online convergence diagnostics and total sampling time of the current fit
+        self.diagnostics = None
+        self.sampling_time = 0.0
+        # StoppingRule used to end the current fit early
+        self.stopping = None
+        # GradientProbe recording the variance of the gradient estimates of the current fit,
+        # as rows [iteration, total variance, squared error] of gradient_variance
+        self.probe = None
+        self.gradient_variance = []
+        # MinibatchSchedule adapting the minibatch size of the current fit
+        self.schedule = None
+        # Thread pool evaluating gradients over blocks of rows
+        self.pool = BlockPool( n_threads )
 
 
-    def fit(self,stepsize,n_iters=10**4,minibatch_size=500):
+    def close(self):
+        """Stop the threads of self.pool, after which blocks are evaluated in the calling thread"""
+        self.pool.close()
+
+
+    def __enter__(self):
+        """Use the object in a with statement, which closes it on exit"""
+        return self
+
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+
+    def fit(self,stepsize,n_iters=10**4,minibatch_size=500,metrics=None,
+            evaluation=None,checkpointer=None,stopping=None,schedule=None,probe=None):
         """
         Fit Bayesian logistic regression model using train and test set.
 
@@ -61,42 +111,349 @@ class LogisticRegression:
 
         Parameters:
         stepsize - stepsize to use in stochastic gradient descent
-        n_iters - number of iterations of stochastic gradient descent (optional)
+        n_iters - maximum number of iterations of stochastic gradient descent, can be None 
+                if stopping is set (optional)
         minibatch_size - minibatch size in stochastic gradient descent (optional)
+        metrics - Metrics object used to record progress, by default records are 
+                written to stdout as JSON lines (optional)
+        evaluation - 'thread' or 'process' to evaluate the test log loss in a background
+                worker while sampling continues, None evaluates synchronously (optional)
+        checkpointer - Checkpointer object used to periodically save the state of the fit,
+                so it can be continued using resume (optional)
+        stopping - StoppingRule object used to end the fit once a target ESS, MCSE or 
+                compute budget is reached (optional)
+        probe - GradientProbe object used to record the variance of the gradient estimates
+                in self.gradient_variance (optional)
+        schedule - MinibatchSchedule object used to adapt the minibatch size to the 
+                gradient noise, starting from minibatch_size (optional)
         """
         # Holds log loss values once fitted
         self.training_loss = []
         # Number of iterations before the logloss is stored
         self.loss_thinning = 10
         # Initialize sample storage
-        self.n_iters = n_iters
-        self.sample = np.zeros( ( self.n_iters, self.d ) )
-        self.grad_sample = np.zeros( ( self.n_iters, self.d ) )
+        self.init_chain(n_iters)
 
+        self.metrics = metrics if metrics is not None else Metrics( stream = sys.stdout )
+        self.evaluation = evaluation
+        self.checkpointer = checkpointer
+        self.stopping = stopping
+        self.probe = probe
+        self.gradient_variance = []
+        self.schedule = schedule
         self.fitter = SAGA(self,stepsize,minibatch_size,n_iters)
         # Burn in chain
         print "Fitting chain..."
-        print "{0}\t{1}".format( "iteration", "Test log loss" )
+        self.run_fitter(n_iters)
+
+
+    def resume(self,checkpointer,metrics=None,evaluation=None,stopping=None,probe=None):
+        """
+        Continue a fit from the last checkpoint written by checkpointer.
+
+        The object should hold the same data as the one which was checkpointed; BlockData
+        is put back in its checkpointed shuffle. The chain continues exactly as if the fit
+        had not been interrupted.
+
+        Parameters:
+        checkpointer - Checkpointer object pointing at the checkpoint to resume from
+        metrics - Metrics object used to record progress, by default records are 
+                written to stdout as JSON lines (optional)
+        evaluation - 'thread' or 'process' to evaluate the test log loss in a background
+                worker while sampling continues, None evaluates synchronously (optional)
+        stopping - StoppingRule object used to end the fit once a target ESS, MCSE or 
+                compute budget is reached (optional)
+        probe - GradientProbe object used to record the variance of the gradient estimates
+                in self.gradient_variance (optional)
+        """
+        state, tables = checkpointer.load()
+        self.beta = state['beta']
+        self.training_loss = state['training_loss'].tolist()
+        if 'gradient_variance' in state:
+            self.gradient_variance = state['gradient_variance'].tolist()
+        self.loss_thinning = int( state['loss_thinning'] )
+        # A maximum number of iterations of -1 means the fit is only ended by a StoppingRule
+        self.n_iters = int( state['n_iters'] )
+        if self.n_iters < 0:
+            self.n_iters = None
+        self.sample = tables.pop('sample')
+        self.grad_sample = tables.pop('grad_sample')
+        # Put BlockData rows back in the checkpointed order before anything is drawn
+        if 'block_permutation' in tables:
+            self.data.set_permutation( tables.pop('block_permutation') )
+        self.sampling_time = float( state['sampling_time'] )
+        self.diagnostics = diagnostics_from_chain( self.sample[:int( state['iter'] ),:] )
+
+        self.metrics = metrics if metrics is not None else Metrics( stream = sys.stdout )
+        self.evaluation = evaluation
+        self.checkpointer = checkpointer
+        self.stopping = stopping
+        self.probe = probe
+        self.schedule = None
+        fitters = { 'SAGA' : SAGA }
+        self.fitter = fitters[str( state['fitter'] )]( self, float( state['epsilon'] ), 
+                int( state['minibatch_size'] ), self.n_iters, **tables )
+        self.fitter.restore_state( state )
+        if 'pending_minibatch' in state:
+            self.data.request( state['pending_minibatch'] )
+        if 'block_chunks' in state:
+            self.data.chunk_size = int( state['block_chunk_size'] )
+            self.data.chunks = list( state['block_chunks'] )
+        np.random.set_state( state['rng'] )
+        print "Resuming from iteration {0}...".format( self.fitter.iter )
+        self.run_fitter( self.n_iters, self.fitter.iter + 1 )
+
+
+    def append(self,X_new,y_new,row_weights=None):
+        """
+        Append new observations to the training data.
+
+        The data source and N are updated, as are the SAGA gradient tables of the current 
+        fitter, without another pass over the old data. The chain can then be continued 
+        using continue_fit.
+
+        Parameters:
+        X_new - matrix of explanatory variables of the new observations (dense or sparse)
+        y_new - vector of response variables of the new observations
+        row_weights - weight of each new observation in the likelihood, if the training data 
+                is weighted (optional)
+        """
+        start = self.N
+        self.data.append( X_new, y_new, row_weights )
+        self.N = self.data.N
+        if self.fitter is not None:
+            X, y = self.data.rows( np.arange( start, self.N ) )
+            weights = None
+            if self.data.row_weights is not None:
+                weights = self.data.row_weights[start:]
+            self.fitter.append( self, X, y, weights )
+
+
+    def continue_fit(self,n_iters,stopping=None):
+        """
+        Continue the current chain from its last state, e.g. once new data has been appended.
+
+        Parameters:
+        n_iters - maximum number of additional iterations, can be None if stopping is set
+        stopping - StoppingRule object used to end the fit (optional)
+        """
+        if n_iters is not None:
+            n_iters += self.fitter.iter
+        self.n_iters = n_iters
+        self.stopping = stopping
+        print "Continuing from iteration {0}...".format( self.fitter.iter )
+        self.run_fitter( n_iters, self.fitter.iter + 1 )
+
+
+    def checkpoint_state(self):
+        """Return the state of the fit which is not held in the chain, used by Checkpointer"""
+        state = { 'beta' : self.beta, 'training_loss' : np.array( self.training_loss ), 
+                'gradient_variance' : np.array( self.gradient_variance ).reshape( -1, 3 ), 
+                'loss_thinning' : self.loss_thinning, 
+                'n_iters' : self.n_iters if self.n_iters is not None else -1, 
+                'sampling_time' : self.sampling_time }
+        # Minibatch already drawn by a PrefetchReader, but not yet used
+        if getattr( self.data, 'pending', None ) is not None:
+            state['pending_minibatch'] = self.data.pending
+        # Chunks left in the current epoch of BlockData
+        if getattr( self.data, 'chunk_size', None ) is not None:
+            state['block_chunk_size'] = self.data.chunk_size
+            state['block_chunks'] = np.array( self.data.chunks, dtype = int )
+        return state
+
+
+    def init_chain(self,n_iters,capacity=1000):
+        """
+        Allocate storage for the chain and its gradients, which grows as the chain gets longer.
+
+        Parameters:
+        n_iters - maximum number of iterations, None if the fit is only ended by a StoppingRule
+        capacity - number of iterations to allocate storage for initially (optional)
+        """
+        self.n_iters = n_iters
+        if n_iters is not None:
+            capacity = min( n_iters, capacity )
+        self.sample = np.zeros( ( capacity, self.d ) )
+        self.grad_sample = np.zeros( ( capacity, self.d ) )
+
+
+    def grow_chain(self):
+        """Double the storage for the chain and its gradients, up to n_iters iterations"""
+        capacity = self.sample.shape[0]
+        extra = capacity
+        if self.n_iters is not None:
+            extra = min( capacity, self.n_iters - capacity )
+        self.sample = np.concatenate( ( self.sample, np.zeros( ( extra, self.d ) ) ) )
+        self.grad_sample = np.concatenate( ( self.grad_sample, np.zeros( ( extra, self.d ) ) ) )
+
+
+    def run_fitter(self,n_iters,start=1):
+        """
+        Run the current fitter for n_iters iterations, storing the chain as it goes.
+
+        Every loss_thinning iterations the log loss on the test set is calculated and
+        a record is emitted to self.metrics. The elapsed time stored in training_loss is
+        the sampling time since the last record, excluding the time spent evaluating.
+        If self.evaluation is set, snapshots of beta are evaluated by a background worker
+        while the chain keeps running. Online convergence diagnostics are updated every
+        iteration and summarised in each record. If self.stopping is set the fit ends as soon
+        as one of its targets is reached, after which the chain storage is trimmed and
+        self.n_iters holds the number of iterations actually run.
+
+        Parameters:
+        n_iters - maximum number of iterations to run the fitter for, None for no maximum
+        start - iteration to start from, greater than 1 when resuming (optional)
+        """
+        if start == 1:
+            self.diagnostics = OnlineDiagnostics( self.d )
+            self.sampling_time = 0.0
+        evaluator = None
+        if self.evaluation is not None:
+            evaluator = AsyncEvaluator( self.X_test, self.y_test, self.evaluation, 
+                    self.test_weights, self.test_loss )
+        if self.stopping is not None:
+            self.stopping.start(self)
+        if n_iters is None:
+            iterations = itertools.count(start)
+        else:
+            iterations = xrange(start,n_iters+1)
+        completed = start - 1
         timer = Stopwatch()
-        for self.fitter.iter in range(1,n_iters+1):
-            # Every so often output log loss on test set and store 
+        # Time spent probing the gradient variance since the last record, not counted as sampling
+        probe_timer = Stopwatch()
+        probe_time = 0.0
+        for self.fitter.iter in iterations:
+            if self.fitter.iter > self.sample.shape[0]:
+                self.grow_chain()
+            # Every so often store log loss on test set and sampling time
             if self.fitter.iter % self.loss_thinning == 0:
-                elapsed_time = timer.toc()
-                current_loss = self.logloss()
-                self.training_loss.append( [current_loss,elapsed_time] )
-                print "{0}\t\t{1}\t\t{2}".format( self.fitter.iter, current_loss, elapsed_time )
+                elapsed_time = timer.toc() - probe_time
+                probe_time = 0.0
+                self.sampling_time += elapsed_time
+                if evaluator is None:
+                    self.metrics.tic('evaluation')
+                    current_loss = self.logloss()
+                    self.metrics.toc('evaluation')
+                    self.training_loss.append( [current_loss,elapsed_time] )
+                    self.metrics.emit( self.fitter.iter, test_log_loss = current_loss, 
+                            elapsed_time = elapsed_time, **self.live_diagnostics() )
+                else:
+                    evaluator.submit( self.fitter.iter, self.beta, elapsed_time )
+                    self.store_evaluations( evaluator.results() )
                 timer.tic()
+            probing = self.probe is not None and self.probe.due( self.fitter.iter )
+            # Parameters the update's gradient estimate is calculated at, for the probe and schedule
+            if probing or self.schedule is not None:
+                beta = self.beta.copy()
             self.fitter.update(self)
+            if probing:
+                probe_timer.tic()
+                self.metrics.tic('probe')
+                self.probe.record( self, beta )
+                self.metrics.toc('probe')
+                probe_time += probe_timer.toc()
+            if self.schedule is not None and self.fitter.iter % self.schedule.every == 0:
+                self.schedule.update( self, beta )
+            self.metrics.tic('storage')
             self.sample[(self.fitter.iter-1),:] = self.beta
+            self.metrics.toc('storage')
+            self.metrics.tic('diagnostics')
+            self.diagnostics.update(self.beta)
+            self.metrics.toc('diagnostics')
+            if self.checkpointer is not None and self.fitter.iter % self.checkpointer.every == 0:
+                if evaluator is not None:
+                    self.store_evaluations( evaluator.results( block = True ) )
+                self.metrics.tic('checkpoint')
+                self.checkpointer.save(self)
+                self.metrics.toc('checkpoint')
+            completed = self.fitter.iter
+            if self.stopping is not None and self.stopping.done(self):
+                print "Stopping at iteration {0}: {1}".format( completed, self.stopping.reason )
+                break
+        if evaluator is not None:
+            self.store_evaluations( evaluator.close() )
+        # Drop unused storage if the fit was stopped early
+        self.n_iters = completed
+        self.sample = self.sample[:completed,:]
+        self.grad_sample = self.grad_sample[:completed,:]
+
+
+    def store_evaluations(self,results):
+        """
+        Store test log loss values returned by an AsyncEvaluator.
+
+        Parameters:
+        results - list of results returned by AsyncEvaluator.results
+        """
+        for result in results:
+            self.training_loss.append( [result['test_log_loss'],result['elapsed_time']] )
+            self.metrics.emit( result['iteration'], test_log_loss = result['test_log_loss'],
+                    elapsed_time = result['elapsed_time'], 
+                    evaluation_time = result['evaluation_time'], **self.live_diagnostics() )
+
+
+    def live_diagnostics(self):
+        """
+        Summarise the online convergence diagnostics of the current fit.
+
+        Returns:
+        summary - dictionary with the minimum ESS, maximum MCSE and maximum split R-hat over
+                coordinates, and the minimum ESS per second of sampling time
+        """
+        ess = self.diagnostics.ess()
+        summary = { 'min_ess' : float( ess.min() ), 
+                'max_mcse' : float( self.diagnostics.mcse().max() ),
+                'max_rhat' : float( np.max( self.diagnostics.rhat() ) ), 
+                'ess_per_second' : 0.0 }
+        if self.sampling_time > 0:
+            summary['ess_per_second'] = summary['min_ess'] / self.sampling_time
+        return summary
+
+
+    def summary(self,thin=10):
+        """
+        Summarise the fitted chain for prediction.
+
+        Parameters:
+        thin - keep every thin-th iteration of the chain in the summary (optional)
+
+        Returns:
+        summary - PosteriorSummary object holding a thinned sample, the posterior mean
+                and covariance
+        """
+        return PosteriorSummary( self.sample, thin )
+
+
+    def stein_discrepancy(self,thin=10,recompute=False,approximate=False,chunk_size=100):
+        """
+        Calculate the kernel Stein discrepancy of the fitted chain, a measure of sample quality.
+
+        Parameters:
+        thin - use every thin-th iteration of the chain (optional)
+        recompute - recompute the full data log posterior gradient at each point, in batches;
+                otherwise the SAGA gradient estimates stored in self.grad_sample are used,
+                whose noise inflates the discrepancy (optional)
+        approximate - use the linear time random feature approximation rather than the
+                exact discrepancy, which is quadratic in the number of points (optional)
+        chunk_size - number of points whose gradients are recomputed in each pass (optional)
+
+        Returns:
+        ksd - the kernel Stein discrepancy, see stein.py
+        """
+        sample = self.sample[::thin,:]
+        if recompute:
+            gradients = np.concatenate( [ self.full_gradients( sample[start:start+chunk_size,:] )
+                    for start in xrange(0,sample.shape[0],chunk_size) ] )
+        else:
+            gradients = self.grad_sample[::thin,:]
+        if approximate:
+            return random_feature_ksd( sample, gradients )
+        return kernel_stein_discrepancy( sample, gradients, pool = self.pool )
 
 
     def logloss(self):
         """Calculate the log loss on the test set, used to check convergence"""
-        y_pred = np.zeros(self.test_size, dtype = int)
-        for i in range(self.test_size):
-            x = np.squeeze( np.copy( self.X_test[i,:] ) )
-            y_pred[i] = int( np.dot( self.beta, x ) >= 0.0 )
-        return log_loss( self.y_test, y_pred )
+        return self.test_loss( self.beta, self.X_test, self.y_test, self.pool, self.test_weights )
 
 
     def loglossp(self,beta):
@@ -106,34 +463,75 @@ class LogisticRegression:
         Parameters:
         beta - a vector of logistic regression parameters (float array)
         """
-        y_pred = np.zeros(self.test_size, dtype = int)
-        for i in range(self.test_size):
-            x = np.squeeze( np.copy( self.X_test[i,:] ) )
-            y_pred[i] = int( np.dot( beta, x ) >= 0.0 )
-        return log_loss( self.y_test, y_pred )
+        return self.test_loss( beta, self.X_test, self.y_test, self.pool, self.test_weights )
+
+
+    def full_gradient(self,beta):
+        """
+        Calculate the full data log posterior gradient at beta, in blocks on self.pool
+
+        Parameters:
+        beta - vector of logistic regression parameters to calculate the gradient at
+        """
+        def block_gradient(X,y,weights):
+            residuals = y - 1 / ( 1 + np.exp( - np.dot( X, beta ) ) )
+            if weights is not None:
+                residuals = weights * residuals
+            return np.dot( residuals, X )
+        dlogbeta = self.pool.sum( block_gradient, self.data.weighted_blocks( self.pool.block_size ) )
+        # Add gradient of log prior (assume Laplace prior with scale 1)
+        return dlogbeta - np.sign(beta)
+
+
+    def full_gradients(self,betas):
+        """
+        Calculate the full data log posterior gradient at a batch of parameter values, in one pass
+
+        Each block of data is multiplied by every parameter vector in a single matrix product.
+
+        Parameters:
+        betas - array of shape (n, d), each row holding parameter values
+
+        Returns:
+        gradients - array of shape (n, d) holding the gradient at each row of betas
+        """
+        def block_gradients(X,y,weights):
+            residuals = y[:,np.newaxis] - 1 / ( 1 + np.exp( - np.dot( X, betas.T ) ) )
+            if weights is not None:
+                residuals *= weights[:,np.newaxis]
+            return np.dot( residuals.T, X )
+        dlogbeta = self.pool.sum( block_gradients, self.data.weighted_blocks( self.pool.block_size ) )
+        # Add gradient of log prior (assume Laplace prior with scale 1)
+        return dlogbeta - np.sign(betas)
 
 
-    def dlogdens(self,sgld,indices = None):
+    def dlogdens(self,X,y):
         """
-        Calculate gradient of the log density wrt the parameters at observations specified by indices
+        Calculate gradient of the log density wrt the parameters at each observation of a block
 
         Parameters:
-        sgld - a StochasticGradientLangevinDynamics object, used to specify the minibatch
+        X - dense block of explanatory variables
+        y - vector of response variables for the block
 
         Returns:
-        dlogbeta - gradient of the log likelihood wrt the parameter beta at observation at each index
-        """
-        if not( indices ):
-            indices = sgld.minibatch
-        sample_size = len( indices )
-        dlogbeta = np.zeros( ( sample_size, self.d ) )
-
-        # Calculate sum of gradients at each point in the minibatch
-        for i, index in enumerate(sgld.minibatch):
-            x = np.squeeze( np.copy( self.X[index,:] ) )
-            y = self.y[index]
-            # Calculate gradient of the log density at current point, use to update dlogbeta
-            # Handle overflow gracefully by catching numpy's error
-            # (seterr was defined at start of class)
-            dlogbeta[i,:] = ( y - 1 / ( 1 + np.exp( - np.dot( self.beta, x ) ) ) ) * x
-        return dlogbeta
+        dlogbeta - gradient of the log likelihood wrt the parameter beta at each observation
+        """
+        # Handle overflow gracefully by catching numpy's error
+        # (seterr was defined at start of class)
+        residuals = y - 1 / ( 1 + np.exp( - np.dot( X, self.beta ) ) )
+        return residuals[:,np.newaxis] * X
+
+
+    def dlogdens_blocks(self,X,y):
+        """
+        Calculate gradient of the log density at each observation, splitting into blocks.
+
+        Minibatches larger than the block size of self.pool are evaluated in parallel.
+
+        Parameters:
+        X - dense minibatch of explanatory variables
+        y - vector of response variables for the minibatch
+        """
+        if X.shape[0] <= self.pool.block_size:
+            return self.dlogdens(X,y)
+        return np.concatenate( self.pool.map( self.dlogdens, self.pool.split( X, y ) ) )
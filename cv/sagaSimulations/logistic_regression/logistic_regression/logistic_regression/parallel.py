@@ -0,0 +1,88 @@
+import itertools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+
+class BlockPool:
+    """
+    Evaluate a function over blocks of rows on a pool of threads.
+
+    Used for full data passes and large minibatches. The work in each block is done by
+    numpy and BLAS, which release the GIL, so blocks are evaluated in parallel. Results are
+    always combined in block order, so for a given block size the result doesn't depend on
+    the number of threads or the order in which blocks finish.
+    """
+
+    def __init__(self,n_threads=1,block_size=4096):
+        """
+        Start the thread pool.
+
+        Parameters:
+        n_threads - number of threads, None to use one per core, 1 evaluates blocks in the
+                calling thread (optional)
+        block_size - number of rows in each block (optional)
+        """
+        if n_threads is None:
+            n_threads = multiprocessing.cpu_count()
+        self.n_threads = n_threads
+        self.block_size = block_size
+        self.pool = None
+        if n_threads > 1:
+            self.pool = ThreadPool( n_threads )
+
+
+    def map(self,func,blocks):
+        """
+        Apply func to each block, returning the results in block order.
+
+        Blocks are taken from the iterable a few at a time, so blocks read from disk are
+        not all held in memory at once.
+
+        Parameters:
+        func - function called as func(*block)
+        blocks - iterable of blocks, e.g. tuples (X, y) as returned by data.blocks()
+
+        Returns:
+        results - list holding the result for each block
+        """
+        # Error handling set by np.seterr is per thread, so pass the caller's on to workers
+        errors = np.geterr()
+        def evaluate(block):
+            with np.errstate( **errors ):
+                return func( *block )
+        if self.pool is None:
+            return [ evaluate(block) for block in blocks ]
+        results = []
+        blocks = iter(blocks)
+        while True:
+            wave = list( itertools.islice( blocks, 2 * self.n_threads ) )
+            if not wave:
+                return results
+            results += self.pool.map( evaluate, wave )
+
+
+    def sum(self,func,blocks):
+        """Apply func to each block and return the sum of the results, added in block order"""
+        total = None
+        for result in self.map(func,blocks):
+            if total is None:
+                total = result
+            else:
+                total = total + result
+        return total
+
+
+    def split(self,*arrays):
+        """Split arrays with matching rows into tuples of consecutive blocks of block_size rows"""
+        n = arrays[0].shape[0]
+        for start in xrange(0,n,self.block_size):
+            yield tuple( array[start:(start+self.block_size)] for array in arrays )
+
+
+    def close(self):
+        """Stop the threads"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,53 @@
+import numpy as np
+
+
+class GradientProbe:
+    """
+    Measure the variance of a fitter's gradient estimates while it runs.
+
+    Every `every` iterations the fitter estimates the variance of its log posterior gradient
+    estimate from the per-row gradients of its current minibatch, at the parameters the
+    estimate was made at rather than those after the update. Every reference_every probes,
+    the full data log posterior gradient is also calculated at the same parameters, and the
+    squared error of the estimate is recorded.
+    The error checks the variance estimate, and also shows any bias, e.g. from control
+    variates whose mode has drifted away from the posterior.
+
+    Records are stored in lr.gradient_variance as rows [iteration, total variance,
+    squared error], with nan for the squared error when there's no reference.
+    """
+
+    def __init__(self,every=100,reference_every=10):
+        """
+        Initialise the probe.
+
+        Parameters:
+        every - number of iterations between probes (optional)
+        reference_every - number of probes between full data reference gradients, None for
+                no references (optional)
+        """
+        self.every = every
+        self.reference_every = reference_every
+        self.n_probes = 0
+
+
+    def due(self,iteration):
+        """Return True if the fitter should be probed at iteration"""
+        return iteration % self.every == 0
+
+
+    def record(self,lr,beta):
+        """
+        Probe the fitter once it has updated.
+
+        Parameters:
+        lr - LogisticRegression object being fitted
+        beta - parameter values the last gradient estimate was calculated at
+        """
+        variance = lr.fitter.estimator_variance( lr, beta )
+        error = np.nan
+        if self.reference_every is not None and self.n_probes % self.reference_every == 0:
+            reference = lr.full_gradient(beta)
+            error = np.sum( ( lr.fitter.gradient_estimate(lr) - reference )**2 )
+        self.n_probes += 1
+        lr.gradient_variance.append( [ lr.fitter.iter, np.sum(variance), error ] )
@@ -20,7 +20,7 @@ class SAGA:
                 https://projecteuclid.org/download/pdfview_1/euclid.ba/1393251772
     """
     
-    def __init__(self,lr,epsilon,minibatch_size,n_iter):
+    def __init__(self,lr,epsilon,minibatch_size,n_iter,g_alpha_i=None):
         """
         Initialize the container for SGLD
 
@@ -28,18 +28,38 @@ class SAGA:
         lr - LogisticRegression object
         epsilon - the stepsize to perform SGD at
         minibatch_size - size of the minibatch used at each iteration
-        n_iter - the number of iterations to perform
+        n_iter - the maximum number of iterations to perform, None if there's no maximum
+        g_alpha_i - table of gradients at each data point, when resuming from a checkpoint 
+                (optional)
         """
         self.epsilon = epsilon
         # Set the minibatch size
         self.minibatch_size = minibatch_size
         self.sample_minibatch(lr)
-        # Hold number of iterations so far
+        # Hold number of iterations so far, and number of per-observation gradients evaluated
         self.iter = 1
-        self.output = np.zeros( ( n_iter, lr.d ) )
+        self.grad_evals = 0
         # Hold gradients of each data point
-        self.g_alpha_i = lr.dlogdens(self,xrange(lr.N)) 
-        self.g_alpha = self.g_alpha_i.sum(axis=0)
+        if g_alpha_i is not None:
+            self.g_alpha_i = g_alpha_i
+        else:
+            lr.metrics.tic('full_post')
+            self.g_alpha_i = np.concatenate( lr.pool.map( lr.dlogdens, 
+                    lr.data.blocks( lr.pool.block_size ) ) )
+            lr.metrics.toc('full_post')
+            self.grad_evals += lr.N
+            lr.metrics.count( 'grad_evals', lr.N )
+            lr.metrics.count( 'rows', lr.N )
+        # Row weights of the likelihood, the stored gradients are summed using them
+        self.row_weights = lr.data.row_weights
+        if self.row_weights is None:
+            self.g_alpha = self.g_alpha_i.sum(axis=0)
+        else:
+            self.g_alpha = np.dot( self.row_weights, self.g_alpha_i )
+        # Rows of g_alpha_i changed since the last checkpoint
+        self.changed = np.zeros( lr.N, dtype = bool )
+        if g_alpha_i is None:
+            self.changed[:] = True
 
 
     def update(self,lr):
@@ -53,22 +73,47 @@ class SAGA:
         lr.beta - updates parameter values using SGLD
         lr.grad_sample - adds calculated gradient to storage
         """
+        lr.metrics.tic('minibatch')
         self.sample_minibatch(lr)
+        lr.metrics.toc('minibatch')
         # Calculate gradients of log density at current point and minibatch
-        dlogdensgrads_beta = lr.dlogdens(self)
-        # Calculate old and new log likelihood gradient estimates
-        loglikgradest_beta = dlogdensgrads_beta.sum(axis=0)
-        loglikgradest_alpha = self.g_alpha_i[self.minibatch,:].sum(axis=0)
+        lr.metrics.tic('gradient')
+        dlogdensgrads_beta = lr.dlogdens_blocks(self.X_batch,self.y_batch)
+        dlogdensgrads_alpha = self.g_alpha_i[self.minibatch,:]
+        # Keep the per-row gradients of the minibatch, used by estimator_variance
+        self.last_grads = ( dlogdensgrads_beta, dlogdensgrads_alpha )
+        # Calculate old and new log likelihood gradient estimates, weighted if minibatches 
+        # aren't drawn uniformly
+        if self.w_batch is None:
+            loglikgradest_beta = dlogdensgrads_beta.sum(axis=0)
+            loglikgradest_alpha = dlogdensgrads_alpha.sum(axis=0)
+        else:
+            loglikgradest_beta = np.dot( self.w_batch, dlogdensgrads_beta )
+            loglikgradest_alpha = np.dot( self.w_batch, dlogdensgrads_alpha )
         # Calculate SAGA estimate of log posterior gradient
         dlogbeta = self.dlogpostest(lr,loglikgradest_alpha,loglikgradest_beta)
-
-        # Update g_alpha
-        self.g_alpha += loglikgradest_beta - loglikgradest_alpha
-        self.g_alpha_i[self.minibatch,:] = dlogdensgrads_beta
+        self.dlogbeta = dlogbeta
+        lr.grad_sample[self.iter-1,:] = dlogbeta
+        lr.metrics.toc('gradient')
+        self.grad_evals += self.minibatch_size
+        lr.metrics.count( 'grad_evals', self.minibatch_size )
+        lr.metrics.count( 'rows', self.minibatch_size )
+
+        # Update g_alpha, counting rows drawn more than once a single time
+        lr.metrics.tic('update')
+        rows, first = np.unique( self.minibatch, return_index = True )
+        changes = dlogdensgrads_beta[first,:] - dlogdensgrads_alpha[first,:]
+        if self.row_weights is None:
+            self.g_alpha += changes.sum(axis=0)
+        else:
+            self.g_alpha += np.dot( self.row_weights[rows], changes )
+        self.g_alpha_i[rows,:] = dlogdensgrads_beta[first,:]
+        self.changed[rows] = True
 
         # Update parameters using SGLD
         eta = np.random.normal( size = lr.d, scale = self.epsilon )
         lr.beta += self.epsilon / 2 * dlogbeta + eta
+        lr.metrics.toc('update')
 
 
     def dlogpostest(self,lr,loglikgrad_alpha,loglikgrad_beta):
@@ -88,6 +133,81 @@ class SAGA:
         return dlogpostest_saga
 
 
+    def estimator_variance(self,lr,beta=None):
+        """
+        Estimate the variance of each coordinate of the gradient estimate from the last update
+
+        Uses the per-row gradients of the minibatch and their stored values, already 
+        calculated by the update at the parameters before it moved lr.beta, so beta, the
+        parameters the other fitters take, isn't needed.
+        """
+        dlogdensgrads_beta, dlogdensgrads_alpha = self.last_grads
+        contributions = dlogdensgrads_beta - dlogdensgrads_alpha
+        if self.w_batch is not None:
+            contributions = self.w_batch[:,np.newaxis] * contributions
+        return lr.N**2 / float( self.minibatch_size ) * contributions.var( axis = 0, ddof = 1 )
+
+
+    def gradient_estimate(self,lr):
+        """Return the log posterior gradient estimate used by the last update"""
+        return self.dlogbeta
+
+
+    def injected_variance(self):
+        """Return the variance of the noise injected into each coordinate at every update"""
+        return self.epsilon**2
+
+
+    def checkpoint_state(self):
+        """Return the state of the fitter, used by Checkpointer"""
+        return { 'epsilon' : self.epsilon, 'minibatch_size' : self.minibatch_size, 
+                'iter' : self.iter, 'grad_evals' : self.grad_evals, 'g_alpha' : self.g_alpha }
+
+
+    def checkpoint_tables(self):
+        """Return the gradient table and the rows changed since the last checkpoint"""
+        return { 'g_alpha_i' : ( self.g_alpha_i, np.flatnonzero( self.changed ) ) }
+
+
+    def clear_changes(self):
+        """Mark the gradient table as checkpointed"""
+        self.changed[:] = False
+
+
+    def restore_state(self,state):
+        """Restore the state of the fitter from a checkpoint"""
+        self.iter = int( state['iter'] )
+        self.grad_evals = int( state['grad_evals'] )
+        self.g_alpha = state['g_alpha']
+
+
+    def append(self,lr,X,y,weights=None):
+        """
+        Add the gradients of rows appended to the training data to the gradient tables.
+
+        New rows get their gradient at the current point, as if they had just been sampled.
+
+        Parameters:
+        lr - LogisticRegression object, with lr.N already updated
+        X - dense block holding the new rows
+        y - vector of responses of the new rows
+        weights - row weights of the new rows, None if rows are unweighted (optional)
+        """
+        new_grads = lr.dlogdens_blocks(X,y)
+        self.g_alpha_i = np.concatenate( ( self.g_alpha_i, new_grads ) )
+        self.row_weights = lr.data.row_weights
+        if weights is None:
+            self.g_alpha += new_grads.sum(axis=0)
+        else:
+            self.g_alpha += np.dot( weights, new_grads )
+        self.changed = np.concatenate( ( self.changed, np.ones( len(y), dtype = bool ) ) )
+        self.grad_evals += len(y)
+        lr.metrics.count( 'grad_evals', len(y) )
+
+
     def sample_minibatch(self,lr):
-        """Sample the next minibatch"""
-        self.minibatch = np.random.choice( np.arange( lr.N ), self.minibatch_size, replace = False )
+        """Sample the next minibatch and gather its rows and weights from the data source"""
+        self.minibatch, self.X_batch, self.y_batch = lr.data.minibatch( self.minibatch_size )
+        self.w_batch = None
+        if lr.data.weights is not None:
+            self.w_batch = lr.data.weights[self.minibatch]
@@ -9,6 +9,8 @@ import bz2
 from sklearn.datasets import load_svmlight_file
 from sklearn.model_selection import train_test_split
 from ..logistic_regression.logistic_regression import LogisticRegression
+from ..logistic_regression.checkpoint import Checkpointer
+from ..logistic_regression.results import ResultStore
 
 
 class CoverType:
@@ -47,18 +49,24 @@ class CoverType:
         self.y_test = self.y_test[:test_size]
 
 
-    def fit(self,stepsize):
+    def fit(self,stepsize,checkpointer=None,stopping=None):
         """
         Fit a Bayesian logistic regression model to the data using the LogisticRegression class.
 
         Parameters:
         stepsize - stepsize parameter for the stochastic gradient langevin dynamics
+        checkpointer - Checkpointer object, the fit is resumed if a checkpoint exists (optional)
+        stopping - StoppingRule object used to end the fit before 2*10**4 iterations (optional)
 
         Returns:
         lr - fitted LogisticRegression object
         """
         self.lr = LogisticRegression( self.X_train, self.X_test, self.y_train, self.y_test )
-        self.lr.fit(stepsize, n_iters = 2*10**4)
+        # Continue from the last checkpoint if the job was interrupted
+        if checkpointer is not None and os.path.exists( checkpointer.path ):
+            self.lr.resume(checkpointer,stopping=stopping)
+            return
+        self.lr.fit(stepsize, n_iters = 2*10**4, checkpointer = checkpointer, stopping = stopping)
 
 
     def download_data(self):
@@ -102,10 +110,16 @@ class CoverType:
         test_size = int( n_obs * self.X_test.shape[0] )
         self.truncate( train_size, test_size )
         random.seed(seed_current)
-        self.fit(stepsize)
         if not os.path.exists( self.data_dir + outdir + '/{0}/'.format(n_obs) ):
             os.makedirs( self.data_dir + outdir + '/{0}/'.format(n_obs) )
-        np.savetxt( self.data_dir + outdir + '/{0}/{1}.dat'.format(n_obs,seed_current), np.array( self.lr.training_loss ) )
+        checkpointer = Checkpointer( self.data_dir + outdir + '/{0}/checkpoint-{1}.npz'.format(
+                n_obs, seed_current ) )
+        self.fit(stepsize,checkpointer)
+        store = ResultStore( self.data_dir + outdir + '/results' )
+        store.append( method = 'saga', stepsize = stepsize, seed = seed_current, n_obs = n_obs, 
+                N = train_size, sampling_time = self.lr.sampling_time, 
+                training_loss = self.lr.training_loss )
+        self.lr.close()
 
 
 if __name__ == '__main__':
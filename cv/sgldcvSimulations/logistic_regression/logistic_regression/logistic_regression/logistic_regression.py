@@ -1,4 +1,5 @@
 import numpy as np
+from metrics import Metrics
 from stopwatch import Stopwatch
 from zvsgld import ZVSGLD
 from sklearn.metrics import log_loss
@@ -52,9 +53,13 @@ class LogisticRegression:
         self.training_loss = []
         self.n_iters = None
         self.fitter = None
+        # MinibatchSchedule adapting the minibatch size of the current fit
+        self.schedule = None
+        # Counts minibatch resizes, disabled unless passed to fit
+        self.metrics = Metrics( enabled = False )
 
 
-    def fit(self,stepsize,n_iters=10**4,minibatch_size=500):
+    def fit(self,stepsize,n_iters=10**4,minibatch_size=500,schedule=None,metrics=None):
         """
         Fit Bayesian logistic regression model using train and test set.
 
@@ -64,6 +69,9 @@ class LogisticRegression:
         stepsize - stepsize to use in stochastic gradient descent
         n_iters - number of iterations of stochastic gradient descent (optional)
         minibatch_size - minibatch size in stochastic gradient descent (optional)
+        schedule - MinibatchSchedule object used to adapt the minibatch size to the 
+                gradient noise, starting from minibatch_size (optional)
+        metrics - Metrics object counting the minibatch resizes (optional)
         """
         # Holds log loss values once fitted
         self.training_loss = []
@@ -74,6 +82,8 @@ class LogisticRegression:
         self.sample = np.zeros( ( self.n_iters, self.d ) )
         self.grad_sample = np.zeros( ( self.n_iters, self.d ) )
 
+        self.schedule = schedule
+        self.metrics = metrics if metrics is not None else Metrics( enabled = False )
         self.fitter = ZVSGLD(self,stepsize,minibatch_size,n_iters)
         print "Running MCMC..."
         print "{0}\t{1}".format( "iteration", "Test log loss" )
@@ -86,7 +96,12 @@ class LogisticRegression:
                 self.training_loss.append( [current_loss,elapsed_time] )
                 print "{0}\t\t{1}".format( self.fitter.iter, current_loss )
                 timer.tic()
+            # Parameters the update's gradient estimate is calculated at, for the schedule
+            if self.schedule is not None:
+                beta = self.beta.copy()
             self.fitter.update(self)
+            if self.schedule is not None and self.fitter.iter % self.schedule.every == 0:
+                self.schedule.update( self, beta )
             self.sample[(self.fitter.iter-1),:] = self.beta
 
 
@@ -133,11 +148,31 @@ class LogisticRegression:
             # (seterr was defined at start of class)
             dlogbeta += ( y - 1 / ( 1 + np.exp( - np.dot( self.beta, x ) ) ) ) * x
         # Adjust log density gradients so they're unbiased
-        dlogbeta *= self.N / sgld.minibatch_size
+        dlogbeta *= float( self.N ) / sgld.minibatch_size
         # Add gradient of log prior (assume Laplace prior with scale 1)
         dlogbeta -= np.sign(self.beta)
         return dlogbeta
 
 
+    def row_variance(self,beta,X,y):
+        """
+        Estimate the variance of each coordinate of the log likelihood gradient of a single row.
+
+        A minibatch estimate of the log likelihood gradient is N / m times the sum of the 
+        gradients of m rows, so its variance is N^2 / m times the row variance.
+
+        Parameters:
+        beta - vector of logistic regression parameters to calculate the gradients at
+        X - dense minibatch of explanatory variables
+        y - vector of response variables for the minibatch
+
+        Returns:
+        variance - vector holding the variance of each coordinate over the rows
+        """
+        residuals = np.asarray(y).ravel() - 1 / ( 1 + np.exp( - np.dot( X, beta ) ) )
+        contributions = residuals[:,np.newaxis] * X
+        return contributions.var( axis = 0, ddof = 1 )
+
+
     def postprocess(self):
         return self.fitter.control_variates(self)
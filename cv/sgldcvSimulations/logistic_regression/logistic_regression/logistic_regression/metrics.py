@@ -0,0 +1,97 @@
+import json
+import resource
+from timeit import default_timer
+
+
+class Metrics:
+    """
+    Per-phase timers, counters and progress records for a fitting run.
+
+    Timers accumulate the time spent in each named phase (e.g. minibatch, gradient, update,
+    storage, evaluation) between calls to emit(), counters accumulate over the whole run.
+    Each call to emit() produces a record which is kept in self.records and, if a stream
+    is given, written to it as a JSON line. When disabled tic, toc and count return
+    immediately, so instrumented code only pays for a method call.
+    """
+
+    def __init__(self,enabled=True,stream=None,memory=False):
+        """
+        Initialise the metrics container.
+
+        Parameters:
+        enabled - whether timers and counters are recorded (optional)
+        stream - file-like object records are written to as JSON lines (optional)
+        memory - whether to add the peak resident memory to each record (optional)
+        """
+        self.enabled = enabled
+        self.stream = stream
+        self.memory = memory
+        # Records emitted so far
+        self.records = []
+        # Phase timings since the last record, and for the whole run
+        self.timers = {}
+        self.total_timers = {}
+        self.counters = {}
+        self.started = {}
+
+
+    def tic(self,phase):
+        """Start timing phase"""
+        if not self.enabled:
+            return
+        self.started[phase] = default_timer()
+
+
+    def toc(self,phase):
+        """Stop timing phase and add elapsed time to its timer"""
+        if not self.enabled:
+            return
+        elapsed = default_timer() - self.started[phase]
+        self.timers[phase] = self.timers.get( phase, 0.0 ) + elapsed
+        self.total_timers[phase] = self.total_timers.get( phase, 0.0 ) + elapsed
+
+
+    def count(self,name,n=1):
+        """Increment counter name by n"""
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get( name, 0 ) + n
+
+
+    def emit(self,iteration,**values):
+        """
+        Store a progress record and write it to the stream if one is set.
+
+        Parameters:
+        iteration - current iteration of the fitter
+        values - further named values to add to the record e.g. the test log loss
+
+        Returns:
+        record - dictionary holding the record
+        """
+        record = { 'iteration' : iteration }
+        record.update( values )
+        if self.enabled:
+            record['timers'] = self.timers
+            record['counters'] = dict( self.counters )
+            self.timers = {}
+            if self.memory:
+                record['peak_memory'] = peak_memory()
+        self.records.append( record )
+        if self.stream is not None:
+            self.stream.write( json.dumps( record ) + "\n" )
+            self.stream.flush()
+        return record
+
+
+    def summary(self):
+        """Return timings and counters accumulated over the whole run"""
+        summary = { 'timers' : dict( self.total_timers ), 'counters' : dict( self.counters ) }
+        if self.memory:
+            summary['peak_memory'] = peak_memory()
+        return summary
+
+
+def peak_memory():
+    """Return the peak resident memory of the process (kilobytes on Linux)"""
+    return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
@@ -0,0 +1,78 @@
+import numpy as np
+
+
+class MinibatchSchedule:
+    """
+    Adapt the minibatch size during fitting using online estimates of the gradient noise.
+
+    Every few iterations the fitter estimates the variance of its minibatch gradient estimate
+    from the rows of the current minibatch. The per-row variance s^2, averaged over
+    coordinates, is smoothed by an exponential moving average. With stepsize epsilon, the
+    gradient noise enters each update with variance epsilon^2 / 4 * N^2 s^2 / m, so the ratio
+    of injected noise to gradient noise is proportional to m; for SGLD it is 4 m / ( epsilon N^2 s^2 ).
+    Whenever the ratio leaves the band [target_ratio / band, target_ratio * band], the
+    minibatch size is set so the ratio is back at target_ratio, within [min_size, max_size].
+    With BlockData every size is rounded to a multiple of its n_blocks, since each minibatch
+    is made of n_blocks chunks of equal size.
+
+    With control variates s^2 is small near the mode, so minibatches can be much smaller.
+    """
+
+    def __init__(self,target_ratio=10.0,band=2.0,min_size=10,max_size=5000,every=10,
+            smoothing=0.2):
+        """
+        Initialise the schedule.
+
+        Parameters:
+        target_ratio - target ratio of injected noise variance to gradient noise variance (optional)
+        band - the minibatch size is changed when the ratio is off target by more than this factor (optional)
+        min_size - smallest minibatch size (optional)
+        max_size - largest minibatch size, the compute budget of each iteration (optional)
+        every - number of iterations between estimates of the gradient noise (optional)
+        smoothing - weight of the newest estimate in the moving average (optional)
+        """
+        self.target_ratio = target_ratio
+        self.band = band
+        self.min_size = min_size
+        self.max_size = max_size
+        self.every = every
+        self.smoothing = smoothing
+        # Smoothed per-row gradient variance, averaged over coordinates
+        self.row_variance = None
+        self.ratio = None
+
+
+    def update(self,lr,beta=None):
+        """
+        Estimate the gradient noise at the current minibatch and adapt the minibatch size.
+
+        Parameters:
+        lr - LogisticRegression object being fitted
+        beta - parameter values the last gradient estimate was calculated at, by default
+                lr.beta (optional)
+
+        Modifies:
+        lr.fitter.minibatch_size - used from the next iteration
+        """
+        fitter = lr.fitter
+        m = fitter.minibatch_size
+        row_variance = np.mean( fitter.estimator_variance( lr, beta ) ) * m / float( lr.N )**2
+        if self.row_variance is None:
+            self.row_variance = row_variance
+        else:
+            self.row_variance += self.smoothing * ( row_variance - self.row_variance )
+        # Variance the gradient noise adds to each update, per row of the minibatch
+        update_variance = ( fitter.epsilon / 2.0 )**2 * lr.N**2 * self.row_variance
+        if update_variance <= 0:
+            return
+        self.ratio = fitter.injected_variance() * m / update_variance
+        if self.ratio < self.target_ratio / self.band or self.ratio > self.target_ratio * self.band:
+            size = self.target_ratio * update_variance / fitter.injected_variance()
+            # Round to whole chunks, keeping the bounds on whole chunks too; objects holding
+            # their data as arrays rather than a data source have no chunks
+            step = getattr( getattr( lr, 'data', None ), 'n_blocks', 1 )
+            min_size = step * int( np.ceil( self.min_size / float( step ) ) )
+            max_size = max( step * ( min( self.max_size, lr.N ) // step ), min_size )
+            fitter.minibatch_size = int( np.clip( step * np.ceil( size / step ), min_size,
+                    max_size ) )
+            lr.metrics.count( 'minibatch_resizes' )
@@ -61,6 +61,27 @@ class ZVSGLD:
         lr.beta += self.epsilon / 2 * dlogbeta + eta
 
 
+    def estimator_variance(self,lr,beta=None):
+        """
+        Estimate the variance of each coordinate of the gradient estimate from the current minibatch
+
+        Parameters:
+        lr - LogisticRegression object being fitted
+        beta - parameter values the last gradient estimate was calculated at, before the
+                update moved lr.beta; lr.beta by default (optional)
+        """
+        if beta is None:
+            beta = lr.beta
+        X = np.asarray( lr.X[self.minibatch] )
+        return lr.N**2 / float( self.minibatch_size ) * lr.row_variance( beta, X, 
+                lr.y[self.minibatch] )
+
+
+    def injected_variance(self):
+        """Return the variance of the noise injected into each coordinate at every update"""
+        return self.epsilon
+
+
     def sample_minibatch(self,lr):
         """Sample the next minibatch"""
         self.minibatch = np.random.choice( np.arange( lr.N ), self.minibatch_size, replace = False )
@@ -7,6 +7,8 @@ import bz2
 from sklearn.datasets import load_svmlight_file
 from sklearn.model_selection import train_test_split
 from ..logistic_regression.logistic_regression import LogisticRegression
+from ..logistic_regression.results import ResultStore
+from ..logistic_regression.stopwatch import Stopwatch
 
 
 class CoverType:
@@ -58,13 +60,17 @@ class CoverType:
         """
         N = self.X_train.shape[0]
         self.lr = LogisticRegression( self.X_train, self.X_test, self.y_train, self.y_test )
+        stopwatch = Stopwatch()
         self.lr.fit_sgd(stepsize, n_iters = 10**3)
+        fit_time = stopwatch.toc()
         # Save mode to file
         if not os.path.exists( self.data_dir + 'cover_type_mode/{0}'.format(N) ):
             os.makedirs( self.data_dir + 'cover_type_mode/{0}'.format(N) )
         print "Saving file to path: {0}cover_type_mode/{1}/{2}.npy".format( self.data_dir, N, stepsize )
         np.save( "{0}cover_type_mode/{1}/{2}.npy".format( self.data_dir, N, stepsize ), self.lr.beta )
-        np.savetxt( "{0}cover_type_mode/{1}/log_loss-{2}.log".format( self.data_dir, N, stepsize ), np.array( self.lr.training_loss ) )
+        store = ResultStore( self.data_dir + 'cover_type_mode/results' )
+        store.append( method = 'sgd', stepsize = stepsize, N = N, fit_time = fit_time, 
+                training_loss = self.lr.training_loss )
 
 
     def download_data(self):
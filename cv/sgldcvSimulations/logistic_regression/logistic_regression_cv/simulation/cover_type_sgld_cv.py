@@ -8,6 +8,8 @@ import bz2
 from sklearn.datasets import load_svmlight_file
 from sklearn.model_selection import train_test_split
 from ..logistic_regression.logistic_regression import LogisticRegression
+from ..logistic_regression.results import ResultStore
+from ..logistic_regression.stopwatch import Stopwatch
 
 
 class CoverType:
@@ -96,10 +98,12 @@ class CoverType:
         test_size = int( n_obs * self.X_test.shape[0] )
         self.truncate( train_size, test_size )
         random.seed(seed_current)
+        stopwatch = Stopwatch()
         self.fit(stepsize,sgd_step)
-        if not os.path.exists( self.data_dir + outdir + '/{0}/'.format(n_obs) ):
-            os.makedirs( self.data_dir + outdir + '/{0}/'.format(n_obs) )
-        np.savetxt( self.data_dir + outdir + '/{0}/{1}.dat'.format(n_obs,seed_current), np.array( self.lr.training_loss ) )
+        fit_time = stopwatch.toc()
+        store = ResultStore( self.data_dir + outdir + '/results' )
+        store.append( method = 'sgld_cv', stepsize = stepsize, seed = seed_current, n_obs = n_obs, 
+                N = train_size, fit_time = fit_time, training_loss = self.lr.training_loss )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,132 @@
+"""
+Zero variance postprocessing of many chains at once, e.g. every seed and stepsize of a sweep.
+
+LogisticRegression.postprocess corrects one chain, fitting its own covariance and scoring
+the test set one iteration at a time. Here chains are corrected in parallel on a pool of
+threads (the work is done by numpy and BLAS, which release the GIL), the test set scores
+of every scored iteration of a chain are calculated with one matrix product per chunk of
+test points, and the results are gathered into a single set of arrays. Chains targeting
+the same posterior can optionally share one covariance estimate pooled across them, which
+is factorized once rather than once per chain. Test log losses are for binary logistic
+regression.
+"""
+import os
+import numpy as np
+import scipy.sparse as sp
+from sklearn.metrics import log_loss
+from checkpoint import Checkpointer
+from parallel import BlockPool
+from zero_variance import ZeroVariance, pooled_factor, variance_reduction
+
+
+def load_chain(chain):
+    """
+    Return the sample and gradients of a chain as a pair of arrays of shape (n_iters, d).
+
+    Parameters:
+    chain - a fitted LogisticRegression object, a tuple (sample, grad_sample), or the path
+            of a Checkpointer file, whose tables are truncated to the completed iterations
+    """
+    if isinstance( chain, basestring ):
+        state, tables = Checkpointer( chain ).load()
+        completed = int( state['iter'] )
+        return tables['sample'][:completed,:], tables['grad_sample'][:completed,:]
+    if isinstance( chain, tuple ):
+        return chain
+    return chain.sample, chain.grad_sample
+
+
+def test_loglosses(betas,X_test,y_test,weights=None,chunk_size=1000):
+    """
+    Calculate the test log loss at each row of betas, with one pass over the test set.
+
+    The loss is the same as test_logloss, the log loss of the hard 0/1 predictions, so
+    results can be compared with LogisticRegression.postprocess.
+
+    Parameters:
+    betas - array of shape (n, d), each row holding parameter values
+    X_test - matrix of explanatory variables for testing
+    y_test - vector of responses for testing
+    weights - weight of each test point (optional)
+    chunk_size - number of test points processed at a time (optional)
+
+    Returns:
+    loglosses - vector holding the test log loss at each row of betas
+    """
+    y_test = np.asarray( y_test ).ravel()
+    m = X_test.shape[0]
+    y_pred = np.zeros( ( betas.shape[0], m ), dtype = int )
+    for start in xrange(0,m,chunk_size):
+        X_chunk = X_test[start:start+chunk_size]
+        if sp.issparse(X_chunk):
+            X_chunk = X_chunk.toarray()
+        scores = np.dot( betas, np.asarray(X_chunk).T )
+        y_pred[:,start:start+chunk_size] = scores >= 0.0
+    return np.array( [ log_loss( y_test, predictions, sample_weight = weights )
+            for predictions in y_pred ] )
+
+
+def batch_postprocess(chains,X_test,y_test,degree=1,pooled=False,n_threads=None,
+        sample_size=20,test_weights=None,path=None,**labels):
+    """
+    Apply zero variance control variates to a batch of chains and score them on the test set.
+
+    Parameters:
+    chains - list of chains in any form accepted by load_chain, all with the same d
+    X_test - matrix of explanatory variables for testing
+    y_test - vector of responses for testing
+    degree - degree of the polynomial control variates, 1 or 2 (optional)
+    pooled - share a single control variate covariance, estimated from every chain (optional)
+    n_threads - number of chains corrected at once, None to use one per core (optional)
+    sample_size - number of random iterations of each chain scored on the test set (optional)
+    test_weights - weight of each test point in the test log loss (optional)
+    path - write the results to this .npz file, atomically replacing it (optional)
+    labels - vectors with an entry for each chain stored with the results, e.g.
+            stepsize = [...], seed = [...] (optional)
+
+    Returns:
+    results - dict of arrays with a row for each chain: llold and llnew, the test log
+            loss at sample_size random iterations before and after correction, mean_old and
+            mean_new, the posterior mean estimates, and reduction, the variance reduction of
+            each coordinate; plus the labels
+    """
+    chains = [ load_chain( chain ) for chain in chains ]
+    factor = None
+    feature_means = [ None ] * len( chains )
+    if pooled:
+        factor, feature_means = pooled_factor( [ grad_sample for sample, grad_sample in chains ],
+                [ sample for sample, grad_sample in chains ], degree )
+    # Draw the scored iterations up front, so results don't depend on the number of threads
+    random_points = [ np.random.choice( range( len(sample) ), sample_size )
+            for sample, grad_sample in chains ]
+    def correct_chain(index):
+        sample, grad_sample = chains[index]
+        new_sample = ZeroVariance( grad_sample, sample, degree, factor = factor,
+                feature_mean = feature_means[index] ).correct( sample )
+        points = random_points[index]
+        betas = np.concatenate( ( sample[points,:], new_sample[points,:] ) )
+        loglosses = test_loglosses( betas, X_test, y_test, test_weights )
+        return ( loglosses[:sample_size], loglosses[sample_size:], sample.mean( axis = 0 ),
+                new_sample.mean( axis = 0 ), variance_reduction( sample, new_sample ) )
+    pool = BlockPool( n_threads )
+    try:
+        per_chain = pool.map( correct_chain, [ ( index, ) for index in range( len(chains) ) ] )
+    finally:
+        pool.close()
+    keys = [ 'llold', 'llnew', 'mean_old', 'mean_new', 'reduction' ]
+    results = dict( ( key, np.array( values ) ) for key, values in zip( keys, zip( *per_chain ) ) )
+    for key, values in labels.items():
+        results[key] = np.asarray( values )
+    if path is not None:
+        write_results( path, results )
+    return results
+
+
+def write_results(path,results):
+    """Atomically replace the .npz file at path with the arrays in results"""
+    temp_path = path + '.tmp'
+    with open( temp_path, 'wb' ) as out:
+        np.savez( out, **results )
+        out.flush()
+        os.fsync( out.fileno() )
+    os.rename( temp_path, path )
@@ -0,0 +1,142 @@
+import os
+import numpy as np
+
+
+class Checkpointer:
+    """
+    Periodic, atomic checkpoints of a LogisticRegression fit, so the chain can be resumed.
+
+    The small part of the state (parameters, RNG state, fitter settings, log loss values)
+    is written to a single .npz file which atomically replaces the previous checkpoint.
+    Large arrays which only change a few rows between checkpoints (the stored chain,
+    gradient tables held by the fitter, the shuffle of BlockData) are kept in .npy files
+    next to it. The rows changed
+    since the last checkpoint are stored in the .npz as a journal, then copied into the
+    memory-mapped .npy files once the .npz is in place, so a job killed at any point
+    leaves the last complete checkpoint recoverable.
+    """
+
+    def __init__(self,path,every=1000):
+        """
+        Initialise the checkpointer.
+
+        Parameters:
+        path - path of the checkpoint file, tables are stored alongside with extra suffixes
+        every - number of iterations between checkpoints (optional)
+        """
+        self.path = path
+        self.every = every
+        # Iteration of the last checkpoint written or loaded, None before the first one
+        self.last_iter = None
+
+
+    def table_path(self,name):
+        """Return the path of the file storing table name"""
+        return "{0}.{1}.npy".format( self.path, name )
+
+
+    def save(self,lr):
+        """
+        Write a checkpoint of a LogisticRegression object part way through fitting.
+
+        Parameters:
+        lr - LogisticRegression object, lr.fitter.iter iterations have been completed
+        """
+        state = lr.checkpoint_state()
+        state.update( lr.fitter.checkpoint_state() )
+        state['fitter'] = lr.fitter.__class__.__name__
+        rng = np.random.get_state()
+        state['rng_keys'] = rng[1]
+        state['rng_pos'] = rng[2]
+        state['rng_has_gauss'] = rng[3]
+        state['rng_cached_gaussian'] = rng[4]
+        # Tables are the chain plus any held by the fitter or the data source, with the rows
+        # changed since last time
+        current = lr.fitter.iter
+        tables = {}
+        for name in ['sample', 'grad_sample']:
+            start = 0 if self.last_iter is None else self.last_iter
+            tables[name] = ( getattr( lr, name ), np.arange( start, current ) )
+        if hasattr( lr.fitter, 'checkpoint_tables' ):
+            tables.update( lr.fitter.checkpoint_tables() )
+        if hasattr( lr.data, 'checkpoint_tables' ):
+            tables.update( lr.data.checkpoint_tables() )
+        state['tables'] = np.array( sorted( tables.keys() ) )
+        journalled = []
+        for name, ( table, rows ) in tables.items():
+            if self.last_iter is None or self.stored_shape( name ) != table.shape:
+                # Write tables in full the first time or once they have grown, 
+                # before any checkpoint refers to them
+                self.write_table( name, table )
+            else:
+                state['journal_rows_' + name] = rows
+                state['journal_values_' + name] = table[rows]
+                journalled.append( name )
+        self.write_state( state )
+        for name in journalled:
+            table, rows = tables[name]
+            self.apply_journal( name, rows, table[rows] )
+        if hasattr( lr.fitter, 'checkpoint_tables' ):
+            lr.fitter.clear_changes()
+        self.last_iter = current
+
+
+    def load(self):
+        """
+        Load the last checkpoint, applying any journal to the stored tables.
+
+        Returns:
+        state - dictionary of the stored state, with the RNG state under key 'rng'
+        tables - dictionary of tables loaded into memory
+        """
+        with open( self.path, 'rb' ) as checkpoint:
+            stored = np.load( checkpoint )
+            state = dict( ( key, stored[key] ) for key in stored.files )
+        tables = {}
+        for name in state.pop('tables'):
+            name = str( name )
+            if 'journal_rows_' + name in state:
+                self.apply_journal( name, state.pop( 'journal_rows_' + name ), 
+                        state.pop( 'journal_values_' + name ) )
+            tables[name] = np.load( self.table_path( name ) )
+        state['rng'] = ( 'MT19937', state.pop('rng_keys'), int( state.pop('rng_pos') ),
+                int( state.pop('rng_has_gauss') ), float( state.pop('rng_cached_gaussian') ) )
+        self.last_iter = int( state['iter'] )
+        return state, tables
+
+
+    def stored_shape(self,name):
+        """Return the shape of the stored table name, None if it hasn't been written"""
+        if not os.path.exists( self.table_path( name ) ):
+            return None
+        return np.load( self.table_path( name ), mmap_mode = 'r' ).shape
+
+
+    def write_state(self,state):
+        """Atomically replace the checkpoint file with state"""
+        temp_path = self.path + '.tmp'
+        with open( temp_path, 'wb' ) as out:
+            np.savez( out, **state )
+            out.flush()
+            os.fsync( out.fileno() )
+        os.rename( temp_path, self.path )
+
+
+    def write_table(self,name,table):
+        """Atomically replace the file storing table name with a full copy of table"""
+        temp_path = self.table_path( name ) + '.tmp'
+        with open( temp_path, 'wb' ) as out:
+            np.save( out, table )
+            out.flush()
+            os.fsync( out.fileno() )
+        os.rename( temp_path, self.table_path( name ) )
+
+
+    def apply_journal(self,name,rows,values):
+        """Write changed rows into the memory-mapped file storing table name"""
+        if len( rows ) == 0:
+            return
+        table = np.load( self.table_path( name ), mmap_mode = 'r+' )
+        table[rows] = values
+        table.flush()
+        del table
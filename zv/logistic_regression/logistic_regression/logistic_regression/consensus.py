@@ -0,0 +1,158 @@
+import multiprocessing
+import numpy as np
+import scipy.sparse as sp
+from evaluator import test_logloss
+from logistic_regression import LogisticRegression
+from metrics import Metrics
+
+
+class ConsensusSampler:
+    """
+    Divide and conquer posterior sampling for logistic regression.
+
+    The training data is split at random into n_shards shards, and an independent chain is
+    run on each shard's subposterior, the shard likelihood times the prior raised to the power
+    1 / n_shards, so the product of the subposteriors is the full posterior. Chains are fitted
+    with SGLD with control variates in a process pool, without any communication between them,
+    and their samples are combined with consensus Monte Carlo or a Gaussian product.
+    The chains don't evaluate the test set while they run, only the combined sample is scored.
+
+    References:
+        1. Consensus Monte Carlo - https://research.google.com/pubs/archive/41849.pdf
+    """
+
+    def __init__(self,X_train,X_test,y_train,y_test,n_shards,n_processes=None):
+        """
+        Split the training data into shards.
+
+        Parameters:
+        X_train - matrix of explanatory variables for training (dense or sparse)
+        X_test - matrix of explanatory variables for testing
+        y_train - vector of response variables for training
+        y_test - vector of response variables for testing
+        n_shards - number of shards, each fitted by an independent chain
+        n_processes - number of worker processes, by default one per core (optional)
+        """
+        if not sp.issparse(X_train):
+            X_train = np.asarray(X_train)
+        y_train = np.asarray(y_train).ravel()
+        self.X_test = X_test
+        self.y_test = y_test
+        self.n_shards = n_shards
+        self.n_processes = n_processes
+        permutation = np.random.permutation( X_train.shape[0] )
+        self.shards = [ ( X_train[indices], y_train[indices] )
+                for indices in np.array_split( permutation, n_shards ) ]
+        # Samples from each subposterior once fitted
+        self.subposteriors = None
+
+
+    def fit(self,stepsize,beta_mode,n_iters=10**4,minibatch_size=500):
+        """
+        Fit a chain to each subposterior in parallel.
+
+        Every chain uses beta_mode as its starting point and control variate point; the
+        full data mode is a reasonable point for each subposterior as long as shards are large.
+
+        Parameters:
+        stepsize - stepsize used by every chain
+        beta_mode - parameter values at the mode of the full posterior
+        n_iters - number of iterations of each chain (optional)
+        minibatch_size - minibatch size used by each chain, within its shard (optional)
+        """
+        seeds = np.random.randint( 2**31, size = self.n_shards )
+        tasks = [ ( X, y, self.n_shards, stepsize, beta_mode, n_iters, minibatch_size, seed )
+                for ( X, y ), seed in zip( self.shards, seeds ) ]
+        pool = multiprocessing.Pool( self.n_processes )
+        try:
+            self.subposteriors = pool.map( fit_subposterior, tasks )
+        finally:
+            pool.close()
+            pool.join()
+
+
+    def combine(self,method='consensus'):
+        """
+        Combine the subposterior samples into a sample from the full posterior.
+
+        Parameters:
+        method - 'consensus' to average the i-th draw of each chain weighted by the
+                subposterior precisions (consensus Monte Carlo), or 'gaussian' to approximate
+                each subposterior by a Gaussian and sample from their product (optional)
+
+        Returns:
+        sample - array of shape (n_iters, d) holding the combined sample
+        """
+        if method == 'consensus':
+            return consensus_combine( self.subposteriors )
+        elif method == 'gaussian':
+            mean, covariance = gaussian_product( self.subposteriors )
+            n_iters = min( [ sample.shape[0] for sample in self.subposteriors ] )
+            return np.random.multivariate_normal( mean, covariance, size = n_iters )
+        raise ValueError( "method must be 'consensus' or 'gaussian'" )
+
+
+    def logloss(self,sample):
+        """Return the test log loss at the mean of a combined sample, as returned by combine"""
+        return test_logloss( sample.mean( axis = 0 ), self.X_test, self.y_test )
+
+
+def fit_subposterior(task):
+    """
+    Fit a chain to one subposterior, run in a worker process of ConsensusSampler.
+
+    The chain has no test set, so it doesn't spend time evaluating the test log loss.
+
+    Parameters:
+    task - tuple (X, y, n_shards, stepsize, beta_mode, n_iters, minibatch_size, seed)
+
+    Returns:
+    sample - array holding the chain of the subposterior
+    """
+    X, y, n_shards, stepsize, beta_mode, n_iters, minibatch_size, seed = task
+    np.random.seed(seed)
+    with LogisticRegression( X, None, y, None ) as lr:
+        lr.prior_scale = 1.0 / n_shards
+        lr.fit( stepsize, beta_mode, n_iters, minibatch_size, 
+                metrics = Metrics( enabled = False ) )
+        return lr.sample
+
+
+def consensus_combine(samples):
+    """
+    Combine subposterior samples using consensus Monte Carlo.
+
+    The i-th combined draw is the average of the i-th draws of each chain, weighted by the
+    inverse of each subposterior's sample covariance. Chains are truncated to the same length.
+
+    Parameters:
+    samples - list of arrays of shape (n_iters, d), one for each subposterior
+
+    Returns:
+    sample - array holding the combined sample
+    """
+    n_iters = min( [ sample.shape[0] for sample in samples ] )
+    weights = [ np.linalg.inv( np.atleast_2d( np.cov( sample, rowvar = False ) ) )
+            for sample in samples ]
+    combined = sum( [ np.dot( sample[:n_iters,:], weight )
+            for sample, weight in zip( samples, weights ) ] )
+    return np.linalg.solve( sum(weights), combined.T ).T
+
+
+def gaussian_product(samples):
+    """
+    Approximate each subposterior by a Gaussian and return the mean and covariance of their product
+
+    Parameters:
+    samples - list of arrays of shape (n_iters, d), one for each subposterior
+
+    Returns:
+    mean - mean of the product
+    covariance - covariance matrix of the product
+    """
+    precisions = [ np.linalg.inv( np.atleast_2d( np.cov( sample, rowvar = False ) ) )
+            for sample in samples ]
+    covariance = np.linalg.inv( sum(precisions) )
+    mean = np.dot( covariance, sum( [ np.dot( precision, sample.mean( axis = 0 ) )
+            for sample, precision in zip( samples, precisions ) ] ) )
+    return mean, covariance
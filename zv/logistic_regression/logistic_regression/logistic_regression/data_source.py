@@ -0,0 +1,641 @@
+import os
+import threading
+import Queue
+import numpy as np
+import scipy.sparse as sp
+
+
+class ArrayData:
+    """
+    Training data held in memory, served as dense minibatches of rows.
+
+    This is the data source interface used by the fitters: minibatch() draws a minibatch
+    and gathers its rows into a contiguous block, rows() gathers specified rows and
+    blocks() iterates over all the data in consecutive blocks for full passes.
+    The design matrix can be a dense array or matrix, or a scipy sparse matrix.
+
+    Rows can carry weights in the likelihood, row_weights, so the log likelihood is the
+    weighted sum of the row log likelihoods, e.g. for a coreset; it's None if every row has
+    weight 1. Full passes use weighted_blocks() to pick up the row weights.
+    If minibatches aren't drawn uniformly or rows are weighted, weights holds the weight of
+    each row, which multiplies its gradient so minibatch estimates stay unbiased; it's None 
+    otherwise. prefix is the path prefix of the files for data opened by load_memmap, and 
+    None for data held in memory.
+    """
+
+    def __init__(self,X,y,row_weights=None):
+        """
+        Initialise the data source.
+
+        Parameters:
+        X - matrix of explanatory variables (dense or sparse)
+        y - vector of response variables
+        row_weights - weight of each row in the likelihood, None if rows are unweighted (optional)
+        """
+        if sp.issparse(X):
+            self.X = sp.csr_matrix(X)
+        else:
+            self.X = np.asarray(X)
+        self.y = np.asarray(y).ravel()
+        self.N = self.X.shape[0]
+        self.d = self.X.shape[1]
+        self.row_weights = None
+        if row_weights is not None:
+            self.row_weights = np.asarray( row_weights, dtype = float ).ravel()
+        self.weights = self.row_weights
+        self.prefix = None
+
+
+    def append(self,X,y,row_weights=None):
+        """
+        Append rows to the data, held in memory from then on.
+
+        Parameters:
+        X - matrix of explanatory variables of the new rows (dense or sparse)
+        y - vector of response variables of the new rows
+        row_weights - weight of each new row in the likelihood, 1 by default (optional)
+        """
+        if self.row_weights is not None or row_weights is not None:
+            old_weights = self.row_weights
+            if old_weights is None:
+                old_weights = np.ones( self.N )
+            if row_weights is None:
+                row_weights = np.ones( X.shape[0] )
+            self.row_weights = np.concatenate( ( old_weights, 
+                    np.asarray( row_weights, dtype = float ).ravel() ) )
+            self.weights = self.row_weights
+        if sp.issparse(self.X):
+            self.X = sp.vstack( ( self.X, sp.csr_matrix(X) ), format = 'csr' )
+        else:
+            if sp.issparse(X):
+                X = X.toarray()
+            self.X = np.concatenate( ( self.X, np.asarray(X) ) )
+        self.y = np.concatenate( ( self.y, np.asarray(y).ravel() ) )
+        self.N = self.X.shape[0]
+        # The data no longer matches the files it was loaded from
+        self.prefix = None
+
+
+    def rows(self,indices):
+        """
+        Gather rows of the data into a contiguous block.
+
+        Parameters:
+        indices - indices of the rows to gather
+
+        Returns:
+        X - dense array of shape (len(indices), d)
+        y - vector of responses of the rows
+        """
+        X = self.X[indices]
+        if sp.issparse(X):
+            X = X.toarray()
+        return np.asarray(X), self.y[indices]
+
+
+    def blocks(self,block_size=10000):
+        """Iterate over the data in consecutive blocks of rows, yielding (X, y) pairs"""
+        for start in xrange(0,self.N,block_size):
+            end = min( start + block_size, self.N )
+            X = self.X[start:end]
+            if sp.issparse(X):
+                X = X.toarray()
+            yield np.asarray(X), self.y[start:end]
+
+
+    def weighted_blocks(self,block_size=10000):
+        """Iterate over the data in consecutive blocks, yielding (X, y, row weights), weights None if unweighted"""
+        start = 0
+        for X, y in self.blocks(block_size):
+            end = start + len(y)
+            if self.row_weights is None:
+                yield X, y, None
+            else:
+                yield X, y, self.row_weights[start:end]
+            start = end
+
+
+    def minibatch(self,minibatch_size):
+        """
+        Sample a minibatch uniformly without replacement and gather its rows.
+
+        Indices are sorted so rows are read in storage order.
+
+        Returns:
+        indices - indices of the rows in the minibatch
+        X - dense array holding the rows of the minibatch
+        y - vector of responses of the minibatch
+        """
+        indices = self.draw( minibatch_size )
+        X, y = self.rows(indices)
+        return indices, X, y
+
+
+    def draw(self,minibatch_size):
+        """Draw the indices of a minibatch, uniformly without replacement"""
+        return draw_minibatch( self.N, minibatch_size )
+
+
+class ImportanceData(ArrayData):
+    """
+    Training data served as minibatches drawn with probability proportional to a row score.
+
+    Rows are drawn with replacement, row i with probability p_i, using an AliasTable so each
+    draw costs O(1). Row i has weight 1 / ( N p_i ), times its row weight if rows are weighted,
+    and the fitters multiply each row's gradient by its weight, so minibatch gradient
+    estimates stay unbiased. Rows whose
+    gradients are large get drawn more often, which reduces the variance of the estimates
+    for a given minibatch size. Scores can be calculated using gradient_scores.
+    """
+
+    def __init__(self,X,y,scores,mix=0.1,row_weights=None):
+        """
+        Build the alias table.
+
+        Parameters:
+        X - matrix of explanatory variables (dense or sparse)
+        y - vector of response variables
+        scores - nonnegative score of each row
+        mix - proportion of uniform sampling mixed in, which bounds the weights by 1 / mix (optional)
+        row_weights - weight of each row in the likelihood, None if rows are unweighted (optional)
+        """
+        ArrayData.__init__(self,X,y,row_weights)
+        self.mix = mix
+        self.set_scores(scores)
+
+
+    def set_scores(self,scores):
+        """Set the sampling probabilities and weights of the rows from their scores"""
+        self.scores = np.asarray( scores, dtype = float )
+        probabilities = ( ( 1 - self.mix ) * self.scores / self.scores.sum() 
+                + self.mix / float( self.N ) )
+        self.table = AliasTable( probabilities )
+        self.weights = 1 / ( self.N * probabilities )
+        if self.row_weights is not None:
+            self.weights *= self.row_weights
+
+
+    def draw(self,minibatch_size):
+        """Draw the sorted indices of a minibatch with replacement, proportional to the scores"""
+        return np.sort( self.table.draw( minibatch_size ) )
+
+
+    def append(self,X,y,row_weights=None):
+        """Append rows to the data, giving them the average score"""
+        scores = np.concatenate( ( self.scores, self.scores.mean() * np.ones( X.shape[0] ) ) )
+        ArrayData.append(self,X,y,row_weights)
+        self.set_scores(scores)
+
+
+class CompressedData(ImportanceData):
+    """
+    Training data with duplicate rows collapsed into unique rows with integer multiplicities.
+
+    Data with many repeated rows, e.g. categorical or discretised features, is stored as its
+    U unique rows, each with row weight equal to its multiplicity c_i, so memory and full
+    data passes scale with U rather than with the number of observations n = sum c_i.
+    Minibatch rows are drawn with replacement with probability c_i / n using an alias 
+    table, so every original observation is equally likely to be drawn. Each drawn row's 
+    gradient then has weight n / U, and minibatch gradient estimates are unbiased
+    estimates of the full data gradient.
+
+    As for any weighted data source N is the number of stored rows, here unique rows.
+    """
+
+    def __init__(self,X,y,counts=None,block_size=10000):
+        """
+        Compress the data.
+
+        Parameters:
+        X - matrix of explanatory variables (dense or sparse), unique rows if counts is given
+        y - vector of response variables
+        counts - multiplicity of each row, if X and y are already compressed (optional)
+        block_size - number of rows compressed at a time (optional)
+        """
+        if counts is None:
+            X, y, counts = unique_rows( ArrayData(X,y), block_size )
+        counts = np.asarray( counts )
+        ImportanceData.__init__( self, X, y, counts, 0.0, counts )
+        self.counts = counts
+        self.n_observations = counts.sum()
+
+
+    def append(self,X,y,row_weights=None):
+        """
+        Append rows to the data, with multiplicities row_weights, 1 by default.
+
+        New rows aren't merged with existing duplicates, which is correct but uses more memory.
+        """
+        if row_weights is None:
+            row_weights = np.ones( X.shape[0], dtype = int )
+        self.counts = np.concatenate( ( self.counts, np.asarray( row_weights ).ravel() ) )
+        self.n_observations = self.counts.sum()
+        ArrayData.append(self,X,y,row_weights)
+        self.set_scores( self.counts )
+
+
+class AliasTable:
+    """
+    Walker's alias table, for drawing from a discrete distribution in O(1) time per draw.
+
+    Built in O(n) time using Vose's method.
+
+    References:
+        1. Vose's alias method - https://doi.org/10.1109/32.92917
+    """
+
+    def __init__(self,probabilities):
+        """
+        Build the table.
+
+        Parameters:
+        probabilities - probability of each outcome, summing to 1
+        """
+        n = len(probabilities)
+        scaled = n * np.asarray( probabilities, dtype = float )
+        self.n = n
+        self.threshold = np.ones( n )
+        self.alias = np.arange( n )
+        small = list( np.flatnonzero( scaled < 1 ) )
+        large = list( np.flatnonzero( scaled >= 1 ) )
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.threshold[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1 - scaled[less]
+            if scaled[more] < 1:
+                small.append(more)
+            else:
+                large.append(more)
+        # Anything left has probability 1 up to rounding error, so keeps threshold 1
+
+
+    def draw(self,size):
+        """Draw size outcomes independently"""
+        columns = np.random.randint( self.n, size = size )
+        accept = np.random.random_sample( size ) < self.threshold[columns]
+        return np.where( accept, columns, self.alias[columns] )
+
+
+class BlockData(ArrayData):
+    """
+    Training data shuffled once and stored contiguously, served as contiguous minibatches.
+
+    At load time the rows are permuted once at random and copied into a contiguous array.
+    Each epoch the stored rows are split into chunks of minibatch_size / n_blocks consecutive
+    rows, starting from a random offset, and the chunks are visited in a random order.
+    A minibatch is made of n_blocks chunks, so with n_blocks = 1 it is a view of the
+    stored data rather than a fancy-indexed copy, and gradient kernels stream through
+    memory sequentially.
+
+    Because the rows were shuffled, every chunk is a uniformly random subset of the data,
+    and the random offset means every row is equally likely to be used in each epoch, so
+    the minibatch gradient estimate stays unbiased. Its variance matches that of a
+    minibatch drawn without replacement, but minibatches within an epoch never overlap
+    and chunk membership is fixed by the initial shuffle.
+    """
+
+    def __init__(self,X,y,n_blocks=1,row_weights=None):
+        """
+        Shuffle and store the data.
+
+        Parameters:
+        X - matrix of explanatory variables (dense or sparse)
+        y - vector of response variables
+        n_blocks - number of contiguous chunks making up each minibatch (optional)
+        row_weights - weight of each row in the likelihood, None if rows are unweighted (optional)
+        """
+        ArrayData.__init__(self,X,y,row_weights)
+        # Original index of each stored row
+        self.permutation = np.random.permutation( self.N )
+        if sp.issparse(self.X):
+            self.X = self.X[self.permutation]
+        else:
+            self.X = np.ascontiguousarray( self.X[self.permutation] )
+        self.y = np.ascontiguousarray( self.y[self.permutation] )
+        if self.row_weights is not None:
+            self.row_weights = self.row_weights[self.permutation]
+            self.weights = self.row_weights
+        self.n_blocks = n_blocks
+        self.chunk_size = None
+        # Start of each chunk not yet used in the current epoch
+        self.chunks = []
+
+
+    def append(self,X,y,row_weights=None):
+        """
+        Shuffle new rows and append them to the stored data.
+
+        New rows are only shuffled among themselves, but chunks start from a random offset
+        each epoch, so every row is still equally likely to be used in each epoch.
+        """
+        permutation = np.random.permutation( X.shape[0] )
+        if row_weights is not None:
+            row_weights = np.asarray( row_weights ).ravel()[permutation]
+        ArrayData.append( self, X[permutation], np.asarray(y).ravel()[permutation], row_weights )
+        self.permutation = np.concatenate( ( self.permutation, 
+                self.permutation.shape[0] + permutation ) )
+
+
+    def set_permutation(self,permutation):
+        """
+        Reorder the stored rows so that stored row i is original row permutation[i].
+
+        Used to restore the shuffle of a checkpointed fit, so it resumes on the same chunks
+        whatever the state of numpy's random number generator when the data was loaded.
+        """
+        permutation = np.asarray( permutation )
+        if permutation.shape != self.permutation.shape:
+            raise ValueError( "permutation doesn't match the number of stored rows" )
+        if np.array_equal( permutation, self.permutation ):
+            return
+        # Current storage position of each original row
+        position = np.empty( self.N, dtype = int )
+        position[self.permutation] = np.arange( self.N )
+        order = position[permutation]
+        if sp.issparse(self.X):
+            self.X = self.X[order]
+        else:
+            self.X = np.ascontiguousarray( self.X[order] )
+        self.y = np.ascontiguousarray( self.y[order] )
+        if self.row_weights is not None:
+            self.row_weights = self.row_weights[order]
+            self.weights = self.row_weights
+        self.permutation = permutation
+        self.chunks = []
+
+
+    def checkpoint_tables(self):
+        """
+        Return the shuffle as a table for Checkpointer, keyed by name as (table, changed rows).
+
+        The table only changes when rows are appended, which changes its shape, so it is
+        written in full then and never journalled.
+        """
+        return { 'block_permutation' : ( self.permutation, np.arange( 0 ) ) }
+
+
+    def new_epoch(self):
+        """Split the stored rows into chunks from a random offset and shuffle their order"""
+        n_chunks = self.N // self.chunk_size
+        offset = np.random.randint( self.N )
+        self.chunks = list( ( offset + self.chunk_size * np.random.permutation( n_chunks ) ) 
+                % self.N )
+
+
+    def chunk(self,start):
+        """Return the indices, rows and responses of the chunk starting at start"""
+        end = start + self.chunk_size
+        if end <= self.N:
+            X = self.X[start:end]
+            if sp.issparse(X):
+                X = X.toarray()
+            return np.arange( start, end ), X, self.y[start:end]
+        # Chunk wraps around the end of the data
+        indices = np.arange( start, end ) % self.N
+        X, y = self.rows(indices)
+        return indices, X, y
+
+
+    def minibatch(self,minibatch_size):
+        """
+        Take the next n_blocks chunks of the current epoch as a minibatch.
+
+        Returns:
+        indices - indices of the stored rows in the minibatch
+        X - dense array holding the rows of the minibatch, a view when n_blocks = 1
+        y - vector of responses of the minibatch
+        """
+        if minibatch_size % self.n_blocks != 0:
+            raise ValueError( "minibatch_size must be a multiple of n_blocks" )
+        if self.chunk_size != minibatch_size // self.n_blocks:
+            self.chunk_size = minibatch_size // self.n_blocks
+            self.chunks = []
+        if len( self.chunks ) < self.n_blocks:
+            self.new_epoch()
+        chunks = [ self.chunk( self.chunks.pop() ) for block in range( self.n_blocks ) ]
+        if self.n_blocks == 1:
+            return chunks[0]
+        return tuple( np.concatenate( part ) for part in zip( *chunks ) )
+
+
+class PrefetchReader:
+    """
+    Wrap a data source so the next minibatch is gathered in a background thread.
+
+    The indices of minibatch t+1 are drawn when minibatch t is handed out, and its rows
+    are gathered into a contiguous buffer while the fitter works on minibatch t. Numpy
+    releases the GIL while copying rows, so reading a memory-mapped file overlaps with
+    the gradient calculation.
+
+    BlockData can't be wrapped: its minibatches are already contiguous views, with no
+    gather to overlap, and are drawn by its own minibatch rather than draw.
+    """
+
+    def __init__(self,data):
+        """
+        Start the background thread.
+
+        Parameters:
+        data - data source to read from, e.g. ArrayData or the result of load_memmap
+        """
+        if isinstance( data, BlockData ):
+            raise ValueError( "BlockData serves contiguous minibatches itself, use it unwrapped" )
+        self.data = data
+        self.N = data.N
+        self.d = data.d
+        self.row_weights = data.row_weights
+        self.weights = data.weights
+        # Indices of the minibatch being gathered, None if nothing has been requested
+        self.pending = None
+        self.requests = Queue.Queue()
+        self.gathered = Queue.Queue()
+        self.worker = threading.Thread( target = self.gather )
+        self.worker.daemon = True
+        self.worker.start()
+
+
+    def gather(self):
+        """Worker loop, gather the rows of each requested minibatch"""
+        while True:
+            indices = self.requests.get()
+            self.gathered.put( self.data.rows(indices) )
+
+
+    def request(self,indices):
+        """Start gathering the rows of indices, dropping any minibatch already requested"""
+        if self.pending is not None:
+            self.gathered.get()
+        self.pending = indices
+        self.requests.put(indices)
+
+
+    def minibatch(self,minibatch_size):
+        """
+        Hand out the prefetched minibatch and start gathering the next one.
+
+        Returns:
+        indices - indices of the rows in the minibatch
+        X - dense array holding the rows of the minibatch
+        y - vector of responses of the minibatch
+        """
+        if self.pending is None or len( self.pending ) != minibatch_size:
+            self.request( self.data.draw( minibatch_size ) )
+        indices = self.pending
+        X, y = self.gathered.get()
+        self.pending = None
+        self.request( self.data.draw( minibatch_size ) )
+        return indices, X, y
+
+
+    def rows(self,indices):
+        """Gather rows of the data into a contiguous block"""
+        return self.data.rows(indices)
+
+
+    def append(self,X,y,row_weights=None):
+        """Append rows to the wrapped data source"""
+        self.data.append(X,y,row_weights)
+        self.N = self.data.N
+        self.row_weights = self.data.row_weights
+        self.weights = self.data.weights
+
+
+    def blocks(self,block_size=10000):
+        """Iterate over the data in consecutive blocks of rows, yielding (X, y) pairs"""
+        return self.data.blocks(block_size)
+
+
+    def weighted_blocks(self,block_size=10000):
+        """Iterate over the data in consecutive blocks, yielding (X, y, row weights) triples"""
+        return self.data.weighted_blocks(block_size)
+
+
+def draw_minibatch(N,minibatch_size):
+    """Draw sorted indices of a minibatch uniformly without replacement"""
+    return np.sort( np.random.choice( np.arange( N ), minibatch_size, replace = False ) )
+
+
+def gradient_scores(data,beta,block_size=10000):
+    """
+    Score each row by the size of its log likelihood gradient at beta, for ImportanceData.
+
+    The gradient of row i is ( y_i - p_i ) x_i, so its norm is | y_i - p_i | ||x_i||, times
+    the row weight if rows are weighted. At the mode, this is the size of the term each row
+    contributes to the control variates.
+
+    Parameters:
+    data - data source holding the training data
+    beta - parameter values to score the rows at, e.g. the mode
+    block_size - number of rows scored at a time (optional)
+    """
+    scores = []
+    for X, y, weights in data.weighted_blocks(block_size):
+        with np.errstate( over = 'ignore', under = 'ignore' ):
+            residuals = y - 1 / ( 1 + np.exp( - np.dot( X, beta ) ) )
+        if weights is not None:
+            residuals = weights * residuals
+        scores.append( np.abs(residuals) * np.sqrt( ( X**2 ).sum( axis = 1 ) ) )
+    return np.concatenate(scores)
+
+
+def unique_rows(data,block_size=10000):
+    """
+    Collapse identical rows of a data source, with identical responses, into unique rows.
+
+    Duplicates are found within each block of rows using np.unique, then merged across 
+    blocks using a dictionary of the unique rows found so far, so memory scales with the 
+    number of unique rows rather than the size of the data.
+
+    Parameters:
+    data - data source holding the data, e.g. ArrayData( X, y )
+    block_size - number of rows compressed at a time (optional)
+
+    Returns:
+    X - dense array holding the unique rows
+    y - vector of responses of the unique rows
+    counts - multiplicity of each unique row, the sum of its row weights if rows are weighted
+    """
+    index = {}
+    rows = []
+    counts = []
+    for X, y, weights in data.weighted_blocks(block_size):
+        block = np.ascontiguousarray( np.column_stack( ( X, y ) ), dtype = float )
+        # View each row as a single opaque value so np.unique compares whole rows
+        keys = block.view( np.dtype( ( np.void, block.dtype.itemsize * block.shape[1] ) ) ).ravel()
+        _, first, inverse = np.unique( keys, return_index = True, return_inverse = True )
+        block_counts = np.bincount( inverse, weights = weights )
+        for row, count in zip( first, block_counts ):
+            key = block[row].tostring()
+            if key in index:
+                counts[index[key]] += count
+            else:
+                index[key] = len(rows)
+                rows.append( block[row] )
+                counts.append( count )
+    rows = np.array(rows)
+    counts = np.array(counts)
+    if data.row_weights is None:
+        counts = counts.astype(int)
+    return rows[:,:-1], rows[:,-1], counts
+
+
+def as_data_source(X,y):
+    """Return X if it's already a data source, otherwise wrap X and y in ArrayData"""
+    if hasattr( X, 'minibatch' ):
+        return X
+    return ArrayData(X,y)
+
+
+def save_memmap(X,y,prefix,row_weights=None):
+    """
+    Store a design matrix and responses as .npy files which can be memory-mapped.
+
+    Dense matrices are stored in prefix.X.npy, sparse ones in CSR format as
+    prefix.data.npy, prefix.indices.npy and prefix.indptr.npy. Row weights, if any,
+    are stored in prefix.w.npy.
+
+    Parameters:
+    X - matrix of explanatory variables (dense or sparse)
+    y - vector of response variables
+    prefix - path prefix of the stored files
+    row_weights - weight of each row in the likelihood (optional)
+    """
+    if sp.issparse(X):
+        X = sp.csr_matrix(X)
+        np.save( prefix + '.data.npy', X.data )
+        np.save( prefix + '.indices.npy', X.indices )
+        np.save( prefix + '.indptr.npy', X.indptr )
+        np.save( prefix + '.shape.npy', np.array( X.shape ) )
+    else:
+        np.save( prefix + '.X.npy', np.ascontiguousarray(X) )
+    np.save( prefix + '.y.npy', np.asarray(y).ravel() )
+    if row_weights is not None:
+        np.save( prefix + '.w.npy', np.asarray( row_weights, dtype = float ).ravel() )
+
+
+def load_memmap(prefix):
+    """
+    Open data stored by save_memmap as a data source without reading it into memory.
+
+    Parameters:
+    prefix - path prefix of the stored files
+
+    Returns:
+    data - ArrayData object backed by memory-mapped files
+    """
+    y = np.load( prefix + '.y.npy', mmap_mode = 'r' )
+    if os.path.exists( prefix + '.X.npy' ):
+        X = np.load( prefix + '.X.npy', mmap_mode = 'r' )
+    else:
+        shape = tuple( np.load( prefix + '.shape.npy' ) )
+        X = sp.csr_matrix( ( np.load( prefix + '.data.npy', mmap_mode = 'r' ),
+                np.load( prefix + '.indices.npy', mmap_mode = 'r' ),
+                np.load( prefix + '.indptr.npy', mmap_mode = 'r' ) ), shape = shape, copy = False )
+    row_weights = None
+    if os.path.exists( prefix + '.w.npy' ):
+        row_weights = np.load( prefix + '.w.npy' )
+    data = ArrayData(X,y,row_weights)
+    data.prefix = prefix
+    return data
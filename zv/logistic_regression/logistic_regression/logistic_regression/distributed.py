@@ -0,0 +1,198 @@
+import multiprocessing
+import numpy as np
+from data_source import CompressedData, ImportanceData, PrefetchReader, load_memmap
+from zvsgld import ZVSGLD
+
+
+class DistributedSGLD(ZVSGLD):
+    """
+    SGLD with control variates where the training data is split across worker processes.
+
+    The rows are partitioned into contiguous shards, each read into memory by its own worker
+    process. Every iteration the current parameters are sent to all workers over pipes,
+    each worker draws a minibatch from its shard, proportional in size to the shard, and
+    returns its contribution to the log likelihood gradient estimates at beta and beta_mode.
+    The coordinator sums the contributions in shard order and applies the ZVSGLD update.
+    Since each contribution is scaled by its shard size over its minibatch size, the
+    gradient estimate is unbiased, and it's a stratified version of the one in ZVSGLD.
+
+    Data stored by save_memmap is read by each worker from the files, so only its shard is
+    ever in memory; other data sources are handed to the workers, which keep only their
+    shard. Once the workers hold their shards the coordinator drops lr.data, so the full
+    data isn't kept alongside them.
+
+    Workers draw their minibatches uniformly and weight rows by the row weights of the data
+    source, so ImportanceData, whose sampling probabilities would be ignored, is rejected.
+    CompressedData is supported, since its multiplicities are its row weights. PrefetchReader
+    is rejected too, as workers draw their own minibatches.
+
+    Workers run on the local machine, standing in for the nodes of a cluster. The workers'
+    random number generators are seeded from numpy's global generator, so fits are
+    reproducible given np.random.seed, but can't be checkpointed.
+    """
+
+    def __init__(self,lr,epsilon,minibatch_size,n_iter,n_shards):
+        """
+        Start a worker process for each shard, then drop the training data of lr.
+
+        Parameters:
+        lr - LogisticRegression object, with lr.beta_mode set; lr.data is None afterwards
+        epsilon - the stepsize to perform SGD at
+        minibatch_size - total size of the minibatches drawn across all shards
+        n_iter - the maximum number of iterations to perform, None if there's no maximum
+        n_shards - number of shards, each held by a worker process
+        """
+        data = lr.data
+        if isinstance( data, PrefetchReader ):
+            # Its thread would keep the data alive, and workers draw their own minibatches
+            raise ValueError( "workers draw their own minibatches, pass the data unwrapped" )
+        if isinstance( data, ImportanceData ) and not isinstance( data, CompressedData ):
+            raise ValueError( "shards draw minibatches uniformly, so ImportanceData "
+                    "isn't supported" )
+        # Workers open memory-mapped data themselves, reading only their shard
+        source = data if data.prefix is None else data.prefix
+        ZVSGLD.__init__(self,lr,epsilon,minibatch_size,n_iter)
+        bounds = [ shard * lr.N // n_shards for shard in range( n_shards + 1 ) ]
+        self.connections = []
+        self.workers = []
+        rows_used = 0
+        for shard in range( n_shards ):
+            start, end = bounds[shard], bounds[shard+1]
+            shard_minibatch = max( 1, minibatch_size * ( end - start ) // lr.N )
+            rows_used += shard_minibatch
+            connection, worker_connection = multiprocessing.Pipe()
+            worker = multiprocessing.Process( target = shard_worker, args = ( worker_connection,
+                    lr, source, start, end, lr.beta_mode, shard_minibatch,
+                    np.random.randint( 2**31 ), np.geterr() ) )
+            worker.daemon = True
+            worker.start()
+            self.connections.append( connection )
+            self.workers.append( worker )
+        # Shard minibatch sizes are rounded down, so store the number of rows actually used
+        self.minibatch_size = rows_used
+        lr.data = None
+
+
+    def request(self,*message):
+        """Send message to every worker, then return their replies in shard order"""
+        if not self.connections:
+            raise ValueError( "the workers have been stopped" )
+        for connection in self.connections:
+            connection.send( message )
+        replies = [ connection.recv() for connection in self.connections ]
+        # Workers reply with an exception to requests they can't answer, and keep running
+        for reply in replies:
+            if isinstance( reply, Exception ):
+                raise reply
+        return replies
+
+
+    def full_loglik(self,lr):
+        """Return the full data log likelihood gradient at the mode, summed over shards"""
+        return self.loglik_gradient( lr.beta_mode )
+
+
+    def loglik_gradient(self,beta):
+        """Return the full data log likelihood gradient at beta, summed over shards"""
+        return sum( self.request( 'full_loglik', beta ) )
+
+
+    def gradients(self,lr):
+        """Return the log posterior gradient estimates at lr.beta and lr.beta_mode, aggregated over shards"""
+        contributions = self.request( 'gradients', lr.beta )
+        dlogbeta = sum( [ contribution[0] for contribution in contributions ] )
+        dlogbetaopt = sum( [ contribution[1] for contribution in contributions ] )
+        return lr.add_prior_cv( dlogbeta, dlogbetaopt )
+
+
+    def append(self,lr,X,y,weights=None):
+        """Shards are fixed when the workers start, so rows can't be appended"""
+        raise ValueError( "rows can't be appended to a distributed fit" )
+
+
+    def estimator_variance(self,lr,beta=None):
+        """Estimate the variance of each coordinate of the gradient estimate from the shards' last minibatches"""
+        if beta is None:
+            beta = lr.beta
+        return sum( self.request( 'variance', beta ) )
+
+
+    def sample_minibatch(self,lr):
+        """Minibatches are drawn uniformly by the workers"""
+        self.w_batch = None
+
+
+    def close(self):
+        """Stop the worker processes"""
+        for connection in self.connections:
+            connection.send( ( 'stop', ) )
+        for worker in self.workers:
+            worker.join()
+        self.connections = []
+        self.workers = []
+
+
+def shard_worker(connection,model,source,start,end,beta_mode,minibatch_size,seed,errors):
+    """
+    Worker loop holding one shard of the training data.
+
+    Rows are weighted by the row weights of the data source, if it has any. Once the shard
+    has been read the worker drops its references to the rest of the data. A request the
+    worker can't answer gets an exception as its reply, which the coordinator raises.
+
+    Messages are tuples whose first element is the request:
+    ('gradients', beta) - reply with the log likelihood gradients at beta and beta_mode of a
+            new minibatch from the shard, scaled by shard size / minibatch size
+    ('full_loglik', beta) - reply with the log likelihood gradient of the whole shard at beta
+    ('variance', beta) - reply with the variance of each coordinate of the shard's contribution 
+            to the gradient estimate, estimated from its last minibatch at beta; an error
+            before the first 'gradients' request
+    ('stop',) - exit
+
+    Parameters:
+    connection - end of the pipe to the coordinator
+    model - LogisticRegression object whose dloglik and row_variance methods are used
+    source - data source holding the training data, or the path prefix of data stored by
+            save_memmap
+    start - first row of the shard
+    end - row after the last row of the shard
+    beta_mode - parameter values at the mode
+    minibatch_size - size of the minibatches drawn from the shard
+    seed - seed of the worker's random number generator
+    errors - numpy floating point error handling of the coordinator, as returned by np.geterr
+    """
+    np.seterr( **errors )
+    data = source
+    if isinstance( source, basestring ):
+        data = load_memmap( source )
+    X, y = data.rows( np.arange( start, end ) )
+    weights = None
+    if data.row_weights is not None:
+        weights = data.row_weights[start:end]
+    # Keep only the shard, the worker's copy of the model holds the coordinator's data
+    data = source = model.data = None
+    # Last minibatch drawn, None until the first 'gradients' request
+    X_batch = y_batch = w_batch = None
+    random_state = np.random.RandomState( seed )
+    scale = ( end - start ) / float( minibatch_size )
+    while True:
+        message = connection.recv()
+        if message[0] == 'gradients':
+            beta = message[1]
+            minibatch = np.sort( random_state.choice( end - start, minibatch_size, replace = False ) )
+            X_batch = X[minibatch]
+            y_batch = y[minibatch]
+            if weights is not None:
+                w_batch = weights[minibatch]
+            connection.send( ( scale * model.dloglik( beta, X_batch, y_batch, w_batch ),
+                    scale * model.dloglik( beta_mode, X_batch, y_batch, w_batch ) ) )
+        elif message[0] == 'variance' and X_batch is None:
+            connection.send( ValueError( "no minibatch has been drawn from the shard yet" ) )
+        elif message[0] == 'variance':
+            connection.send( ( end - start )**2 / float( minibatch_size ) * model.row_variance(
+                    message[1], X_batch, y_batch, w_batch, beta_mode ) )
+        elif message[0] == 'full_loglik':
+            connection.send( model.dloglik( message[1], X, y, weights ) )
+        else:
+            connection.close()
+            return
@@ -0,0 +1,80 @@
+"""
+Fused compiled kernels for SGLD with control variates, used by ZVSGLD when backend = 'numba'.
+
+Numba is optional: if it isn't installed HAVE_NUMBA is False and ZVSGLD falls back to the
+numpy implementation.
+"""
+import math
+try:
+    import numba
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+
+def sigmoid(z):
+    """Numerically stable logistic function"""
+    if z >= 0:
+        return 1.0 / ( 1.0 + math.exp( - z ) )
+    expz = math.exp( z )
+    return expz / ( 1.0 + expz )
+
+
+def sign(x):
+    """Sign of a float, as a float"""
+    if x > 0:
+        return 1.0
+    if x < 0:
+        return -1.0
+    return 0.0
+
+
+def sgld_cv_step(X,y,weights,indices,beta,beta_mode,full_post,scale,prior_scale,epsilon,eta,grad,grad_opt):
+    """
+    Perform one SGLD update with control variates in a single pass over the minibatch.
+
+    Gathers each minibatch row, calculates the residuals at beta and beta_mode, accumulates
+    the gradients and applies the Langevin update, without allocating any arrays.
+
+    Parameters:
+    X - dense C-contiguous matrix of explanatory variables for training (float array)
+    y - vector of response variables for training (float array)
+    weights - weight of each training row in the likelihood, ones if rows are unweighted
+    indices - indices of the rows in the minibatch
+    beta - current parameter values, updated in place
+    beta_mode - parameter values at the mode
+    full_post - full data log posterior gradient at the mode
+    scale - factor making the minibatch gradient unbiased, N / minibatch_size
+    prior_scale - power the prior is raised to
+    epsilon - stepsize
+    eta - injected noise for this step
+    grad - work array, holds the minibatch log posterior gradient at beta on return
+    grad_opt - work array, holds the minibatch log posterior gradient at beta_mode on return
+    """
+    d = beta.shape[0]
+    for j in range(d):
+        grad[j] = 0.0
+        grad_opt[j] = 0.0
+    for k in range(indices.shape[0]):
+        i = indices[k]
+        z = 0.0
+        z_opt = 0.0
+        for j in range(d):
+            z += X[i,j] * beta[j]
+            z_opt += X[i,j] * beta_mode[j]
+        residual = weights[i] * ( y[i] - sigmoid(z) )
+        residual_opt = weights[i] * ( y[i] - sigmoid(z_opt) )
+        for j in range(d):
+            grad[j] += residual * X[i,j]
+            grad_opt[j] += residual_opt * X[i,j]
+    for j in range(d):
+        # Add gradient of log prior (assume Laplace prior with scale 1)
+        grad[j] = grad[j] * scale - prior_scale * sign( beta[j] )
+        grad_opt[j] = grad_opt[j] * scale - prior_scale * sign( beta_mode[j] )
+        beta[j] += epsilon / 2 * ( full_post[j] + ( grad[j] - grad_opt[j] ) ) + eta[j]
+
+
+if HAVE_NUMBA:
+    sigmoid = numba.njit( sigmoid, cache = True )
+    sign = numba.njit( sign, cache = True )
+    sgld_cv_step = numba.njit( sgld_cv_step, cache = True )
@@ -1,8 +1,18 @@
+import sys
+import itertools
 import numpy as np
+from metrics import Metrics
+from diagnostics import OnlineDiagnostics, diagnostics_from_chain
+from evaluator import AsyncEvaluator, test_logloss
+from data_source import as_data_source
+from parallel import BlockPool
+from summary import PosteriorSummary
+from stein import kernel_stein_discrepancy, random_feature_ksd
+from zero_variance import ZeroVariance
 from stopwatch import Stopwatch
 from zvsgld import ZVSGLD
 from sgd import SGD
-from sklearn.metrics import log_loss
+from distributed import DistributedSGLD
 
 
 class LogisticRegression:
@@ -20,34 +30,50 @@ class LogisticRegression:
                 https://projecteuclid.org/download/pdfview_1/euclid.ba/1393251772
     """
 
+    # The fused kernels in kernels.py assume the binary logistic likelihood
+    fused_kernel = True
 
-    def __init__(self,X_train,X_test,y_train,y_test):
+
+    def __init__(self,X_train,X_test,y_train,y_test,n_threads=1,test_weights=None):
         """
         Initialise the logistic regression object.
 
         Parameters:
-        X_train - matrix of explanatory variables for training (assumes numpy array of floats)
-        X_test - matrix of explanatory variables for testing (assumes numpy array of ints)
+        X_train - matrix of explanatory variables for training (assumes numpy array of floats),
+                or a data source such as those returned by data_source.load_memmap, 
+                in which case y_train is ignored
+        X_test - matrix of explanatory variables for testing (assumes numpy array of ints),
+                None to fit without evaluating the test log loss
         y_train - vector of response variables for training (assumes numpy array of ints)
         y_train - vector of response variables for testing (assumes numpy array of ints)
+        n_threads - number of threads used for full data passes, large minibatches and 
+                test set evaluation, None to use one per core (optional)
+        test_weights - weight of each test point in the test log loss, e.g. its multiplicity
+                if duplicate test points were compressed (optional)
         """
         # Set error to be raised if there's an over/under flow
         np.seterr( over = 'raise', under = 'raise' )
-        self.X = X_train
-        self.y = y_train
+        self.data = as_data_source( X_train, y_train )
         self.X_test = X_test
         self.y_test = y_test
+        self.test_weights = test_weights
+        # Function calculating the test log loss at given parameter values
+        self.test_loss = test_logloss
 
         # Set dimension constants
-        self.N = self.X.shape[0]
-        self.d = self.X.shape[1]
-        self.test_size = self.X_test.shape[0]
+        self.N = self.data.N
+        self.d = self.data.d
+        self.test_size = 0
+        if self.X_test is not None:
+            self.test_size = self.X_test.shape[0]
         
         # Initialise containers
         # Logistic regression parameters (assume bias term encoded in design matrix)
         self.beta = np.random.rand(self.d)
         self.beta_mode = np.zeros(self.d)
         self.full_post = None
+        # Full data log likelihood gradient at the mode, updated when rows are appended
+        self.loglik_mode = None
         # Storage for beta samples and gradients of the log posterior during fitting
         self.sample = None
         self.grad_sample = None
@@ -55,9 +81,46 @@ class LogisticRegression:
         self.training_loss = []
         self.n_iters = None
         self.fitter = None
-
-
-    def fit(self,stepsize,beta_mode,n_iters=10**4,minibatch_size=500):
+        # Instrumentation for the current fit, disabled until fit is called
+        self.metrics = Metrics( enabled = False )
+        # Background evaluation mode of the test log loss, None evaluates synchronously
+        self.evaluation = None
+        # Checkpointer used to periodically save the state of the fit
+        self.checkpointer = None
+        # Online convergence diagnostics and total sampling time of the current fit
+        self.diagnostics = None
+        self.sampling_time = 0.0
+        # StoppingRule used to end the current fit early
+        self.stopping = None
+        # GradientProbe recording the variance of the gradient estimates of the current fit,
+        # as rows [iteration, total variance, squared error] of gradient_variance
+        self.probe = None
+        self.gradient_variance = []
+        # MinibatchSchedule adapting the minibatch size of the current fit
+        self.schedule = None
+        # Thread pool evaluating gradients over blocks of rows
+        self.pool = BlockPool( n_threads )
+        # Power the prior is raised to, below 1 when fitting a subposterior of a shard
+        self.prior_scale = 1.0
+
+
+    def close(self):
+        """Stop the threads of self.pool, after which blocks are evaluated in the calling thread"""
+        self.pool.close()
+
+
+    def __enter__(self):
+        """Use the object in a with statement, which closes it on exit"""
+        return self
+
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+
+    def fit(self,stepsize,beta_mode,n_iters=10**4,minibatch_size=500,metrics=None,
+            evaluation=None,checkpointer=None,stopping=None,backend='numpy',schedule=None,
+            probe=None):
         """
         Fit Bayesian logistic regression model using train and test set.
 
@@ -65,8 +128,23 @@ class LogisticRegression:
 
         Parameters:
         stepsize - stepsize to use in stochastic gradient descent
-        n_iters - number of iterations of stochastic gradient descent (optional)
+        n_iters - maximum number of iterations of stochastic gradient descent, can be None 
+                if stopping is set (optional)
         minibatch_size - minibatch size in stochastic gradient descent (optional)
+        metrics - Metrics object used to record progress, by default records are 
+                written to stdout as JSON lines (optional)
+        evaluation - 'thread' or 'process' to evaluate the test log loss in a background
+                worker while sampling continues, None evaluates synchronously (optional)
+        checkpointer - Checkpointer object used to periodically save the state of the fit,
+                so it can be continued using resume (optional)
+        stopping - StoppingRule object used to end the fit once a target ESS, MCSE or 
+                compute budget is reached (optional)
+        probe - GradientProbe object used to record the variance of the gradient estimates
+                in self.gradient_variance (optional)
+        backend - 'numpy', or 'numba' to perform each SGLD update with a fused compiled 
+                kernel when numba is installed (optional)
+        schedule - MinibatchSchedule object used to adapt the minibatch size to the 
+                gradient noise, starting from minibatch_size (optional)
         """
         # Load beta mode
         self.beta_mode = beta_mode
@@ -77,29 +155,74 @@ class LogisticRegression:
         # Number of iterations before the logloss is stored
         self.loss_thinning = 10
         # Initialize sample storage
-        self.n_iters = n_iters
-        self.sample = np.zeros( ( self.n_iters, self.d ) )
-        self.grad_sample = np.zeros( ( self.n_iters, self.d ) )
-
-        self.fitter = ZVSGLD(self,stepsize,minibatch_size,n_iters)
+        self.init_chain(n_iters)
+
+        self.metrics = metrics if metrics is not None else Metrics( stream = sys.stdout )
+        self.evaluation = evaluation
+        self.checkpointer = checkpointer
+        self.stopping = stopping
+        self.probe = probe
+        self.gradient_variance = []
+        self.schedule = schedule
+        self.fitter = ZVSGLD(self,stepsize,minibatch_size,n_iters,backend)
         # Calculate likelihood at beta mode
         self.fitter.full_post(self)
         print "Fitting chain..."
-        print "{0}\t{1}".format( "iteration", "Test log loss" )
-        timer = Stopwatch()
-        for self.fitter.iter in xrange(1,n_iters+1):
-            # Every so often output log loss on test set and store 
-            if self.fitter.iter % self.loss_thinning == 0:
-                elapsed_time = timer.toc()
-                current_loss = self.logloss()
-                self.training_loss.append( [current_loss,elapsed_time] )
-                print "{0}\t\t{1}\t\t{2}".format( self.fitter.iter, current_loss, elapsed_time )
-                timer.tic()
-            self.fitter.update(self)
-            self.sample[(self.fitter.iter-1),:] = self.beta
+        self.run_fitter(n_iters)
+
+
+    def fit_distributed(self,stepsize,beta_mode,n_shards,n_iters=10**4,minibatch_size=500,
+            metrics=None,evaluation=None,stopping=None,probe=None):
+        """
+        Fit Bayesian logistic regression model with the training data split across processes.
 
+        Uses stochastic gradient Langevin dynamics with control variates, where each of 
+        n_shards worker processes holds a shard of the training data and computes its part 
+        of the gradient estimates, see DistributedSGLD. The workers are stopped once fitted.
+        So that the full training data isn't held alongside the shards, self.data is dropped 
+        once the workers have started; the object can't be refitted or have rows appended
+        afterwards. Data opened by data_source.load_memmap is never read by this process.
 
-    def fit_sgd(self,stepsize,n_iters=10**4,minibatch_size=500):
+        Parameters:
+        stepsize - stepsize to use in stochastic gradient descent
+        beta_mode - parameter values at the mode, used by the control variates
+        n_shards - number of worker processes the training data is split across
+        n_iters - maximum number of iterations of stochastic gradient descent, can be None 
+                if stopping is set (optional)
+        minibatch_size - total minibatch size across all shards (optional)
+        metrics - Metrics object used to record progress, by default records are 
+                written to stdout as JSON lines (optional)
+        evaluation - 'thread' or 'process' to evaluate the test log loss in a background
+                worker while sampling continues, None evaluates synchronously (optional)
+        stopping - StoppingRule object used to end the fit once a target ESS, MCSE or 
+                compute budget is reached (optional)
+        probe - GradientProbe object used to record the variance of the gradient estimates
+                in self.gradient_variance (optional)
+        """
+        self.beta_mode = beta_mode
+        self.beta = beta_mode.copy()
+        self.training_loss = []
+        self.loss_thinning = 10
+        self.init_chain(n_iters)
+
+        self.metrics = metrics if metrics is not None else Metrics( stream = sys.stdout )
+        self.evaluation = evaluation
+        self.checkpointer = None
+        self.stopping = stopping
+        self.probe = probe
+        self.gradient_variance = []
+        self.schedule = None
+        self.fitter = DistributedSGLD(self,stepsize,minibatch_size,n_iters,n_shards)
+        try:
+            self.fitter.full_post(self)
+            print "Fitting chain on {0} shards...".format( n_shards )
+            self.run_fitter(n_iters)
+        finally:
+            self.fitter.close()
+
+
+    def fit_sgd(self,stepsize,n_iters=10**4,minibatch_size=500,metrics=None,
+            evaluation=None,checkpointer=None,stopping=None,probe=None):
         """
         Fit Bayesian logistic regression model using train and test set.
 
@@ -107,41 +230,369 @@ class LogisticRegression:
 
         Parameters:
         stepsize - stepsize to use in stochastic gradient descent
-        n_iters - number of iterations of stochastic gradient descent (optional)
+        n_iters - maximum number of iterations of stochastic gradient descent, can be None 
+                if stopping is set (optional)
         minibatch_size - minibatch size in stochastic gradient descent (optional)
+        metrics - Metrics object used to record progress, by default records are 
+                written to stdout as JSON lines (optional)
+        evaluation - 'thread' or 'process' to evaluate the test log loss in a background
+                worker while sampling continues, None evaluates synchronously (optional)
+        checkpointer - Checkpointer object used to periodically save the state of the fit,
+                so it can be continued using resume (optional)
+        stopping - StoppingRule object used to end the fit once a target ESS, MCSE or 
+                compute budget is reached (optional)
+        probe - GradientProbe object used to record the variance of the gradient estimates
+                in self.gradient_variance (optional)
         """
         # Holds log loss values once fitted
         self.training_loss = []
         # Number of iterations before the logloss is stored
         self.loss_thinning = 10
         # Initialize sample storage
-        self.n_iters = n_iters
-        self.sample = np.zeros( ( self.n_iters, self.d ) )
-        self.grad_sample = np.zeros( ( self.n_iters, self.d ) )
-
+        self.init_chain(n_iters)
+
+        self.metrics = metrics if metrics is not None else Metrics( stream = sys.stdout )
+        self.evaluation = evaluation
+        self.checkpointer = checkpointer
+        self.stopping = stopping
+        self.probe = probe
+        self.gradient_variance = []
+        self.schedule = None
         self.fitter = SGD(self,stepsize,minibatch_size,n_iters)
         print "Fitting using optimization procedure"
-        print "{0}\t{1}".format( "iteration", "Test log loss" )
+        self.run_fitter(n_iters)
+
+
+    def resume(self,checkpointer,metrics=None,evaluation=None,stopping=None,backend='numpy',
+            probe=None):
+        """
+        Continue a fit from the last checkpoint written by checkpointer.
+
+        The object should hold the same data as the one which was checkpointed; BlockData
+        is put back in its checkpointed shuffle. The chain continues exactly as if the fit
+        had not been interrupted.
+
+        Parameters:
+        checkpointer - Checkpointer object pointing at the checkpoint to resume from
+        metrics - Metrics object used to record progress, by default records are 
+                written to stdout as JSON lines (optional)
+        evaluation - 'thread' or 'process' to evaluate the test log loss in a background
+                worker while sampling continues, None evaluates synchronously (optional)
+        stopping - StoppingRule object used to end the fit once a target ESS, MCSE or 
+                compute budget is reached (optional)
+        probe - GradientProbe object used to record the variance of the gradient estimates
+                in self.gradient_variance (optional)
+        backend - 'numpy', or 'numba' to continue an SGLD fit using the fused compiled 
+                kernel (optional)
+        """
+        state, tables = checkpointer.load()
+        self.beta = state['beta']
+        self.beta_mode = state['beta_mode']
+        if 'full_post' in state:
+            self.full_post = state['full_post']
+        if 'loglik_mode' in state:
+            self.loglik_mode = state['loglik_mode']
+        if 'prior_scale' in state:
+            self.prior_scale = float( state['prior_scale'] )
+        self.training_loss = state['training_loss'].tolist()
+        if 'gradient_variance' in state:
+            self.gradient_variance = state['gradient_variance'].tolist()
+        self.loss_thinning = int( state['loss_thinning'] )
+        # A maximum number of iterations of -1 means the fit is only ended by a StoppingRule
+        self.n_iters = int( state['n_iters'] )
+        if self.n_iters < 0:
+            self.n_iters = None
+        self.sample = tables.pop('sample')
+        self.grad_sample = tables.pop('grad_sample')
+        # Put BlockData rows back in the checkpointed order before anything is drawn
+        if 'block_permutation' in tables:
+            self.data.set_permutation( tables.pop('block_permutation') )
+        self.sampling_time = float( state['sampling_time'] )
+        self.diagnostics = diagnostics_from_chain( self.sample[:int( state['iter'] ),:] )
+
+        self.metrics = metrics if metrics is not None else Metrics( stream = sys.stdout )
+        self.evaluation = evaluation
+        self.checkpointer = checkpointer
+        self.stopping = stopping
+        self.probe = probe
+        self.schedule = None
+        fitters = { 'ZVSGLD' : ZVSGLD, 'SGD' : SGD }
+        if str( state['fitter'] ) == 'ZVSGLD':
+            tables['backend'] = backend
+        self.fitter = fitters[str( state['fitter'] )]( self, float( state['epsilon'] ), 
+                int( state['minibatch_size'] ), self.n_iters, **tables )
+        self.fitter.restore_state( state )
+        if 'pending_minibatch' in state:
+            self.data.request( state['pending_minibatch'] )
+        if 'block_chunks' in state:
+            self.data.chunk_size = int( state['block_chunk_size'] )
+            self.data.chunks = list( state['block_chunks'] )
+        np.random.set_state( state['rng'] )
+        print "Resuming from iteration {0}...".format( self.fitter.iter )
+        self.run_fitter( self.n_iters, self.fitter.iter + 1 )
+
+
+    def append(self,X_new,y_new,row_weights=None):
+        """
+        Append new observations to the training data.
+
+        The data source and N are updated, as is the state of the current fitter: the cached 
+        full data gradient at the mode for SGLD, without another pass over the old data. 
+        The chain can then be continued using continue_fit. The mode isn't updated, which 
+        keeps the control variates unbiased, though less effective if the mode moves a lot.
+
+        Parameters:
+        X_new - matrix of explanatory variables of the new observations (dense or sparse)
+        y_new - vector of response variables of the new observations
+        row_weights - weight of each new observation in the likelihood, if the training data 
+                is weighted (optional)
+        """
+        if self.data is None:
+            raise ValueError( "the training data was dropped by a distributed fit" )
+        start = self.N
+        self.data.append( X_new, y_new, row_weights )
+        self.N = self.data.N
+        if self.fitter is not None:
+            X, y = self.data.rows( np.arange( start, self.N ) )
+            weights = None
+            if self.data.row_weights is not None:
+                weights = self.data.row_weights[start:]
+            self.fitter.append( self, X, y, weights )
+
+
+    def continue_fit(self,n_iters,stopping=None):
+        """
+        Continue the current chain from its last state, e.g. once new data has been appended.
+
+        Parameters:
+        n_iters - maximum number of additional iterations, can be None if stopping is set
+        stopping - StoppingRule object used to end the fit (optional)
+        """
+        if n_iters is not None:
+            n_iters += self.fitter.iter
+        self.n_iters = n_iters
+        self.stopping = stopping
+        print "Continuing from iteration {0}...".format( self.fitter.iter )
+        self.run_fitter( n_iters, self.fitter.iter + 1 )
+
+
+    def checkpoint_state(self):
+        """Return the state of the fit which is not held in the chain, used by Checkpointer"""
+        state = { 'beta' : self.beta, 'beta_mode' : self.beta_mode, 
+                'training_loss' : np.array( self.training_loss ), 
+                'gradient_variance' : np.array( self.gradient_variance ).reshape( -1, 3 ), 
+                'loss_thinning' : self.loss_thinning, 
+                'n_iters' : self.n_iters if self.n_iters is not None else -1, 
+                'sampling_time' : self.sampling_time, 'prior_scale' : self.prior_scale }
+        if self.full_post is not None:
+            state['full_post'] = self.full_post
+        if self.loglik_mode is not None:
+            state['loglik_mode'] = self.loglik_mode
+        # Minibatch already drawn by a PrefetchReader, but not yet used
+        if getattr( self.data, 'pending', None ) is not None:
+            state['pending_minibatch'] = self.data.pending
+        # Chunks left in the current epoch of BlockData
+        if getattr( self.data, 'chunk_size', None ) is not None:
+            state['block_chunk_size'] = self.data.chunk_size
+            state['block_chunks'] = np.array( self.data.chunks, dtype = int )
+        return state
+
+
+    def init_chain(self,n_iters,capacity=1000):
+        """
+        Allocate storage for the chain and its gradients, which grows as the chain gets longer.
+
+        Parameters:
+        n_iters - maximum number of iterations, None if the fit is only ended by a StoppingRule
+        capacity - number of iterations to allocate storage for initially (optional)
+        """
+        self.n_iters = n_iters
+        if n_iters is not None:
+            capacity = min( n_iters, capacity )
+        self.sample = np.zeros( ( capacity, self.d ) )
+        self.grad_sample = np.zeros( ( capacity, self.d ) )
+
+
+    def grow_chain(self):
+        """Double the storage for the chain and its gradients, up to n_iters iterations"""
+        capacity = self.sample.shape[0]
+        extra = capacity
+        if self.n_iters is not None:
+            extra = min( capacity, self.n_iters - capacity )
+        self.sample = np.concatenate( ( self.sample, np.zeros( ( extra, self.d ) ) ) )
+        self.grad_sample = np.concatenate( ( self.grad_sample, np.zeros( ( extra, self.d ) ) ) )
+
+
+    def run_fitter(self,n_iters,start=1):
+        """
+        Run the current fitter for n_iters iterations, storing the chain as it goes.
+
+        Every loss_thinning iterations the log loss on the test set is calculated and
+        a record is emitted to self.metrics; without a test set the log loss is nan. The
+        elapsed time stored in training_loss is the sampling time since the last record,
+        excluding the time spent evaluating.
+        If self.evaluation is set, snapshots of beta are evaluated by a background worker
+        while the chain keeps running. Online convergence diagnostics are updated every
+        iteration and summarised in each record. If self.stopping is set the fit ends as soon
+        as one of its targets is reached, after which the chain storage is trimmed and
+        self.n_iters holds the number of iterations actually run.
+
+        Parameters:
+        n_iters - maximum number of iterations to run the fitter for, None for no maximum
+        start - iteration to start from, greater than 1 when resuming (optional)
+        """
+        if start == 1:
+            self.diagnostics = OnlineDiagnostics( self.d )
+            self.sampling_time = 0.0
+        evaluator = None
+        if self.evaluation is not None and self.X_test is not None:
+            evaluator = AsyncEvaluator( self.X_test, self.y_test, self.evaluation, 
+                    self.test_weights, self.test_loss )
+        if self.stopping is not None:
+            self.stopping.start(self)
+        if n_iters is None:
+            iterations = itertools.count(start)
+        else:
+            iterations = xrange(start,n_iters+1)
+        completed = start - 1
         timer = Stopwatch()
-        for self.fitter.iter in range(1,n_iters+1):
-            # Every so often output log loss and elapsed time on test set and store 
+        # Time spent probing the gradient variance since the last record, not counted as sampling
+        probe_timer = Stopwatch()
+        probe_time = 0.0
+        for self.fitter.iter in iterations:
+            if self.fitter.iter > self.sample.shape[0]:
+                self.grow_chain()
+            # Every so often store log loss on test set and sampling time
             if self.fitter.iter % self.loss_thinning == 0:
-                elapsed_time = timer.toc()
-                current_loss = self.logloss()
-                self.training_loss.append( [current_loss,elapsed_time] )
-                print "{0}\t\t{1}\t\t{2}".format( self.fitter.iter, current_loss, elapsed_time )
+                elapsed_time = timer.toc() - probe_time
+                probe_time = 0.0
+                self.sampling_time += elapsed_time
+                if evaluator is None:
+                    current_loss = np.nan
+                    if self.X_test is not None:
+                        self.metrics.tic('evaluation')
+                        current_loss = self.logloss()
+                        self.metrics.toc('evaluation')
+                    self.training_loss.append( [current_loss,elapsed_time] )
+                    self.metrics.emit( self.fitter.iter, test_log_loss = current_loss, 
+                            elapsed_time = elapsed_time, **self.live_diagnostics() )
+                else:
+                    evaluator.submit( self.fitter.iter, self.beta, elapsed_time )
+                    self.store_evaluations( evaluator.results() )
                 timer.tic()
+            probing = self.probe is not None and self.probe.due( self.fitter.iter )
+            # Parameters the update's gradient estimate is calculated at, for the probe and schedule
+            if probing or self.schedule is not None:
+                beta = self.beta.copy()
             self.fitter.update(self)
+            if probing:
+                probe_timer.tic()
+                self.metrics.tic('probe')
+                self.probe.record( self, beta )
+                self.metrics.toc('probe')
+                probe_time += probe_timer.toc()
+            if self.schedule is not None and self.fitter.iter % self.schedule.every == 0:
+                self.schedule.update( self, beta )
+            self.metrics.tic('storage')
             self.sample[(self.fitter.iter-1),:] = self.beta
+            self.metrics.toc('storage')
+            self.metrics.tic('diagnostics')
+            self.diagnostics.update(self.beta)
+            self.metrics.toc('diagnostics')
+            if self.checkpointer is not None and self.fitter.iter % self.checkpointer.every == 0:
+                if evaluator is not None:
+                    self.store_evaluations( evaluator.results( block = True ) )
+                self.metrics.tic('checkpoint')
+                self.checkpointer.save(self)
+                self.metrics.toc('checkpoint')
+            completed = self.fitter.iter
+            if self.stopping is not None and self.stopping.done(self):
+                print "Stopping at iteration {0}: {1}".format( completed, self.stopping.reason )
+                break
+        if evaluator is not None:
+            self.store_evaluations( evaluator.close() )
+        # Drop unused storage if the fit was stopped early
+        self.n_iters = completed
+        self.sample = self.sample[:completed,:]
+        self.grad_sample = self.grad_sample[:completed,:]
+
+
+    def store_evaluations(self,results):
+        """
+        Store test log loss values returned by an AsyncEvaluator.
+
+        Parameters:
+        results - list of results returned by AsyncEvaluator.results
+        """
+        for result in results:
+            self.training_loss.append( [result['test_log_loss'],result['elapsed_time']] )
+            self.metrics.emit( result['iteration'], test_log_loss = result['test_log_loss'],
+                    elapsed_time = result['elapsed_time'], 
+                    evaluation_time = result['evaluation_time'], **self.live_diagnostics() )
+
+
+    def live_diagnostics(self):
+        """
+        Summarise the online convergence diagnostics of the current fit.
+
+        Returns:
+        summary - dictionary with the minimum ESS, maximum MCSE and maximum split R-hat over
+                coordinates, and the minimum ESS per second of sampling time
+        """
+        ess = self.diagnostics.ess()
+        summary = { 'min_ess' : float( ess.min() ), 
+                'max_mcse' : float( self.diagnostics.mcse().max() ),
+                'max_rhat' : float( np.max( self.diagnostics.rhat() ) ), 
+                'ess_per_second' : 0.0 }
+        if self.sampling_time > 0:
+            summary['ess_per_second'] = summary['min_ess'] / self.sampling_time
+        return summary
+
+
+    def summary(self,thin=10):
+        """
+        Summarise the fitted chain for prediction.
+
+        Parameters:
+        thin - keep every thin-th iteration of the chain in the summary (optional)
+
+        Returns:
+        summary - PosteriorSummary object holding a thinned sample, the posterior mean
+                and covariance
+        """
+        return PosteriorSummary( self.sample, thin )
+
+
+    def stein_discrepancy(self,thin=10,recompute=False,approximate=False,chunk_size=100):
+        """
+        Calculate the kernel Stein discrepancy of the fitted chain, a measure of sample quality.
+
+        Parameters:
+        thin - use every thin-th iteration of the chain (optional)
+        recompute - recompute the full data log posterior gradient at each point, in batches;
+                otherwise the gradient estimates stored in self.grad_sample are used, whose
+                minibatch noise inflates the discrepancy (optional)
+        approximate - use the linear time random feature approximation rather than the
+                exact discrepancy, which is quadratic in the number of points (optional)
+        chunk_size - number of points whose gradients are recomputed in each pass (optional)
+
+        Returns:
+        ksd - the kernel Stein discrepancy, see stein.py
+        """
+        sample = self.sample[::thin,:]
+        if recompute:
+            gradients = np.concatenate( [ self.full_gradients( sample[start:start+chunk_size,:] )
+                    for start in xrange(0,sample.shape[0],chunk_size) ] )
+        else:
+            gradients = self.grad_sample[::thin,:]
+        if approximate:
+            return random_feature_ksd( sample, gradients )
+        return kernel_stein_discrepancy( sample, gradients, pool = self.pool )
 
 
     def logloss(self):
         """Calculate the log loss on the test set, used to check convergence"""
-        y_pred = np.zeros(self.test_size, dtype = int)
-        for i in range(self.test_size):
-            x = np.squeeze( np.copy( self.X_test[i,:] ) )
-            y_pred[i] = int( np.dot( self.beta, x ) >= 0.0 )
-        return log_loss( self.y_test, y_pred )
+        return self.test_loss( self.beta, self.X_test, self.y_test, self.pool, self.test_weights )
 
 
     def loglossp(self,beta):
@@ -151,11 +602,115 @@ class LogisticRegression:
         Parameters:
         beta - a vector of logistic regression parameters (float array)
         """
-        y_pred = np.zeros(self.test_size, dtype = int)
-        for i in range(self.test_size):
-            x = np.squeeze( np.copy( self.X_test[i,:] ) )
-            y_pred[i] = int( np.dot( beta, x ) >= 0.0 )
-        return log_loss( self.y_test, y_pred )
+        return self.test_loss( beta, self.X_test, self.y_test, self.pool, self.test_weights )
+
+
+    def dloglik(self,beta,X,y,weights=None):
+        """
+        Calculate gradient of the log likelihood wrt the parameters, summed over a block of data
+
+        Parameters:
+        beta - vector of logistic regression parameters to calculate the gradient at
+        X - dense block of explanatory variables
+        y - vector of response variables for the block
+        weights - weight of each row of the block, None if rows are unweighted (optional)
+
+        Returns:
+        dlogbeta - gradient of the log likelihood of the block wrt the parameter beta
+        """
+        # Handle overflow gracefully by catching numpy's error
+        # (seterr was defined at start of class)
+        residuals = y - 1 / ( 1 + np.exp( - np.dot( X, beta ) ) )
+        if weights is not None:
+            residuals = weights * residuals
+        return np.dot( residuals, X )
+
+
+    def full_gradient(self,beta):
+        """
+        Calculate the full data log posterior gradient at beta, in blocks on self.pool
+
+        During a distributed fit, the training data is held by the workers, which calculate it.
+
+        Parameters:
+        beta - vector of logistic regression parameters to calculate the gradient at
+        """
+        if self.data is None:
+            dlogbeta = self.fitter.loglik_gradient( beta )
+        else:
+            dlogbeta = self.pool.sum( lambda X, y, weights : self.dloglik( beta, X, y, weights ), 
+                    self.data.weighted_blocks( self.pool.block_size ) )
+        # Add gradient of log prior (assume Laplace prior with scale 1)
+        return dlogbeta - self.prior_scale * np.sign(beta)
+
+
+    def full_gradients(self,betas):
+        """
+        Calculate the full data log posterior gradient at a batch of parameter values, in one pass
+
+        Each block of data is multiplied by every parameter vector in a single matrix product.
+
+        Parameters:
+        betas - array of shape (n, d), each row holding parameter values
+
+        Returns:
+        gradients - array of shape (n, d) holding the gradient at each row of betas
+        """
+        def block_gradients(X,y,weights):
+            residuals = y[:,np.newaxis] - 1 / ( 1 + np.exp( - np.dot( X, betas.T ) ) )
+            if weights is not None:
+                residuals *= weights[:,np.newaxis]
+            return np.dot( residuals.T, X )
+        dlogbeta = self.pool.sum( block_gradients, self.data.weighted_blocks( self.pool.block_size ) )
+        # Add gradient of log prior (assume Laplace prior with scale 1)
+        return dlogbeta - self.prior_scale * np.sign(betas)
+
+
+    def row_variance(self,beta,X,y,weights=None,beta_ref=None):
+        """
+        Estimate the variance of each coordinate of the log likelihood gradient of a single row.
+
+        A minibatch estimate of the log likelihood gradient is N / m times the sum of the 
+        (weighted) gradients of m rows, so its variance is N^2 / m times the row variance.
+
+        Parameters:
+        beta - vector of logistic regression parameters to calculate the gradients at
+        X - dense minibatch of explanatory variables
+        y - vector of response variables for the minibatch
+        weights - weight of each row of the minibatch, None if rows are unweighted (optional)
+        beta_ref - control variate point, whose gradient is subtracted from each row's (optional)
+
+        Returns:
+        variance - vector holding the variance of each coordinate over the rows
+        """
+        residuals = y - 1 / ( 1 + np.exp( - np.dot( X, beta ) ) )
+        if beta_ref is not None:
+            residuals -= y - 1 / ( 1 + np.exp( - np.dot( X, beta_ref ) ) )
+        if weights is not None:
+            residuals = weights * residuals
+        contributions = residuals[:,np.newaxis] * X
+        return contributions.var( axis = 0, ddof = 1 )
+
+
+    def dloglik_blocks(self,beta,X,y,weights=None):
+        """
+        Calculate gradient of the log likelihood summed over a minibatch, split into blocks.
+
+        Minibatches larger than the block size of self.pool are evaluated in parallel.
+
+        Parameters:
+        beta - vector of logistic regression parameters to calculate the gradient at
+        X - dense minibatch of explanatory variables
+        y - vector of response variables for the minibatch
+        weights - weight of each row of the minibatch, None if rows are unweighted (optional)
+        """
+        if X.shape[0] <= self.pool.block_size:
+            return self.dloglik( beta, X, y, weights )
+        if weights is None:
+            return self.pool.sum( lambda X_block, y_block : self.dloglik( beta, X_block, y_block ),
+                    self.pool.split( X, y ) )
+        return self.pool.sum( lambda X_block, y_block, w_block : self.dloglik( beta, X_block, 
+                y_block, w_block ), self.pool.split( X, y, weights ) )
 
 
     def dlogpost(self,sgld):
@@ -163,24 +718,17 @@ class LogisticRegression:
         Calculate gradient of the log posterior wrt the parameters using a minibatch of data
 
         Parameters:
-        sgld - a StochasticGradientLangevinDynamics object, used to specify the minibatch
+        sgld - a StochasticGradientLangevinDynamics object, holding the gathered minibatch
 
         Returns:
         dlogbeta - gradient of the log likelihood wrt the parameter beta 
         """
-        dlogbeta = np.zeros( self.d )
         # Calculate sum of gradients at each point in the minibatch
-        for i in sgld.minibatch:
-            x = np.squeeze( np.copy( self.X[i,:] ) )
-            y = self.y[i]
-            # Calculate gradient of the log density at current point, use to update dlogbeta
-            # Handle overflow gracefully by catching numpy's error
-            # (seterr was defined at start of class)
-            dlogbeta += ( y - 1 / ( 1 + np.exp( - np.dot( self.beta, x ) ) ) ) * x
+        dlogbeta = self.dloglik_blocks( self.beta, sgld.X_batch, sgld.y_batch, sgld.w_batch )
         # Adjust log density gradients so they're unbiased
-        dlogbeta *= self.N / sgld.minibatch_size
+        dlogbeta *= float( self.N ) / sgld.minibatch_size
         # Add gradient of log prior (assume Laplace prior with scale 1)
-        dlogbeta -= np.sign(self.beta)
+        dlogbeta -= self.prior_scale * np.sign(self.beta)
         return dlogbeta
 
 
@@ -189,30 +737,54 @@ class LogisticRegression:
         Calculate gradient of the log posterior wrt the parameters using a minibatch of data
 
         Parameters:
-        sgld - a StochasticGradientLangevinDynamics object, used to specify the minibatch
+        sgld - a StochasticGradientLangevinDynamics object, holding the gathered minibatch
 
         Returns:
         dlogbeta - gradient of the log likelihood wrt the parameter beta 
+        dlogbetaopt - gradient of the log likelihood at beta_mode using the same minibatch
         """
-        dlogbeta = np.zeros( self.d )
-        dlogbetaopt = np.zeros( self.d )
         # Calculate sum of gradients at each point in the minibatch
-        for i in sgld.minibatch:
-            x = np.squeeze( np.copy( self.X[i,:] ) )
-            y = self.y[i]
-            # Calculate gradient of the log density at current point, use to update dlogbeta
-            # Handle overflow gracefully by catching numpy's error
-            # (seterr was defined at start of class)
-            dlogbeta += ( y - 1 / ( 1 + np.exp( - np.dot( self.beta, x ) ) ) ) * x
-            dlogbetaopt += ( y - 1 / ( 1 + np.exp( - np.dot( self.beta_mode, x ) ) ) ) * x
+        dlogbeta = self.dloglik_blocks( self.beta, sgld.X_batch, sgld.y_batch, sgld.w_batch )
+        dlogbetaopt = self.dloglik_blocks( self.beta_mode, sgld.X_batch, sgld.y_batch, 
+                sgld.w_batch )
         # Adjust log density gradients so they're unbiased
-        dlogbeta *= self.N / sgld.minibatch_size
-        dlogbetaopt *= self.N / sgld.minibatch_size
+        dlogbeta *= float( self.N ) / sgld.minibatch_size
+        dlogbetaopt *= float( self.N ) / sgld.minibatch_size
+        return self.add_prior_cv( dlogbeta, dlogbetaopt )
+
+
+    def add_prior_cv(self,dlogbeta,dlogbetaopt):
+        """
+        Add the log prior gradient to unbiased log likelihood gradient estimates at beta and beta_mode
+
+        Parameters:
+        dlogbeta - estimate of the full data log likelihood gradient at self.beta
+        dlogbetaopt - estimate of the full data log likelihood gradient at self.beta_mode
+
+        Returns:
+        dlogbeta - estimate of the log posterior gradient at self.beta
+        dlogbetaopt - estimate of the log posterior gradient at self.beta_mode
+        """
         # Add gradient of log prior (assume Laplace prior with scale 1)
-        dlogbeta -= np.sign(self.beta)
-        dlogbetaopt -= np.sign(self.beta_mode)
+        dlogbeta -= self.prior_scale * np.sign(self.beta)
+        dlogbetaopt -= self.prior_scale * np.sign(self.beta_mode)
         return dlogbeta, dlogbetaopt
 
 
-    def postprocess(self):
-        return self.fitter.control_variates(self)
+    def postprocess(self,degree=1):
+        return self.fitter.control_variates(self,degree)
+
+
+    def postprocess_functionals(self,values,degree=1):
+        """
+        Apply zero variance control variates to a batch of functionals of the fitted chain.
+
+        Parameters:
+        values - array of shape (n_iters, m), each column holding a functional at every 
+                iteration, e.g. from zero_variance.predictive_values( lr.sample, X )
+        degree - degree of the polynomial control variates, 1 or 2 (optional)
+
+        Returns:
+        corrected - array of shape (n_iters, m) holding the corrected functionals
+        """
+        return ZeroVariance( self.grad_sample, self.sample, degree ).correct( values )
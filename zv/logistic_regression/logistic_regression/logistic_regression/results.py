@@ -0,0 +1,332 @@
+"""
+An appendable store of simulation results, in place of a small text file for every run.
+
+A store is a directory of binary part files. Each append writes its records as a new
+part, a .npz file holding one array per column with a row per record. Parts are written
+to a temporary file and renamed into place, so any number of workers can append at once
+without locks, and readers never see a partial part. Records hold the run metadata
+(method, stepsize, seed, N, timings) as scalar columns next to array columns such as the
+training loss. Columns are stored separately, so a query only reads the columns it needs,
+and a whole sweep is loaded in one call. compact merges many small parts into one.
+
+Parts needn't share a schema: a column missing from some records is filled in when
+loaded, and array columns whose records differ in shape, such as the training loss of
+runs stopped early, are loaded as object arrays holding each record's array.
+"""
+import os
+import socket
+import time
+import numpy as np
+
+
+class ResultStore:
+    """
+    Directory of part files, each holding a batch of records as columns.
+
+    Every record gets a written column, the time at which it was appended. Column names
+    starting with an underscore are reserved for the store.
+    """
+
+    def __init__(self,path):
+        """
+        Open the store, creating its directory if needed.
+
+        Parameters:
+        path - directory holding the store
+        """
+        self.path = path
+        try:
+            os.makedirs( path )
+        except OSError:
+            pass
+        # Number of parts written by this object, keeps part names unique within a process
+        self.n_written = 0
+
+
+    def append(self,**record):
+        """
+        Append a single record.
+
+        Parameters:
+        record - value of each column for the record, a scalar, string or array, e.g.
+                method = 'sgld', stepsize = 1e-5, seed = 1, training_loss = lr.training_loss
+        """
+        self.extend( **dict( ( name, np.asarray( value )[np.newaxis] )
+                for name, value in record.items() ) )
+
+
+    def extend(self,**columns):
+        """
+        Append a batch of records as a single part.
+
+        Parameters:
+        columns - arrays whose first axis runs over the records, e.g. the results of
+                batch_postprocess; scalars are repeated for every record. Records of an
+                array column with different shapes must be appended separately
+        """
+        n_records = max( [ len( np.asarray( value ) ) for value in columns.values()
+                if np.ndim( value ) > 0 ] or [ 1 ] )
+        part = {}
+        for name, value in columns.items():
+            value = np.asarray( value )
+            if value.ndim == 0:
+                value = np.repeat( value, n_records )
+            if value.dtype == object:
+                raise ValueError( "column {0} has records of different shapes".format( name ) )
+            if len( value ) != n_records:
+                raise ValueError( "column {0} has {1} records, expected {2}".format(
+                        name, len( value ), n_records ) )
+            part[name] = value
+        part['written'] = np.repeat( time.time(), n_records )
+        self.write_part( self.new_name( 'part' ), part )
+
+
+    def load(self,columns=None,**where):
+        """
+        Load matching records from every part, concatenating each column.
+
+        Parameters:
+        columns - list of columns to load, by default every column in the store (optional)
+        where - conditions on scalar columns, each a value or a list of allowed values, e.g.
+                method = 'sgld', stepsize = [ 1e-5, 3e-5 ] (optional)
+
+        Returns:
+        results - dict mapping each column to an array with a row per matching record,
+                empty if the store holds no records, see concatenate_parts; parts holding
+                none of the columns are skipped
+        """
+        while True:
+            names = self.part_names()
+            try:
+                parts = [ self.read_part( name, columns, where ) for name in names ]
+                break
+            except IOError:
+                # Parts removed by compaction after they were listed, list them again
+                if all( os.path.exists( os.path.join( self.path, name ) ) for name in names ):
+                    raise
+        return concatenate_parts( parts, columns )
+
+
+    def aggregate(self,column,by,func=np.mean,**where):
+        """
+        Summarise a column over groups of records with the same metadata.
+
+        Parameters:
+        column - column to summarise, e.g. 'llnew'
+        by - list of scalar columns defining the groups, e.g. [ 'method', 'stepsize' ]
+        func - function called as func( values, axis = 0 ) on the rows of each group, e.g.
+                np.nanmean if the column is missing from some records (optional)
+        where - conditions selecting records, as for load (optional)
+
+        Returns:
+        summary - dict mapping a tuple of the values of the by columns to the summary of
+                the group
+        """
+        results = self.load( [ column ] + list( by ), **where )
+        if not results:
+            return {}
+        groups = {}
+        for row, key in enumerate( zip( *[ results[name].tolist() for name in by ] ) ):
+            groups.setdefault( key, [] ).append( row )
+        summary = {}
+        for key, rows in groups.items():
+            values = results[column][rows]
+            if values.dtype == object:
+                # Records of different shapes, which must agree within a group
+                values = np.array( list( values ) )
+            summary[key] = func( values, axis = 0 )
+        return summary
+
+
+    def compact(self):
+        """
+        Merge every part into one, so later loads open a single file.
+
+        The merged part lists the parts it replaces, which readers skip, before they are
+        deleted, so records are never seen twice or lost. Array columns loaded as object
+        arrays are stored as their flattened values and the shape of each record. Appends
+        can continue while compacting, but only one process should compact a store at a time.
+        """
+        names = self.part_names()
+        if len( names ) <= 1:
+            return
+        # Merge exactly the parts listed, parts appended meanwhile are left as they are
+        merged = concatenate_parts( [ self.read_part( name, None, {} ) for name in names ] )
+        part = {}
+        for name, values in merged.items():
+            if values.dtype == object:
+                part['_shapes_' + name], part['_values_' + name] = encode_ragged( values )
+            else:
+                part[name] = values
+        part['_replaces'] = np.array( names )
+        # Named with the time of the oldest part it replaces, so it sorts where its records did
+        self.write_part( self.new_name( 'compacted', part_time( names[0] ) ), part )
+        for name in names:
+            os.remove( os.path.join( self.path, name ) )
+
+
+    def part_names(self):
+        """
+        Return the names of the parts in the store, oldest first, skipping replaced parts.
+
+        Parts are ordered by the time in their names, which for a compacted part is the time
+        of the oldest part it replaces, so records load in the order they were appended.
+        """
+        names = sorted( ( name for name in os.listdir( self.path ) if name.endswith( '.npz' ) ),
+                key = lambda name : ( part_time( name ), name ) )
+        replaced = set()
+        for name in names:
+            if name.startswith( 'compacted-' ):
+                with open( os.path.join( self.path, name ), 'rb' ) as part_file:
+                    replaced.update( np.load( part_file )['_replaces'].tolist() )
+        return [ name for name in names if name not in replaced ]
+
+
+    def read_part(self,name,columns,where):
+        """
+        Read the matching records of part name.
+
+        Returns:
+        part - pair ( n_records, columns ), columns a dict holding the requested columns
+                present in the part, or None if no records match
+        """
+        with open( os.path.join( self.path, name ), 'rb' ) as part_file:
+            stored = np.load( part_file )
+            ragged = [ key[len('_shapes_'):] for key in stored.files
+                    if key.startswith( '_shapes_' ) ]
+            available = [ key for key in stored.files if not key.startswith( '_' ) ] + ragged
+            if columns is None:
+                columns = available
+            matches = None
+            for key, allowed in where.items():
+                if key not in available:
+                    return None
+                if key in ragged:
+                    raise ValueError( "conditions only apply to scalar columns" )
+                match = np.in1d( stored[key], np.atleast_1d( allowed ) )
+                matches = match if matches is None else matches & match
+            # Every part has the written column, giving its number of records
+            n_records = len( stored['written'] ) if matches is None else matches.sum()
+            if n_records == 0:
+                return None
+            part = {}
+            for key in columns:
+                if key in ragged:
+                    values = decode_ragged( stored['_shapes_' + key], stored['_values_' + key] )
+                elif key in available:
+                    values = stored[key]
+                else:
+                    continue
+                part[key] = values if matches is None else values[matches]
+            return n_records, part
+
+
+    def new_name(self,prefix,created=None):
+        """Return a part name unique across hosts, processes and calls, holding created or now"""
+        self.n_written += 1
+        if created is None:
+            created = time.time()
+        return "{0}-{1:017.6f}-{2}-{3}-{4}.npz".format( prefix, created,
+                socket.gethostname(), os.getpid(), self.n_written )
+
+
+    def write_part(self,name,part):
+        """Atomically write the part file name holding the arrays in part"""
+        path = os.path.join( self.path, name )
+        # The temporary name doesn't end in .npz, so readers never list it
+        temp_path = path + '.tmp'
+        with open( temp_path, 'wb' ) as out:
+            np.savez( out, **part )
+            out.flush()
+            os.fsync( out.fileno() )
+        os.rename( temp_path, path )
+
+
+def part_time(name):
+    """Return the time held in the part name, see ResultStore.new_name"""
+    return float( name.split( '-' )[1] )
+
+
+def concatenate_parts(parts,columns=None):
+    """
+    Concatenate each column over a list of parts, skipping parts which are None.
+
+    Parts holding none of the columns are skipped. Where a part lacks a scalar column, its
+    records get NaN, or the empty string if the column holds strings. Array columns whose
+    records differ in shape or are missing from some parts give an object array, holding
+    each record's array or None.
+
+    Parameters:
+    parts - list of parts as returned by ResultStore.read_part
+    columns - list of columns to keep, by default every column of any part (optional)
+    """
+    parts = [ part for part in parts if part is not None ]
+    if columns is None:
+        columns = sorted( set().union( *[ part.keys() for n_records, part in parts ] ) )
+    parts = [ ( n_records, part ) for n_records, part in parts
+            if any( name in part for name in columns ) ]
+    if not parts:
+        return {}
+    return dict( ( name, merge_column( [ ( n_records, part.get( name ) )
+            for n_records, part in parts ] ) ) for name in columns )
+
+
+def merge_column(pieces):
+    """
+    Concatenate the records of a column from several parts, see concatenate_parts.
+
+    Parameters:
+    pieces - list of pairs ( n_records, values ), values None if the part lacks the column
+    """
+    present = [ values for n_records, values in pieces if values is not None ]
+    if ( len( present ) == len( pieces ) and all( values.dtype != object for values in present )
+            and len( set( values.shape[1:] for values in present ) ) == 1 ):
+        return np.concatenate( present )
+    scalar = all( values.ndim == 1 and values.dtype != object for values in present )
+    kinds = set( values.dtype.kind for values in present )
+    if scalar and kinds <= set( 'biuf' ):
+        return np.concatenate( [ np.repeat( np.nan, n_records ) if values is None
+                else values.astype(float) for n_records, values in pieces ] )
+    if scalar and len( kinds ) == 1 and kinds <= set( 'SU' ):
+        return np.concatenate( [ np.repeat( np.array( '', dtype = present[0].dtype.kind ),
+                n_records ) if values is None else values for n_records, values in pieces ] )
+    records = []
+    for n_records, values in pieces:
+        records += [ None ] * n_records if values is None else list( values )
+    merged = np.empty( len( records ), dtype = object )
+    # Assign one at a time, so numpy doesn't broadcast records of the same shape
+    for index, record in enumerate( records ):
+        merged[index] = record
+    return merged
+
+
+def encode_ragged(records):
+    """
+    Encode an object array of record arrays for storage without pickling.
+
+    Returns:
+    shapes - integer array with a row per record, 1 if it is present then its shape
+    values - the present records flattened and concatenated
+    """
+    present = [ np.asarray( record ) for record in records if record is not None ]
+    ndims = set( record.ndim for record in present )
+    if len( ndims ) > 1:
+        raise ValueError( "records of a column must have the same number of dimensions" )
+    shapes = np.zeros( ( len( records ), 1 + ( ndims.pop() if ndims else 0 ) ), dtype = int )
+    for index, record in enumerate( records ):
+        if record is not None:
+            shapes[index,:] = ( 1, ) + np.shape( record )
+    values = np.concatenate( [ record.ravel() for record in present ] ) if present else np.zeros(0)
+    return shapes, values
+
+
+def decode_ragged(shapes,values):
+    """Return the object array of record arrays encoded by encode_ragged"""
+    records = np.empty( len( shapes ), dtype = object )
+    offset = 0
+    for index, shape in enumerate( shapes ):
+        if shape[0]:
+            size = int( np.prod( shape[1:] ) )
+            records[index] = values[offset:offset+size].reshape( shape[1:] )
+            offset += size
+    return records
@@ -1,4 +1,3 @@
-import numpy as np
 import sys
 import pkg_resources
 from sklearn.metrics import log_loss
@@ -28,15 +27,15 @@ class SGD:
         lr - LogisticRegression object
         epsilon - the stepsize to perform SGD at
         minibatch_size - size of the minibatch used at each iteration
-        n_iter - the number of iterations to perform
+        n_iter - the maximum number of iterations to perform, None if there's no maximum
         """
         self.epsilon = epsilon
         # Set the minibatch size
         self.minibatch_size = minibatch_size
         self.sample_minibatch(lr)
-        # Hold number of iterations so far
+        # Hold number of iterations so far, and number of per-observation gradients evaluated
         self.iter = 1
-        self.output = np.zeros( ( n_iter, lr.d ) )
+        self.grad_evals = 0
 
 
     def update(self,lr):
@@ -50,15 +49,65 @@ class SGD:
         lr.beta - updates parameter values using SGLD
         lr.grad_sample - adds calculated gradient to storage
         """
+        lr.metrics.tic('minibatch')
         self.sample_minibatch(lr)
+        lr.metrics.toc('minibatch')
         # Calculate gradients at current point
+        lr.metrics.tic('gradient')
         dlogbeta = lr.dlogpost(self)
+        self.dlogbeta = dlogbeta
+        lr.metrics.toc('gradient')
+        self.grad_evals += self.minibatch_size
+        lr.metrics.count( 'grad_evals', self.minibatch_size )
+        lr.metrics.count( 'rows', self.minibatch_size )
         lr.grad_sample[self.iter-1,:] = dlogbeta
 
         # Update parameters using SGD
+        lr.metrics.tic('update')
         lr.beta += self.epsilon / 2 * dlogbeta
+        lr.metrics.toc('update')
+
+
+    def estimator_variance(self,lr,beta=None):
+        """
+        Estimate the variance of each coordinate of the gradient estimate from the current minibatch
+
+        Parameters:
+        lr - LogisticRegression object being fitted
+        beta - parameter values the last gradient estimate was calculated at, before the
+                update moved lr.beta; lr.beta by default (optional)
+        """
+        if beta is None:
+            beta = lr.beta
+        return lr.N**2 / float( self.minibatch_size ) * lr.row_variance( beta, self.X_batch, 
+                self.y_batch, self.w_batch )
+
+
+    def gradient_estimate(self,lr):
+        """Return the log posterior gradient estimate used by the last update"""
+        return self.dlogbeta
+
+
+    def checkpoint_state(self):
+        """Return the state of the fitter, used by Checkpointer"""
+        return { 'epsilon' : self.epsilon, 'minibatch_size' : self.minibatch_size, 
+                'iter' : self.iter, 'grad_evals' : self.grad_evals }
+
+
+    def restore_state(self,state):
+        """Restore the state of the fitter from a checkpoint"""
+        self.iter = int( state['iter'] )
+        self.grad_evals = int( state['grad_evals'] )
+
+
+    def append(self,lr,X,y,weights=None):
+        """SGD holds no per-row state, so nothing needs updating when rows are appended"""
+        pass
 
 
     def sample_minibatch(self,lr):
-        """Sample the next minibatch"""
-        self.minibatch = np.random.choice( np.arange( lr.N ), self.minibatch_size, replace = False )
+        """Sample the next minibatch and gather its rows and weights from the data source"""
+        self.minibatch, self.X_batch, self.y_batch = lr.data.minibatch( self.minibatch_size )
+        self.w_batch = None
+        if lr.data.weights is not None:
+            self.w_batch = lr.data.weights[self.minibatch]
@@ -0,0 +1,231 @@
+import numpy as np
+from logistic_regression import LogisticRegression
+from summary import PosteriorSummary
+
+
+class SoftmaxRegression(LogisticRegression):
+    """
+    Methods for performing Bayesian multinomial (softmax) regression for large datasets.
+
+    Each of the K classes has a weight vector, held as a column of the (d, K) parameter matrix
+    B, and P( y = k | x ) = exp( x B_k ) / sum_j exp( x B_j ). The parameters are stored
+    flattened as a vector of length d * K, so SGLD with control variates, SGD, checkpoints
+    and zero variance postprocessing work unchanged. The gradient of a block of rows is
+    calculated with two matrix products, X B for the class scores and X^T R for the
+    gradient, where R holds the residuals of every class. Probabilities use a stable
+    softmax. As for LogisticRegression the prior is Laplace with scale 1 on every parameter,
+    which also pins down the otherwise redundant softmax parameterisation.
+
+    Responses are class labels 0, ..., K - 1. The numba backend isn't supported.
+    """
+
+    fused_kernel = False
+
+
+    def __init__(self,X_train,X_test,y_train,y_test,n_classes=None,n_threads=1,
+            test_weights=None):
+        """
+        Initialise the softmax regression object.
+
+        Parameters:
+        X_train - matrix of explanatory variables for training, or a data source, in which
+                case y_train is ignored
+        X_test - matrix of explanatory variables for testing
+        y_train - vector of class labels for training
+        y_test - vector of class labels for testing
+        n_classes - number of classes K, by default one more than the largest label; needed
+                if X_train is a data source (optional)
+        n_threads - number of threads used for full data passes, large minibatches and
+                test set evaluation, None to use one per core (optional)
+        test_weights - weight of each test point in the test log loss (optional)
+        """
+        LogisticRegression.__init__(self,X_train,X_test,y_train,y_test,n_threads,test_weights)
+        if n_classes is None:
+            n_classes = int( max( np.max(y_train), np.max(y_test) ) ) + 1
+        self.n_classes = n_classes
+        self.n_features = self.data.d
+        # Parameters are the flattened ( n_features, n_classes ) matrix
+        self.d = self.n_features * n_classes
+        self.beta = np.random.rand(self.d)
+        self.beta_mode = np.zeros(self.d)
+        self.test_loss = softmax_logloss
+
+
+    def residuals(self,beta,X,y):
+        """
+        Calculate the residuals of each class for a block of data.
+
+        Parameters:
+        beta - vector of flattened softmax regression parameters
+        X - dense block of explanatory variables
+        y - vector of class labels for the block
+
+        Returns:
+        residuals - array of shape (len(y), K), the indicator of each row's class minus
+                its class probabilities
+        """
+        scores = np.dot( X, beta.reshape( self.n_features, self.n_classes ) )
+        # Subtract the largest score of each row so exp can't overflow; the probabilities
+        # of unlikely classes can underflow, which is harmless
+        scores -= scores.max( axis = 1 )[:,np.newaxis]
+        with np.errstate( under = 'ignore' ):
+            probabilities = np.exp(scores)
+            probabilities /= probabilities.sum( axis = 1 )[:,np.newaxis]
+        residuals = - probabilities
+        residuals[np.arange( len(y) ),np.asarray( y, dtype = int )] += 1
+        return residuals
+
+
+    def dloglik(self,beta,X,y,weights=None):
+        """
+        Calculate gradient of the log likelihood wrt the parameters, summed over a block of data
+
+        Parameters:
+        beta - vector of flattened softmax regression parameters
+        X - dense block of explanatory variables
+        y - vector of class labels for the block
+        weights - weight of each row of the block, None if rows are unweighted (optional)
+
+        Returns:
+        dlogbeta - flattened gradient of the log likelihood of the block
+        """
+        residuals = self.residuals( beta, X, y )
+        if weights is not None:
+            residuals *= weights[:,np.newaxis]
+        return np.dot( X.T, residuals ).ravel()
+
+
+    def row_variance(self,beta,X,y,weights=None,beta_ref=None):
+        """
+        Estimate the variance of each coordinate of the log likelihood gradient of a single row.
+
+        Parameters:
+        beta - vector of flattened softmax regression parameters
+        X - dense minibatch of explanatory variables
+        y - vector of class labels for the minibatch
+        weights - weight of each row of the minibatch, None if rows are unweighted (optional)
+        beta_ref - control variate point, whose gradient is subtracted from each row's (optional)
+
+        Returns:
+        variance - vector holding the variance of each coordinate over the rows
+        """
+        residuals = self.residuals( beta, X, y )
+        if beta_ref is not None:
+            residuals -= self.residuals( beta_ref, X, y )
+        if weights is not None:
+            residuals *= weights[:,np.newaxis]
+        contributions = X[:,:,np.newaxis] * residuals[:,np.newaxis,:]
+        return contributions.reshape( len(y), self.d ).var( axis = 0, ddof = 1 )
+
+
+    def full_gradients(self,betas):
+        """Calculate the full data log posterior gradient at each row of betas, one pass per row"""
+        return np.array( [ self.full_gradient(beta) for beta in betas ] )
+
+
+    def predict_proba(self,beta,X):
+        """Return the (n, K) matrix of class probabilities of the rows of X at parameters beta"""
+        with np.errstate( under = 'ignore' ):
+            return np.exp( log_probabilities( beta, X ) )
+
+
+    def summary(self,thin=10):
+        """
+        Summarise the fitted chain for prediction.
+
+        Parameters:
+        thin - keep every thin-th iteration of the chain in the summary (optional)
+
+        Returns:
+        summary - SoftmaxSummary object holding a thinned sample, the posterior mean
+                and covariance
+        """
+        return SoftmaxSummary( self.sample, thin )
+
+
+class SoftmaxSummary(PosteriorSummary):
+    """
+    PosteriorSummary of a softmax regression, whose predictions are class probabilities.
+
+    Parameters are flattened ( n_features, K ) matrices, as in SoftmaxRegression.
+    """
+
+    @staticmethod
+    def load(path):
+        """Load a summary saved using save"""
+        stored = np.load(path)
+        return SoftmaxSummary( stored['sample'], 1, stored['mean'], stored['covariance'] )
+
+
+    def predict_proba(self,X,mode='mc',chunk_size=10000):
+        """
+        Calculate the posterior predictive probability of each class for each row of X.
+
+        X is processed in chunks of rows, so it can be large, sparse or memory-mapped.
+
+        Parameters:
+        X - matrix of explanatory variables (dense or sparse)
+        mode - 'mc' averages the class probabilities over the thinned sample, 'mean'
+                plugs in the posterior mean; the probit approximation of PosteriorSummary
+                is for binary models only (optional)
+        chunk_size - number of rows of X processed at a time (optional)
+
+        Returns:
+        probabilities - array of shape (X.shape[0], K) of predicted class probabilities
+        """
+        if mode not in [ 'mc', 'mean' ]:
+            raise ValueError( "mode must be 'mc' or 'mean' for softmax regression" )
+        probabilities = np.zeros( ( X.shape[0], self.d // X.shape[1] ) )
+        for start in xrange(0,X.shape[0],chunk_size):
+            end = min( start + chunk_size, X.shape[0] )
+            X_chunk = X[start:end]
+            # Probabilities of unlikely classes underflow, which LogisticRegression sets to raise
+            with np.errstate( under = 'ignore' ):
+                if mode == 'mean':
+                    probabilities[start:end] = np.exp( log_probabilities( self.mean, X_chunk ) )
+                else:
+                    for beta in self.sample:
+                        probabilities[start:end] += np.exp( log_probabilities( beta, X_chunk ) )
+                    probabilities[start:end] /= len( self.sample )
+        return probabilities
+
+
+def log_probabilities(beta,X):
+    """
+    Calculate the log probability of every class for each row of X, using a stable log-sum-exp.
+
+    Parameters:
+    beta - vector of flattened softmax regression parameters, of length X.shape[1] * K
+    X - matrix of explanatory variables (dense or sparse)
+
+    Returns:
+    log_probabilities - array of shape (X.shape[0], K)
+    """
+    scores = np.asarray( X.dot( beta.reshape( X.shape[1], -1 ) ) )
+    scores -= scores.max( axis = 1 )[:,np.newaxis]
+    with np.errstate( under = 'ignore' ):
+        return scores - np.log( np.exp(scores).sum( axis = 1 ) )[:,np.newaxis]
+
+
+def softmax_logloss(beta,X_test,y_test,pool=None,weights=None):
+    """
+    Calculate the multiclass log loss on the test set for parameter values beta
+
+    Used as the test loss of SoftmaxRegression, with the signature of test_logloss.
+
+    Parameters:
+    beta - vector of flattened softmax regression parameters
+    X_test - matrix of explanatory variables for testing
+    y_test - vector of class labels for testing
+    pool - BlockPool used to score blocks of the test set in parallel (optional)
+    weights - weight of each test point (optional)
+    """
+    def block_loglik(X,y):
+        log_probs = log_probabilities( beta, X )
+        return log_probs[np.arange( len(y) ),np.asarray( y, dtype = int ).ravel()]
+    y_test = np.asarray(y_test).ravel()
+    if pool is None:
+        loglik = block_loglik( X_test, y_test )
+    else:
+        loglik = np.concatenate( pool.map( block_loglik, pool.split( X_test, y_test ) ) )
+    return - np.average( loglik, weights = weights )
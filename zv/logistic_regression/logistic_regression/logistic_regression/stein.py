@@ -0,0 +1,155 @@
+"""
+Kernel Stein discrepancy (KSD), measuring how well a sample approximates the posterior.
+
+The KSD only needs the sample and the log posterior gradient at each point, so it can
+compare chains from different fitters and stepsizes directly, including biased ones such
+as SGLD with a large stepsize, where the test log loss is noisy and indirect.
+
+The exact KSD with the inverse multiquadric (IMQ) kernel sums the Stein kernel over every
+pair of points, O(n^2) kernel evaluations. It is calculated in square tiles of points using
+matrix products, so memory is bounded by the tile size, and tiles are spread over a pool of
+threads. For very long chains, random Fourier features of a Gaussian kernel give a
+linear time approximation.
+
+References:
+    1. Measuring sample quality with kernels - https://arxiv.org/abs/1703.01717
+    2. Random features for large-scale kernel machines -
+            https://papers.nips.cc/paper/3182-random-features-for-large-scale-kernel-machines
+"""
+import numpy as np
+
+
+def imq_tile(X_i,S_i,X_j,S_j,c=1.0,beta=-0.5):
+    """
+    Sum the IMQ Stein kernel over every pair of points from two tiles.
+
+    The IMQ kernel is k(x, y) = ( c^2 + ||x - y||^2 )^beta, and the Stein kernel is
+    s_x.s_y k + s_x.grad_y k + s_y.grad_x k + trace( grad_x grad_y k ), where s is the log
+    posterior gradient.
+
+    Parameters:
+    X_i, X_j - arrays of shape (n_i, d) and (n_j, d) holding the points of each tile
+    S_i, S_j - log posterior gradients at the points of each tile
+    c - scale of the IMQ kernel (optional)
+    beta - exponent of the IMQ kernel, in (-1, 0) (optional)
+    """
+    d = X_i.shape[1]
+    sq_i = ( X_i**2 ).sum( axis = 1 )
+    sq_j = ( X_j**2 ).sum( axis = 1 )
+    sqdist = np.maximum( sq_i[:,np.newaxis] + sq_j[np.newaxis,:] - 2 * np.dot( X_i, X_j.T ), 0 )
+    u = c**2 + sqdist
+    # ( s_j - s_i ).( x_i - x_j ), from the gradients of the kernel
+    score_diff = ( np.dot( X_i, S_j.T ) + np.dot( S_i, X_j.T )
+            - ( S_i * X_i ).sum( axis = 1 )[:,np.newaxis]
+            - ( S_j * X_j ).sum( axis = 1 )[np.newaxis,:] )
+    stein = ( np.dot( S_i, S_j.T ) * u**beta + 2 * beta * u**( beta - 1 ) * ( score_diff - d )
+            - 4 * beta * ( beta - 1 ) * sqdist * u**( beta - 2 ) )
+    return stein.sum()
+
+
+def kernel_stein_discrepancy(sample,gradients,c=1.0,beta=-0.5,tile_size=1000,pool=None):
+    """
+    Calculate the exact KSD of a sample with the IMQ kernel, in tiles.
+
+    The kernel matrix is symmetric, so only tiles on or above the diagonal are evaluated.
+    Each tile holds tile_size^2 kernel values.
+
+    Parameters:
+    sample - array of shape (n, d) holding the points, e.g. a thinned lr.sample
+    gradients - array of shape (n, d) holding the log posterior gradient at each point
+    c - scale of the IMQ kernel (optional)
+    beta - exponent of the IMQ kernel, in (-1, 0) (optional)
+    tile_size - number of points in each tile (optional)
+    pool - BlockPool used to evaluate tiles in parallel (optional)
+
+    Returns:
+    ksd - the kernel Stein discrepancy
+    """
+    n = sample.shape[0]
+    sample = np.asarray( sample, dtype = float )
+    gradients = np.asarray( gradients, dtype = float )
+    def tile_sum(start_i,start_j):
+        X_i, S_i = sample[start_i:start_i+tile_size], gradients[start_i:start_i+tile_size]
+        X_j, S_j = sample[start_j:start_j+tile_size], gradients[start_j:start_j+tile_size]
+        total = imq_tile( X_i, S_i, X_j, S_j, c, beta )
+        # Off diagonal tiles stand in for their transpose too
+        if start_i != start_j:
+            total *= 2
+        return total
+    starts = range(0,n,tile_size)
+    tiles = [ ( start_i, start_j ) for start_i in starts for start_j in starts
+            if start_j >= start_i ]
+    if pool is None:
+        total = sum( [ tile_sum( *tile ) for tile in tiles ] )
+    else:
+        total = pool.sum( tile_sum, tiles )
+    return np.sqrt( max( total, 0 ) ) / n
+
+
+def median_bandwidth(sample,n_points=1000):
+    """Return the median distance between pairs of points, using at most n_points evenly spaced points"""
+    points = np.asarray( sample[::max( 1, sample.shape[0] // n_points )], dtype = float )
+    sq = ( points**2 ).sum( axis = 1 )
+    sqdist = sq[:,np.newaxis] + sq[np.newaxis,:] - 2 * np.dot( points, points.T )
+    sqdist = sqdist[np.triu_indices( points.shape[0], 1 )]
+    return np.sqrt( np.median( np.maximum( sqdist, 0 ) ) )
+
+
+def random_feature_ksd(sample,gradients,n_features=500,bandwidth=None,chunk_size=10000):
+    """
+    Approximate the KSD with a Gaussian kernel using random Fourier features, in linear time.
+
+    The Gaussian kernel is approximated by phi(x).phi(y), with features
+    phi_f(x) = sqrt( 2 / D ) cos( w_f.x + b_f ), so the Stein kernel factorises and the
+    squared KSD is the squared norm of sum_i ( s_i phi(x_i) + grad phi(x_i) ) over n^2. The
+    sum is accumulated over chunks of the sample in a single pass.
+
+    Parameters:
+    sample - array of shape (n, d) holding the points
+    gradients - array of shape (n, d) holding the log posterior gradient at each point
+    n_features - number of random features D (optional)
+    bandwidth - bandwidth of the Gaussian kernel, the median distance between points by
+            default (optional)
+    chunk_size - number of points processed at a time (optional)
+
+    Returns:
+    ksd - the approximate kernel Stein discrepancy
+    """
+    n, d = sample.shape
+    if bandwidth is None:
+        bandwidth = median_bandwidth(sample)
+    frequencies = np.random.normal( scale = 1.0 / bandwidth, size = ( n_features, d ) )
+    offsets = np.random.uniform( 0, 2 * np.pi, size = n_features )
+    scale = np.sqrt( 2.0 / n_features )
+    # Sum of s_i phi(x_i), and of sin( w_f.x_i + b_f ) giving the sum of grad phi(x_i)
+    stein_sum = np.zeros( ( n_features, d ) )
+    sin_sum = np.zeros( n_features )
+    for start in xrange(0,n,chunk_size):
+        X = np.asarray( sample[start:start+chunk_size], dtype = float )
+        S = np.asarray( gradients[start:start+chunk_size], dtype = float )
+        projections = np.dot( X, frequencies.T ) + offsets
+        stein_sum += scale * np.dot( np.cos(projections).T, S )
+        sin_sum += np.sin(projections).sum( axis = 0 )
+    stein_sum -= scale * sin_sum[:,np.newaxis] * frequencies
+    return np.sqrt( ( stein_sum**2 ).sum() ) / n
+
+
+def select_stepsize(fits,thin=10,recompute=True,approximate=False):
+    """
+    Pick the stepsize whose chain has the smallest KSD.
+
+    Parameters:
+    fits - dict mapping each stepsize to a LogisticRegression object fitted with it, using
+            any fitter
+    thin - use every thin-th iteration of each chain (optional)
+    recompute - recompute full data gradients rather than using the stored minibatch
+            estimates (optional)
+    approximate - use the random feature approximation (optional)
+
+    Returns:
+    stepsize - stepsize with the smallest KSD
+    scores - dict mapping each stepsize to the KSD of its chain
+    """
+    scores = dict( ( stepsize, lr.stein_discrepancy( thin, recompute, approximate ) )
+            for stepsize, lr in fits.items() )
+    return min( scores, key = scores.get ), scores
@@ -0,0 +1,60 @@
+from timeit import default_timer
+
+
+class StoppingRule:
+    """
+    Decide when to stop fitting, based on convergence targets or a compute budget.
+
+    Fitting stops as soon as any of the targets which are set is reached. ESS and MCSE
+    targets use the online diagnostics of the fit and must hold for every coordinate, so
+    they are checked every check_every iterations to keep their cost down.
+    """
+
+    def __init__(self,target_ess=None,target_mcse=None,max_time=None,max_grad_evals=None,
+            check_every=100):
+        """
+        Initialise the stopping rule.
+
+        Parameters:
+        target_ess - stop once the effective sample size of every coordinate exceeds this (optional)
+        target_mcse - stop once the MCSE of every coordinate is below this (optional)
+        max_time - stop once this many seconds of wall-clock time have been used (optional)
+        max_grad_evals - stop once this many per-observation gradients have been evaluated (optional)
+        check_every - number of iterations between checks of the ESS and MCSE targets (optional)
+        """
+        self.target_ess = target_ess
+        self.target_mcse = target_mcse
+        self.max_time = max_time
+        self.max_grad_evals = max_grad_evals
+        self.check_every = check_every
+        self.started = None
+        # Reason fitting was stopped, None until a target is reached
+        self.reason = None
+
+
+    def start(self,lr):
+        """Start the wall-clock budget, counting sampling time already spent when resuming"""
+        self.started = default_timer() - lr.sampling_time
+        self.reason = None
+
+
+    def done(self,lr):
+        """
+        Check whether fitting should stop after the current iteration.
+
+        Parameters:
+        lr - LogisticRegression object being fitted
+
+        Returns:
+        done - True if any of the targets has been reached, the target is stored in self.reason
+        """
+        if self.max_time is not None and default_timer() - self.started >= self.max_time:
+            self.reason = 'max_time'
+        elif self.max_grad_evals is not None and lr.fitter.grad_evals >= self.max_grad_evals:
+            self.reason = 'max_grad_evals'
+        elif lr.fitter.iter % self.check_every == 0:
+            if self.target_ess is not None and lr.diagnostics.ess().min() >= self.target_ess:
+                self.reason = 'target_ess'
+            elif self.target_mcse is not None and lr.diagnostics.mcse().max() <= self.target_mcse:
+                self.reason = 'target_mcse'
+        return self.reason is not None
@@ -1,17 +1,17 @@
-import time
+from timeit import default_timer
 
 class Stopwatch:
     """Define tic() and toc() for calculating time"""
     def __init__(self):
-        self.current = time.time()
+        self.current = default_timer()
 
     def tic(self):
         """Reset stopwatch"""
-        self.current = time.time()
+        self.current = default_timer()
 
     def toc(self):
         """Return elapsed time"""
-        elapsed = time.time() - self.current
+        elapsed = default_timer() - self.current
         # Reset timer
-        self.current = time.time()
+        self.current = default_timer()
         return elapsed
@@ -0,0 +1,93 @@
+import os
+import numpy as np
+import scipy.sparse as sp
+from scipy.special import expit
+
+
+class PosteriorSummary:
+    """
+    Compact summary of a fitted posterior, used for prediction.
+
+    Holds a thinned sample of the chain, the posterior mean and covariance estimated from
+    the whole chain, which also define a Gaussian approximation to the posterior. Summaries
+    can be saved to and loaded from a small .npz file, so predictions don't need the chain.
+    """
+
+    def __init__(self,sample,thin=10,mean=None,covariance=None):
+        """
+        Summarise a chain.
+
+        Parameters:
+        sample - array of shape (n_iters, d) holding the chain, e.g. lr.sample or a sample
+                corrected using ZV control variates
+        thin - keep every thin-th iteration of the chain in the summary (optional)
+        mean - posterior mean, estimated from sample by default (optional)
+        covariance - posterior covariance, estimated from sample by default (optional)
+        """
+        self.sample = np.ascontiguousarray( sample[::thin,:] )
+        self.mean = mean if mean is not None else sample.mean( axis = 0 )
+        if covariance is None:
+            covariance = np.atleast_2d( np.cov( sample, rowvar = False ) )
+        self.covariance = covariance
+        self.d = self.mean.shape[0]
+
+
+    def save(self,path):
+        """Save the summary to path as a .npz file, written atomically"""
+        tmp = path + '.tmp'
+        with open( tmp, 'wb' ) as out:
+            np.savez( out, sample = self.sample, mean = self.mean,
+                    covariance = self.covariance )
+            out.flush()
+            os.fsync( out.fileno() )
+        os.rename( tmp, path )
+
+
+    @staticmethod
+    def load(path):
+        """Load a summary saved using save"""
+        stored = np.load(path)
+        return PosteriorSummary( stored['sample'], 1, stored['mean'], stored['covariance'] )
+
+
+    def gaussian_sample(self,size):
+        """Draw size samples from the Gaussian approximation to the posterior"""
+        return np.random.multivariate_normal( self.mean, self.covariance, size = size )
+
+
+    def predict_proba(self,X,mode='mc',chunk_size=10000):
+        """
+        Calculate the posterior predictive probability that y = 1 for each row of X.
+
+        X is processed in chunks of rows, so it can be large, sparse or memory-mapped.
+
+        Parameters:
+        X - matrix of explanatory variables (dense or sparse)
+        mode - 'mc' averages the predicted probability over the thinned sample, 'mean'
+                plugs in the posterior mean, 'probit' integrates over the Gaussian
+                approximation using the probit approximation to the logistic function (optional)
+        chunk_size - number of rows of X processed at a time (optional)
+
+        Returns:
+        probabilities - vector of predicted probabilities, one for each row of X
+        """
+        if mode not in [ 'mc', 'mean', 'probit' ]:
+            raise ValueError( "mode must be 'mc', 'mean' or 'probit'" )
+        probabilities = np.zeros( X.shape[0] )
+        for start in xrange(0,X.shape[0],chunk_size):
+            end = min( start + chunk_size, X.shape[0] )
+            X_chunk = X[start:end]
+            if sp.issparse(X_chunk):
+                X_chunk = X_chunk.toarray()
+            X_chunk = np.asarray(X_chunk)
+            # Probabilities close to 0 or 1 underflow, which LogisticRegression sets to raise
+            with np.errstate( over = 'ignore', under = 'ignore' ):
+                if mode == 'mc':
+                    probabilities[start:end] = expit( np.dot( X_chunk, self.sample.T ) ).mean( axis = 1 )
+                elif mode == 'mean':
+                    probabilities[start:end] = expit( np.dot( X_chunk, self.mean ) )
+                else:
+                    location = np.dot( X_chunk, self.mean )
+                    variance = ( np.dot( X_chunk, self.covariance ) * X_chunk ).sum( axis = 1 )
+                    probabilities[start:end] = expit( location / np.sqrt( 1 + np.pi * variance / 8 ) )
+        return probabilities
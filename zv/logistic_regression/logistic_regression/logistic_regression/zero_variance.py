@@ -0,0 +1,247 @@
+import numpy as np
+import scipy.sparse as sp
+from scipy.linalg import cho_factor, cho_solve
+from scipy.special import expit
+from sklearn.covariance import LedoitWolf
+
+
+class ZeroVariance:
+    """
+    Zero variance control variates for batches of functionals of an SGLD chain.
+
+    The first degree control variates are the potential energy gradients z = - 1/2 * grad_sample.
+    For each functional f, evaluated at every iteration of the chain, the corrected values are
+    f + z a, where a = - Var(z)^-1 Cov(z, f) minimises the variance of the corrected values.
+    Var(z) is estimated using Ledoit-Wolf shrinkage and its Cholesky factorization is computed
+    once and shared by every functional, so correcting m functionals costs one triangular
+    solve with m right hand sides.
+
+    Second degree control variates come from quadratic polynomials of the parameters x. As
+    well as z they use 2 z_i x_i - 1 for each coordinate and z_i x_j + z_j x_i for each pair
+    of coordinates, O(d^2) features in total. These are built from the chain in blocks of
+    iterations, so the full feature matrix is never held in memory, and their covariance is
+    regularised by adding ridge times its average variance to the diagonal.
+
+    Chains from a sweep targeting the same posterior can share a single factorization of a
+    covariance pooled across them, see pooled_factor and batch.py.
+
+    Notation used as in reference 1
+    References:
+        1. Zero variance control variates for Hamiltonian Monte Carlo -
+                https://projecteuclid.org/download/pdfview_1/euclid.ba/1393251772
+    """
+
+    def __init__(self,grad_sample,sample=None,degree=1,ridge=1e-6,block_size=1000,factor=None,
+            feature_mean=None):
+        """
+        Calculate and factorize the covariance of the control variates.
+
+        Parameters:
+        grad_sample - array of shape (n_iters, d) holding the log posterior gradient
+                at each iteration, e.g. lr.grad_sample
+        sample - array of shape (n_iters, d) holding the chain, needed if degree is 2 (optional)
+        degree - degree of the polynomial control variates, 1 or 2 (optional)
+        ridge - regularisation of the second degree control variates (optional)
+        block_size - number of iterations for which features are built at a time (optional)
+        factor - Cholesky factorization of the control variate covariance, e.g. shared by
+                several chains from pooled_factor; estimated from this chain by default (optional)
+        feature_mean - mean of the control variates over this chain, as returned along with
+                factor by pooled_factor; calculated from the chain by default (optional)
+        """
+        self.pot_energy = - 1 / 2.0 * grad_sample
+        self.n_iters, self.d = grad_sample.shape
+        self.sample = sample
+        self.degree = degree
+        self.block_size = block_size
+        if degree == 2 and sample is None:
+            raise ValueError( "second degree control variates need the sample" )
+        elif degree not in ( 1, 2 ):
+            raise ValueError( "degree must be 1 or 2" )
+        if factor is None and degree == 1:
+            self.feature_mean = self.pot_energy.mean( axis = 0 )
+            model = LedoitWolf()
+            model.fit( self.pot_energy )
+            factor = cho_factor( model.covariance_ )
+        elif factor is None:
+            feature_sum, gram = moments( self.pot_energy, sample, degree, block_size )
+            self.feature_mean = feature_sum / self.n_iters
+            scatter = gram - self.n_iters * np.outer( self.feature_mean, self.feature_mean )
+            factor = cho_factor( regularise( scatter / ( self.n_iters - 1 ), ridge ) )
+        elif feature_mean is None:
+            # Only the mean is needed, so skip the O(d^4) Gram matrix
+            self.feature_mean = moments( self.pot_energy, sample, degree, block_size, 
+                    gram = False )[0] / self.n_iters
+        else:
+            self.feature_mean = feature_mean
+        self.factor = factor
+
+
+    def features(self,start,end):
+        """Return the control variates at iterations start to end - 1"""
+        return features( self.pot_energy, self.sample, self.degree, start, end )
+
+
+    def coefficients(self,values):
+        """
+        Calculate the optimal control variate coefficients of a batch of functionals.
+
+        Parameters:
+        values - array of shape (n_iters, m), each column holding a functional at every iteration
+
+        Returns:
+        a - array of shape (n_features, m), the coefficients of each functional
+        """
+        centred = values - values.mean( axis = 0 )
+        cov_params = np.zeros( ( len( self.feature_mean ), values.shape[1] ) )
+        for start in xrange(0,self.n_iters,self.block_size):
+            end = start + self.block_size
+            cov_params += np.dot( ( self.features( start, end ) - self.feature_mean ).T, 
+                    centred[start:end,:] )
+        return - cho_solve( self.factor, cov_params / float( self.n_iters - 1 ) )
+
+
+    def correct(self,values):
+        """
+        Apply the control variates to a batch of functionals.
+
+        Parameters:
+        values - array of shape (n_iters, m) or (n_iters,), the functionals at every iteration
+
+        Returns:
+        corrected - array with the same shape as values holding the corrected functionals
+        """
+        shape = values.shape
+        values = values.reshape( self.n_iters, -1 )
+        a = self.coefficients(values)
+        corrected = values.astype(float)
+        for start in xrange(0,self.n_iters,self.block_size):
+            end = start + self.block_size
+            corrected[start:end,:] += np.dot( self.features( start, end ), a )
+        return corrected.reshape(shape)
+
+
+def features(pot_energy,sample,degree,start,end):
+    """
+    Return the control variates of a chain at iterations start to end - 1.
+
+    Parameters:
+    pot_energy - array of shape (n_iters, d), the potential energies - 1/2 * grad_sample
+    sample - array of shape (n_iters, d) holding the chain, unused if degree is 1
+    degree - degree of the polynomial control variates, 1 or 2
+    """
+    z = pot_energy[start:end,:]
+    if degree == 1:
+        return z
+    x = sample[start:end,:]
+    # Pairs of coordinates used by the cross terms
+    rows, cols = np.triu_indices( z.shape[1], 1 )
+    return np.hstack( ( z, 2 * z * x - 1, z[:,rows] * x[:,cols] + z[:,cols] * x[:,rows] ) )
+
+
+def moments(pot_energy,sample,degree,block_size=1000,gram=True):
+    """
+    Sum the control variates of a chain, building them a block of iterations at a time.
+
+    Parameters:
+    pot_energy - array of shape (n_iters, d), the potential energies - 1/2 * grad_sample
+    sample - array of shape (n_iters, d) holding the chain, unused if degree is 1
+    degree - degree of the polynomial control variates, 1 or 2
+    block_size - number of iterations for which features are built at a time (optional)
+    gram - whether to also sum the outer products of the control variates (optional)
+
+    Returns:
+    feature_sum - sum of the control variates over the chain
+    products - sum of their outer products, None if gram is False
+    """
+    n_iters, d = pot_energy.shape
+    n_features = d if degree == 1 else 2 * d + d * ( d - 1 ) // 2
+    feature_sum = np.zeros( n_features )
+    products = np.zeros( ( n_features, n_features ) ) if gram else None
+    for start in xrange(0,n_iters,block_size):
+        block = features( pot_energy, sample, degree, start, start + block_size )
+        feature_sum += block.sum( axis = 0 )
+        if gram:
+            products += np.dot( block.T, block )
+    return feature_sum, products
+
+
+def regularise(covariance,ridge):
+    """Add ridge times the average variance to the diagonal of covariance, in place, and return it"""
+    n_features = covariance.shape[0]
+    covariance[np.diag_indices(n_features)] += ridge * np.trace( covariance ) / n_features
+    return covariance
+
+
+def pooled_factor(grad_samples,samples=None,degree=1,ridge=1e-6,block_size=1000):
+    """
+    Estimate the control variate covariance pooled across chains and factorize it once.
+
+    Each chain is centred at its own mean, so the pooled estimate is valid for chains with
+    different stepsizes whose means differ slightly. First degree control variates use a
+    single Ledoit-Wolf fit to every chain's centred potential energies; second degree ones
+    add up the scatter matrices of the chains.
+
+    Parameters:
+    grad_samples - list of arrays of shape (n_iters, d), the log posterior gradients of each chain
+    samples - list of the chains, needed if degree is 2 (optional)
+    degree - degree of the polynomial control variates, 1 or 2 (optional)
+    ridge - regularisation of the second degree control variates (optional)
+    block_size - number of iterations for which features are built at a time (optional)
+
+    Returns:
+    factor - Cholesky factorization, passed to ZeroVariance as factor for each chain
+    feature_means - list holding the mean of the control variates of each chain, passed to
+            ZeroVariance as feature_mean so the chain's features aren't built again
+    """
+    if degree == 1:
+        feature_means = [ - 1 / 2.0 * grad_sample.mean( axis = 0 )
+                for grad_sample in grad_samples ]
+        centred = np.concatenate( [ - 1 / 2.0 * grad_sample - feature_mean
+                for grad_sample, feature_mean in zip( grad_samples, feature_means ) ] )
+        model = LedoitWolf( assume_centered = True )
+        model.fit( centred )
+        return cho_factor( model.covariance_ ), feature_means
+    if samples is None:
+        raise ValueError( "second degree control variates need the samples" )
+    scatter = 0
+    n_total = 0
+    feature_means = []
+    for grad_sample, sample in zip( grad_samples, samples ):
+        n_iters = grad_sample.shape[0]
+        feature_sum, gram = moments( - 1 / 2.0 * grad_sample, sample, degree, block_size )
+        feature_means.append( feature_sum / n_iters )
+        scatter = scatter + gram - np.outer( feature_sum, feature_sum ) / n_iters
+        n_total += n_iters - 1
+    return cho_factor( regularise( scatter / float( n_total ), ridge ) ), feature_means
+
+
+def variance_reduction(values,corrected):
+    """Return the variance of each functional divided by the variance after correction"""
+    return values.var( axis = 0 ) / corrected.var( axis = 0 )
+
+
+def predictive_values(sample,X,chunk_size=1000):
+    """
+    Calculate the predicted probability that y = 1 for each test point at every iteration.
+
+    Test points are processed in chunks, each with a single matrix product.
+
+    Parameters:
+    sample - array of shape (n_iters, d) holding the chain
+    X - matrix of explanatory variables of m test points (dense or sparse)
+    chunk_size - number of test points processed at a time (optional)
+
+    Returns:
+    values - array of shape (n_iters, m), suitable for ZeroVariance.correct
+    """
+    m = X.shape[0]
+    values = np.zeros( ( sample.shape[0], m ) )
+    for start in xrange(0,m,chunk_size):
+        end = min( start + chunk_size, m )
+        X_chunk = X[start:end]
+        if sp.issparse(X_chunk):
+            X_chunk = X_chunk.toarray()
+        # Probabilities close to 0 or 1 underflow, which LogisticRegression sets to raise
+        with np.errstate( over = 'ignore', under = 'ignore' ):
+            values[:,start:end] = expit( np.dot( sample, np.asarray(X_chunk).T ) )
+    return values
@@ -1,8 +1,11 @@
 import numpy as np
 import sys
 import pkg_resources
-from sklearn.covariance import LedoitWolf
 from sklearn.metrics import log_loss
+import scipy.sparse as sp
+from data_source import ArrayData, draw_minibatch
+import kernels
+from zero_variance import ZeroVariance, variance_reduction
 
 
 class ZVSGLD:
@@ -21,7 +24,7 @@ class ZVSGLD:
                 https://projecteuclid.org/download/pdfview_1/euclid.ba/1393251772
     """
     
-    def __init__(self,lr,epsilon,minibatch_size,n_iter):
+    def __init__(self,lr,epsilon,minibatch_size,n_iter,backend='numpy'):
         """
         Initialize the container for SGLD
 
@@ -29,15 +32,20 @@ class ZVSGLD:
         lr - LogisticRegression object
         epsilon - the stepsize to perform SGD at
         minibatch_size - size of the minibatch used at each iteration
-        n_iter - the number of iterations to perform
+        n_iter - the maximum number of iterations to perform, None if there's no maximum
+        backend - 'numpy', or 'numba' to perform each update with the fused compiled kernel 
+                in kernels.py, falls back to 'numpy' if numba isn't installed (optional)
         """
         self.epsilon = epsilon
         # Set the minibatch size
         self.minibatch_size = minibatch_size
         self.sample_minibatch(lr)
-        # Hold number of iterations so far
+        # Hold number of iterations so far, and number of per-observation gradients evaluated
         self.iter = 1
-        self.output = np.zeros( ( n_iter, lr.d ) )
+        self.grad_evals = 0
+        self.backend = backend
+        if backend == 'numba':
+            self.init_fused(lr)
 
 
     def update(self,lr):
@@ -51,63 +59,223 @@ class ZVSGLD:
         lr.beta - updates parameter values using SGLD
         lr.grad_sample - adds calculated gradient to storage
         """
+        if self.backend == 'numba':
+            self.update_fused(lr)
+            return
+        lr.metrics.tic('minibatch')
         self.sample_minibatch(lr)
+        lr.metrics.toc('minibatch')
         # Calculate gradients at current point
-        dlogbeta, dlogbetaopt = lr.dlogpostcv(self)
+        lr.metrics.tic('gradient')
+        dlogbeta, dlogbetaopt = self.gradients(lr)
+        self.dlogbeta, self.dlogbetaopt = dlogbeta, dlogbetaopt
+        lr.metrics.toc('gradient')
+        self.grad_evals += 2 * self.minibatch_size
+        lr.metrics.count( 'grad_evals', 2 * self.minibatch_size )
+        lr.metrics.count( 'rows', self.minibatch_size )
         lr.grad_sample[self.iter-1,:] = dlogbeta
 
         # Update parameters using SGD
+        lr.metrics.tic('update')
         eta = np.sqrt( self.epsilon ) * np.random.normal( size = lr.d )
         lr.beta += self.epsilon / 2 * ( lr.full_post + ( dlogbeta - dlogbetaopt ) ) + eta
+        lr.metrics.toc('update')
+
+
+    def init_fused(self,lr):
+        """
+        Set up the fused kernel backend, falling back to numpy if numba isn't installed.
+
+        The kernel gathers minibatch rows itself, so it needs the training data in memory as 
+        a dense array, and draws minibatches uniformly as ArrayData does. Rows can be weighted.
+        """
+        if not kernels.HAVE_NUMBA:
+            print "Numba not installed, using numpy backend"
+            self.backend = 'numpy'
+            return
+        if not lr.fused_kernel:
+            raise ValueError( "numba backend only supports binary logistic regression" )
+        if lr.data.__class__ is not ArrayData or sp.issparse( lr.data.X ):
+            raise ValueError( "numba backend needs dense training data held in ArrayData" )
+        self.X = np.ascontiguousarray( lr.data.X, dtype = float )
+        self.y = np.ascontiguousarray( lr.data.y, dtype = float )
+        if lr.data.weights is None:
+            self.weights = np.ones( lr.N )
+        else:
+            self.weights = np.ascontiguousarray( lr.data.weights, dtype = float )
+        # Work arrays holding the gradient estimates at beta and beta_mode
+        self.grad = np.zeros( lr.d )
+        self.grad_opt = np.zeros( lr.d )
+        self.dlogbeta, self.dlogbetaopt = self.grad, self.grad_opt
+
+
+    def update_fused(self,lr):
+        """
+        Update one step of stochastic gradient Langevin dynamics using the fused kernel
+
+        Random numbers are drawn in the same order as update, so both backends give 
+        the same chain up to floating point rounding.
+
+        Parameters:
+        lr - LogisticRegression object
+
+        Modifies:
+        lr.beta - updates parameter values using SGLD
+        lr.grad_sample - adds calculated gradient to storage
+        """
+        lr.metrics.tic('minibatch')
+        self.minibatch = draw_minibatch( lr.N, self.minibatch_size )
+        lr.metrics.toc('minibatch')
+        lr.metrics.tic('update')
+        eta = np.sqrt( self.epsilon ) * np.random.normal( size = lr.d )
+        kernels.sgld_cv_step( self.X, self.y, self.weights, self.minibatch, lr.beta, lr.beta_mode, 
+                lr.full_post, float( lr.N ) / self.minibatch_size, lr.prior_scale, self.epsilon, 
+                eta, self.grad, self.grad_opt )
+        lr.metrics.toc('update')
+        self.grad_evals += 2 * self.minibatch_size
+        lr.metrics.count( 'grad_evals', 2 * self.minibatch_size )
+        lr.metrics.count( 'rows', self.minibatch_size )
+        lr.grad_sample[self.iter-1,:] = self.grad
+
+
+    def estimator_variance(self,lr,beta=None):
+        """
+        Estimate the variance of each coordinate of the gradient estimate from the current minibatch
+
+        Parameters:
+        lr - LogisticRegression object being fitted
+        beta - parameter values the last gradient estimate was calculated at, before the
+                update moved lr.beta; lr.beta by default (optional)
+        """
+        if beta is None:
+            beta = lr.beta
+        if self.backend == 'numba':
+            # The fused kernel doesn't gather the rows
+            self.X_batch, self.y_batch = lr.data.rows( self.minibatch )
+            self.w_batch = None
+            if lr.data.weights is not None:
+                self.w_batch = lr.data.weights[self.minibatch]
+        return lr.N**2 / float( self.minibatch_size ) * lr.row_variance( beta, self.X_batch, 
+                self.y_batch, self.w_batch, lr.beta_mode )
+
+
+    def gradient_estimate(self,lr):
+        """Return the log posterior gradient estimate used by the last update"""
+        return lr.full_post + ( self.dlogbeta - self.dlogbetaopt )
+
+
+    def injected_variance(self):
+        """Return the variance of the noise injected into each coordinate at every update"""
+        return self.epsilon
+
+
+    def checkpoint_state(self):
+        """Return the state of the fitter, used by Checkpointer"""
+        return { 'epsilon' : self.epsilon, 'minibatch_size' : self.minibatch_size, 
+                'iter' : self.iter, 'grad_evals' : self.grad_evals }
+
+
+    def restore_state(self,state):
+        """Restore the state of the fitter from a checkpoint"""
+        self.iter = int( state['iter'] )
+        self.grad_evals = int( state['grad_evals'] )
+
 
-    
     def full_post(self,lr):
-        self.minibatch = np.arange(lr.N)
-        dlogbeta, dlogbetaopt = lr.dlogpostcv(self)
+        """
+        Calculate the full data log posterior gradient at the mode, used by the control variate
+
+        The data is read in consecutive blocks, so it needn't fit in memory, and blocks are
+        evaluated in parallel on lr.pool.
+
+        Parameters:
+        lr - LogisticRegression object
+
+        Modifies:
+        lr.loglik_mode - full data log likelihood gradient at lr.beta_mode
+        lr.full_post - full data log posterior gradient at lr.beta_mode
+        """
+        lr.metrics.tic('full_post')
+        lr.loglik_mode = self.full_loglik(lr)
+        self.set_full_post(lr)
+        lr.metrics.toc('full_post')
+        self.grad_evals += lr.N
+        lr.metrics.count( 'grad_evals', lr.N )
+        lr.metrics.count( 'rows', lr.N )
+
+
+    def set_full_post(self,lr):
+        """Calculate lr.full_post from the full data log likelihood gradient lr.loglik_mode"""
+        # Scale as for a minibatch estimate, then back to the full data
+        dlogbetaopt = lr.loglik_mode * ( float( lr.N ) / self.minibatch_size )
+        dlogbetaopt -= lr.prior_scale * np.sign(lr.beta_mode)
         lr.full_post = self.minibatch_size / float( lr.N ) * dlogbetaopt
 
+
+    def append(self,lr,X,y,weights=None):
+        """
+        Update the fitter once rows have been appended to the training data.
+
+        The log likelihood gradient of the new rows at the mode is added to lr.loglik_mode,
+        so lr.full_post is updated without another pass over the data.
+
+        Parameters:
+        lr - LogisticRegression object, with lr.N already updated
+        X - dense block holding the new rows
+        y - vector of responses of the new rows
+        weights - row weights of the new rows, None if rows are unweighted (optional)
+        """
+        if lr.loglik_mode is None:
+            self.full_post(lr)
+        else:
+            lr.loglik_mode = lr.loglik_mode + lr.dloglik_blocks( lr.beta_mode, X, y, weights )
+            self.set_full_post(lr)
+            self.grad_evals += len(y)
+            lr.metrics.count( 'grad_evals', len(y) )
+        if self.backend == 'numba':
+            self.init_fused(lr)
+
+
+    def full_loglik(self,lr):
+        """Return the full data log likelihood gradient at the mode, summed over blocks on lr.pool"""
+        return lr.pool.sum( lambda X, y, weights : lr.dloglik( lr.beta_mode, X, y, weights ), 
+                lr.data.weighted_blocks( lr.pool.block_size ) )
+
+
+    def gradients(self,lr):
+        """Return the log posterior gradient estimates at lr.beta and lr.beta_mode using the current minibatch"""
+        return lr.dlogpostcv(self)
+
+
     def sample_minibatch(self,lr):
-        """Sample the next minibatch"""
-        self.minibatch = np.random.choice( np.arange( lr.N ), self.minibatch_size, replace = False )
+        """Sample the next minibatch and gather its rows and weights from the data source"""
+        self.minibatch, self.X_batch, self.y_batch = lr.data.minibatch( self.minibatch_size )
+        self.w_batch = None
+        if lr.data.weights is not None:
+            self.w_batch = lr.data.weights[self.minibatch]
 
 
-    def control_variates(self,lr):
+    def control_variates(self,lr,degree=1):
         """
         Postprocess a fitted LogisticRegression object using zero variance control variates.
 
         Assumes object has already been fitted using SLGD i.e. lr.sample is nonempty.
+        All coordinates are corrected at once, see ZeroVariance. Prints the median and 
+        minimum variance reduction over coordinates.
 
         Parameters:
         lr - fitted LogisticRegression object
+        degree - degree of the polynomial control variates, 1 or 2 (optional)
 
-        Modifies:
-        lr.sample - updates stored MCMC chain using ZV control variates
+        Returns:
+        llold - test log loss at 20 random iterations of the chain
+        llnew - test log loss at the same iterations of the corrected chain
         """
-        pot_energy = - 1 / 2.0 * lr.grad_sample
-        sample_mean = np.mean( lr.sample, axis = 0 )
-        grad_mean = np.mean( pot_energy, axis = 0 )
-        var_grad_inv = self.shrinkage_precision(pot_energy)
-
-        # Initialise variables
-        cov_params = np.zeros( lr.d )
-        a_current = np.zeros( lr.d )
-        new_sample = np.zeros( lr.sample.shape )
-
-        # Calculate covariance for each parameter
         print "Calculating control variates..."
-        for j in range(lr.d):
-            sys.stdout.write("{0} ".format(j))
-            sys.stdout.flush()
-            cov_params = np.zeros(lr.d)
-            a_current = np.zeros(lr.d)
-            for i in range(lr.n_iters):
-                cov_params += 1 / float( lr.n_iters - 1 ) * ( 
-                        lr.sample[i,j] - sample_mean[j] ) * ( pot_energy[i,:] - grad_mean )
-            # Update sample for current dimension
-            a_current = - np.matmul( var_grad_inv, cov_params )
-            for i in range(lr.n_iters):
-                new_sample[i,j] = lr.sample[i,j] + np.dot( a_current, pot_energy[i,:] )
-        print
+        new_sample = ZeroVariance( lr.grad_sample, lr.sample, degree ).correct( lr.sample )
+        reduction = variance_reduction( lr.sample, new_sample )
+        print "Variance reduction: median {0:.2f}, minimum {1:.2f}".format( 
+                np.median(reduction), reduction.min() )
         # Compare new samples
         sample_size = 20
         random_points = np.random.choice( range(lr.n_iters), sample_size )
@@ -121,10 +289,3 @@ class ZVSGLD:
             llnew[i] = lr.loglossp( new_sample[index,:] )
         print
         return llold, llnew
-
-
-    def shrinkage_precision(self,PE):
-        """Calculate estimate of precision of PE using shrinkage"""
-        model = LedoitWolf()
-        model.fit(PE)
-        return model.get_precision()
@@ -0,0 +1,84 @@
+import numpy as np
+from timeit import default_timer
+from ..logistic_regression.logistic_regression import LogisticRegression
+from ..logistic_regression.data_source import ArrayData, BlockData
+from .cover_type_sgld_zv import CoverType
+
+
+class MinibatchBenchmark:
+    """
+    Compare uniform minibatches against BlockData's contiguous minibatches.
+
+    For each data layout, repeatedly draw a minibatch and estimate the control variate
+    correction, the difference in log likelihood gradients between a fixed point near the
+    mode and the mode. Reports the time per estimate, the largest standardised difference
+    between the average estimate and its full data value (which should look like a draw
+    from a standard normal maximum if the estimate is unbiased) and the total variance of
+    the estimate relative to uniform minibatches.
+    """
+
+    def __init__(self,n_obs=0.1,sgd_step=5e-5,minibatch_size=500,n_draws=2000):
+        """
+        Load the cover type data and the SGD mode.
+
+        Parameters:
+        n_obs - proportion of the cover type training set to use (optional)
+        sgd_step - stepsize of the SGD run used to find the mode (optional)
+        minibatch_size - size of each minibatch (optional)
+        n_draws - number of minibatches to draw for each layout (optional)
+        """
+        example = CoverType()
+        train_size = int( example.X_train.shape[0] * n_obs )
+        test_size = int( example.X_test.shape[0] * n_obs )
+        example.truncate( train_size, test_size )
+        self.X = example.X_train
+        self.y = example.y_train
+        self.X_test = example.X_test
+        self.y_test = example.y_test
+        self.beta_mode = np.load( "{0}cover_type_mode/{1}/{2}.npy".format(
+                example.data_dir, train_size, sgd_step ) )
+        self.minibatch_size = minibatch_size
+        self.n_draws = n_draws
+
+
+    def estimates(self,lr,data,beta):
+        """Return the time per estimate and an array of control variate gradient estimates"""
+        estimates = np.zeros( ( self.n_draws, lr.d ) )
+        start = default_timer()
+        for i in range( self.n_draws ):
+            indices, X, y = data.minibatch( self.minibatch_size )
+            estimates[i,:] = lr.dloglik( beta, X, y ) - lr.dloglik( self.beta_mode, X, y )
+        elapsed = ( default_timer() - start ) / self.n_draws
+        return elapsed, estimates * lr.N / float( self.minibatch_size )
+
+
+    def run(self):
+        """Run the benchmark and print a summary of each layout"""
+        lr = LogisticRegression( self.X, self.X_test, self.y, self.y_test )
+        beta = self.beta_mode + 0.01 * np.random.normal( size = lr.d )
+        # Exact full data value of the control variate correction
+        exact = np.zeros( lr.d )
+        for X, y in lr.data.blocks():
+            exact += lr.dloglik( beta, X, y ) - lr.dloglik( self.beta_mode, X, y )
+        layouts = [ ( 'uniform', ArrayData( self.X, self.y ) ),
+                ( 'block-1', BlockData( self.X, self.y, 1 ) ),
+                ( 'block-5', BlockData( self.X, self.y, 5 ) ) ]
+        print "{0}\t{1}\t\t{2}\t{3}".format( "layout", "time", "max |z|", "relative variance" )
+        baseline = None
+        for name, data in layouts:
+            elapsed, estimates = self.estimates( lr, data, beta )
+            se = estimates.std( axis = 0, ddof = 1 ) / np.sqrt( self.n_draws )
+            nonzero = se > 0
+            z = np.abs( estimates.mean( axis = 0 ) - exact )[nonzero] / se[nonzero]
+            variance = estimates.var( axis = 0 ).sum()
+            if baseline is None:
+                baseline = variance
+            print "{0}\t{1:.2e}\t{2:.2f}\t\t{3:.3f}".format( name, elapsed, z.max(), 
+                    variance / baseline )
+        lr.close()
+
+
+if __name__ == '__main__':
+    print "Benchmark started!"
+    benchmark = MinibatchBenchmark()
+    benchmark.run()
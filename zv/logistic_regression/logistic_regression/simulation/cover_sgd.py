@@ -7,6 +7,7 @@ import bz2
 from sklearn.datasets import load_svmlight_file
 from sklearn.model_selection import train_test_split
 from ..logistic_regression.logistic_regression import LogisticRegression
+from ..logistic_regression.results import ResultStore
 
 
 class CoverType:
@@ -64,7 +65,10 @@ class CoverType:
             os.makedirs( self.data_dir + 'cover_type_mode/{0}'.format(N) )
         print "Saving file to path: {0}cover_type_mode/{1}/{2}.npy".format( self.data_dir, N, stepsize )
         np.save( "{0}cover_type_mode/{1}/{2}.npy".format( self.data_dir, N, stepsize ), self.lr.beta )
-        np.savetxt( "{0}cover_type_mode/{1}/log_loss-{2}.log".format( self.data_dir, N, stepsize ), np.array( self.lr.training_loss ) )
+        store = ResultStore( self.data_dir + 'cover_type_mode/results' )
+        store.append( method = 'sgd', stepsize = stepsize, N = N, 
+                sampling_time = self.lr.sampling_time, training_loss = self.lr.training_loss )
+        self.lr.close()
 
 
     def download_data(self):
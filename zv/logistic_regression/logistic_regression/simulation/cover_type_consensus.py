@@ -0,0 +1,28 @@
+import sys
+import numpy as np
+from ..logistic_regression.consensus import ConsensusSampler
+from .cover_type_sgld_zv import CoverType
+
+
+def run(n_shards,stepsize=1e-6,sgd_step=5e-5,n_iters=10**4):
+    """
+    Fit the cover type posterior by consensus sampling over n_shards shards.
+
+    Prints the test log loss at the mean of the combined sample for each combination method.
+    """
+    example = CoverType()
+    n_obs = example.X_train.shape[0]
+    beta_mode = np.load( "{0}cover_type_mode/{1}/{2}.npy".format( example.data_dir, n_obs,
+            sgd_step ) )
+    sampler = ConsensusSampler( example.X_train, example.X_test, example.y_train,
+            example.y_test, n_shards )
+    # Subposterior gradients are about n_shards times smaller, so scale the stepsize up
+    sampler.fit( stepsize * n_shards, beta_mode, n_iters )
+    for method in [ 'consensus', 'gaussian' ]:
+        print "{0}\t{1}".format( method, sampler.logloss( sampler.combine(method) ) )
+
+
+if __name__ == '__main__':
+    n_shards = int( sys.argv[1] )
+    np.random.seed(n_shards)
+    run(n_shards)
@@ -0,0 +1,35 @@
+import sys
+import numpy as np
+from ..logistic_regression.logistic_regression import LogisticRegression
+from ..logistic_regression.coreset import build_coreset, compare_posteriors
+from .cover_type_sgld_zv import CoverType
+
+
+def run(size,stepsize=1e-6,sgd_step=5e-5,n_iters=10**4):
+    """
+    Fit the cover type posterior to a coreset of the training data and to the full data.
+
+    Prints how far the coreset posterior is from the full data posterior.
+    """
+    example = CoverType()
+    n_obs = example.X_train.shape[0]
+    beta_mode = np.load( "{0}cover_type_mode/{1}/{2}.npy".format( example.data_dir, n_obs,
+            sgd_step ) )
+    full = LogisticRegression( example.X_train, example.X_test, example.y_train, example.y_test )
+    coreset, indices = build_coreset( full.data, beta_mode, size )
+    print "Coreset holds {0} of {1} rows".format( coreset.N, n_obs )
+    full.fit( stepsize, beta_mode, n_iters )
+    # The weighted coreset log likelihood estimates the full one, so the stepsize is unchanged
+    lr = LogisticRegression( coreset, example.X_test, None, example.y_test )
+    lr.fit( stepsize, beta_mode, n_iters )
+    report = compare_posteriors( lr.sample, full.sample, example.X_test, example.y_test )
+    full.close()
+    lr.close()
+    for key in sorted(report):
+        print "{0}\t{1}".format( key, report[key] )
+
+
+if __name__ == '__main__':
+    size = int( sys.argv[1] )
+    np.random.seed(size)
+    run(size)
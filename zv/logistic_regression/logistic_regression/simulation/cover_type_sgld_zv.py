@@ -8,6 +8,9 @@ import bz2
 from sklearn.datasets import load_svmlight_file
 from sklearn.model_selection import train_test_split
 from ..logistic_regression.logistic_regression import LogisticRegression
+from ..logistic_regression.checkpoint import Checkpointer
+from ..logistic_regression.batch import batch_postprocess
+from ..logistic_regression.results import ResultStore
 
 
 class CoverType:
@@ -46,11 +49,15 @@ class CoverType:
         self.y_test = self.y_test[:test_size]
 
 
-    def fit(self,stepsize,sgd_step):
+    def fit(self,stepsize,sgd_step,checkpointer=None,stopping=None):
         n_obs = self.X_train.shape[0]
         self.lr = LogisticRegression( self.X_train, self.X_test, self.y_train, self.y_test )
+        # Continue from the last checkpoint if the job was interrupted
+        if checkpointer is not None and os.path.exists( checkpointer.path ):
+            self.lr.resume(checkpointer,stopping=stopping)
+            return
         beta_mode = np.load( "{0}cover_type_mode/{1}/{2}.npy".format(self.data_dir,n_obs,sgd_step) )
-        self.lr.fit(stepsize,beta_mode,10**4)
+        self.lr.fit(stepsize,beta_mode,10**4,checkpointer=checkpointer,stopping=stopping)
 
 
     def download_data(self):
@@ -90,18 +97,53 @@ class CoverType:
         stepsize = stepsize_list[index % n_stepsizes]
         print "Stepsize: {0}\tSeed: {1}".format(stepsize, seed_current)
         random.seed(seed_current)
-        self.fit(stepsize,sgd_step)
-        llold, llnew = self.lr.postprocess() 
         try:
             os.makedirs( self.data_dir + outdir + '/{0}/'.format(stepsize) )
         except OSError:
             pass
-        np.savetxt( self.data_dir + outdir + '/{0}/old-{1}.dat'.format(stepsize, seed_current), np.array(llold))
-        np.savetxt( self.data_dir + outdir + '/{0}/new-{1}.dat'.format(stepsize, seed_current), np.array(llnew))
+        checkpointer = Checkpointer( self.data_dir + outdir + '/{0}/checkpoint-{1}.npz'.format(
+                stepsize, seed_current ) )
+        self.fit(stepsize,sgd_step,checkpointer)
+        llold, llnew = self.lr.postprocess() 
+        store = ResultStore( self.data_dir + outdir + '/results' )
+        store.append( method = 'sgld_zv', stepsize = stepsize, seed = seed_current, 
+                N = self.X_train.shape[0], sampling_time = self.lr.sampling_time, 
+                llold = llold, llnew = llnew )
+        self.lr.close()
+
+
+    def postprocess_sweep(self,pooled=False):
+        """
+        Postprocess every finished chain of the sweep at once, adding the results to the store
+
+        Chains are found from the checkpoints written by simulation_step. If pooled is True
+        chains with the same stepsize share a control variate covariance.
+        """
+        outdir = self.data_dir + 'cover_type_sgld_zv/'
+        store = ResultStore( outdir + 'results' )
+        stepsize_list = [1e-6, 3e-6, 5e-6, 8e-6, 1e-5, 3e-5, 5e-5]
+        for stepsize in stepsize_list:
+            paths = []
+            seeds = []
+            seed = 1
+            while os.path.exists( outdir + '{0}/checkpoint-{1}.npz'.format( stepsize, seed ) ):
+                paths.append( outdir + '{0}/checkpoint-{1}.npz'.format( stepsize, seed ) )
+                seeds.append( seed )
+                seed += 1
+            if not paths:
+                continue
+            print "Stepsize: {0}\tPostprocessing {1} chains".format( stepsize, len(paths) )
+            results = batch_postprocess( paths, self.X_test, self.y_test, pooled = pooled, 
+                    stepsize = [ stepsize ] * len(seeds), seed = seeds )
+            store.extend( method = 'sgld_zv_batch', pooled = pooled, N = self.X_train.shape[0],
+                    **results )
 
 
 if __name__ == '__main__':
-    print "Simulation started!"
-    index = int( sys.argv[1] ) - 1
     example = CoverType()
-    example.simulation_step(index)
+    if sys.argv[1] == 'batch':
+        example.postprocess_sweep( pooled = 'pooled' in sys.argv[2:] )
+    else:
+        print "Simulation started!"
+        index = int( sys.argv[1] ) - 1
+        example.simulation_step(index)
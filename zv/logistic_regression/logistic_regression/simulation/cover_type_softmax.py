@@ -0,0 +1,83 @@
+import os
+import sys
+import pkg_resources
+import urllib
+import numpy as np
+import bz2
+from sklearn.datasets import load_svmlight_file
+from sklearn.model_selection import train_test_split
+from ..logistic_regression.softmax_regression import SoftmaxRegression
+
+
+class CoverTypeMulticlass:
+    """
+    Example for fitting a softmax regression model to the 7 class cover type dataset
+
+    References:
+    1. Cover type dataset - https://www.csie.ntu.edu.tw/~cjlin/libsvmtools/datasets/multiclass.html
+    """
+
+    def __init__(self):
+        """Load data into the object, downloading it if it's not available"""
+        self.data_dir = pkg_resources.resource_filename('logistic_regression', 'data/')
+        self.lr = None
+        path = self.data_dir + 'cover_type_multiclass/'
+        try:
+            np.load( path + 'X_train.dat' )
+        except IOError:
+            self.download_data()
+            self.X_train, self.X_test, self.y_train, self.y_test = self.preprocess()
+            self.X_train.dump( path + 'X_train.dat' )
+            self.X_test.dump( path + 'X_test.dat' )
+            self.y_train.dump( path + 'y_train.dat' )
+            self.y_test.dump( path + 'y_test.dat' )
+        else:
+            self.X_train = np.load( path + 'X_train.dat' )
+            self.X_test = np.load( path + 'X_test.dat' )
+            self.y_train = np.load( path + 'y_train.dat' )
+            self.y_test = np.load( path + 'y_test.dat' )
+
+
+    def download_data(self):
+        """Download raw multiclass cover type data"""
+        if not os.path.exists( self.data_dir + 'cover_type_multiclass' ):
+            os.makedirs( self.data_dir + 'cover_type_multiclass' )
+        print "Downloading data..."
+        urllib.urlretrieve( ( "https://www.csie.ntu.edu.tw/~cjlin/libsvmtools/"
+                "datasets/multiclass/covtype.scale01.bz2" ),
+                self.data_dir + "cover_type_multiclass/covtype.scale01.bz2" )
+        compressed_file = bz2.BZ2File( self.data_dir + 'cover_type_multiclass/covtype.scale01.bz2',
+                'r')
+        with open( self.data_dir + 'cover_type_multiclass/raw.dat', 'w' ) as out:
+            out.write( compressed_file.read() )
+
+
+    def preprocess(self):
+        """Preprocess raw data once downloaded, split into train and test sets"""
+        X, y = load_svmlight_file( self.data_dir + 'cover_type_multiclass/raw.dat' )
+        X_train, X_test, y_train, y_test = train_test_split( X, y )
+        # Set classes to go from 0 to 6
+        y_train -= 1
+        y_test -= 1
+        # Add a bias term to X
+        X_train = np.concatenate( ( np.ones( ( len(y_train), 1 ) ), X_train.todense() ), axis = 1 )
+        X_test = np.concatenate( ( np.ones( ( len(y_test), 1 ) ), X_test.todense() ), axis = 1 )
+        return X_train, X_test, y_train.astype(int), y_test.astype(int)
+
+
+    def fit(self,stepsize,sgd_step,n_iters=10**4):
+        """Find the mode using SGD, then fit the posterior using SGLD with control variates"""
+        self.lr = SoftmaxRegression( self.X_train, self.X_test, self.y_train, self.y_test )
+        self.lr.fit_sgd( sgd_step, n_iters )
+        beta_mode = self.lr.beta.copy()
+        self.lr.fit( stepsize, beta_mode, n_iters )
+
+
+if __name__ == '__main__':
+    seed = int( sys.argv[1] )
+    np.random.seed(seed)
+    example = CoverTypeMulticlass()
+    example.fit( 1e-6, 5e-6 )
+    llold, llnew = example.lr.postprocess()
+    print "Test log loss: {0} before ZV, {1} after".format( llold.mean(), llnew.mean() )
+    example.lr.close()
@@ -0,0 +1,45 @@
+import unittest
+import numpy as np
+from ..logistic_regression.logistic_regression import LogisticRegression
+from ..logistic_regression.data_source import BlockData
+from ..logistic_regression.metrics import Metrics
+from ..logistic_regression.schedule import MinibatchSchedule
+
+
+class RecordingBlockData(BlockData):
+    """BlockData which records the size of every minibatch drawn"""
+
+    def __init__(self,X,y,n_blocks=1):
+        BlockData.__init__(self,X,y,n_blocks)
+        self.sizes = []
+
+
+    def minibatch(self,minibatch_size):
+        self.sizes.append( minibatch_size )
+        return BlockData.minibatch(self,minibatch_size)
+
+
+class TestMinibatchSchedule(unittest.TestCase):
+
+    def test_block_data_sizes(self):
+        """Every size set by the schedule is a whole number of BlockData chunks"""
+        np.random.seed(1)
+        N, d, n_blocks = 2000, 5, 4
+        X = np.random.normal( size = ( N, d ) )
+        y = ( np.random.random_sample( N ) < 1 / ( 1 + np.exp( - X.sum( axis = 1 ) ) ) )
+        data = RecordingBlockData( X, y.astype(int), n_blocks )
+        lr = LogisticRegression( data, X[:100], None, y[:100].astype(int) )
+        # A band of 1 resizes at every estimate, min_size and max_size aren't whole chunks
+        schedule = MinibatchSchedule( band = 1.0, min_size = 10, max_size = 1001, every = 1 )
+        metrics = Metrics()
+        lr.fit( 1e-4, np.zeros(d), n_iters = 200, minibatch_size = 100, metrics = metrics,
+                schedule = schedule )
+        lr.close()
+        self.assertEqual( lr.n_iters, 200 )
+        self.assertGreater( metrics.counters['minibatch_resizes'], 0 )
+        self.assertTrue( all( size % n_blocks == 0 for size in data.sizes ) )
+        self.assertTrue( all( 12 <= size <= 1000 for size in data.sizes ) )
+
+
+if __name__ == '__main__':
+    unittest.main()